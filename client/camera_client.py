@@ -14,9 +14,214 @@ import base64
 import time
 from pathlib import Path
 import argparse
+import random
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Tuple
+
+PROTOCOL_VERSION = 1   # 支援的伺服器上傳協定版本
+DEFAULT_MAX_FPS = 15   # 伺服器未公告時的上傳幀率
+BUFFER_FPS = 2         # 斷線期間暫存影像的最高幀率
+MAX_READ_FAILURES = 50 # 連續讀取失敗幾次後重新開啟攝影機
+READ_TIMEOUT = 1.0     # 等待擷取執行緒提供影像的秒數
+
+
+def reconnect_delay(attempt: int, max_delay: float, base: float = 1.0) -> float:
+    """重新連線等待秒數 (指數退避 + 隨機抖動, 避免所有攝影機同時重連)"""
+    delay = min(max_delay, base * (2 ** min(attempt, 16)))
+    return random.uniform(delay / 2, delay)
+
+class AdaptiveJpegQuality:
+    """依實際上傳位元率調整 JPEG 品質 (超過目標降低品質, 明顯低於目標時逐步提高)"""
+
+    def __init__(self, target_kbps: float, quality: int = 80, min_quality: int = 40, max_quality: int = 90,
+                 window: float = 1.0):
+        self.target_kbps = target_kbps
+        self.quality = quality
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.window = window
+        self.kbps = 0.0
+        self._bytes = 0
+        self._window_start = time.monotonic()
+
+    def record(self, nbytes: int):
+        """記錄一次上傳的位元組數, 每個統計區間調整一次品質"""
+        self._bytes += nbytes
+        elapsed = time.monotonic() - self._window_start
+        if elapsed < self.window:
+            return
+        self.kbps = self._bytes * 8 / 1000 / elapsed
+        self._bytes = 0
+        self._window_start = time.monotonic()
+
+        if self.target_kbps <= 0:
+            return
+        if self.kbps > self.target_kbps * 1.05:
+            # 超出越多降越多
+            step = max(2, int(10 * (self.kbps / self.target_kbps - 1)))
+            self.quality = max(self.min_quality, self.quality - step)
+        elif self.kbps < self.target_kbps * 0.8:
+            self.quality = min(self.max_quality, self.quality + 2)
+
+
+class FrameGrabber:
+    """
+    擷取執行緒: 持續 grab 清空攝影機緩衝, 只保留最新一幀
+
+    上傳比來源慢時, OpenCV (FFmpeg) 的緩衝會堆積舊影像, 延遲越來越大。
+    執行緒不斷 grab (只取封包, 不解碼), 有人要影像時才 retrieve (解碼) 剛取到的那一幀,
+    被略過的影像不花解碼成本。連續讀取失敗過多時重新開啟攝影機。
+    """
+
+    def __init__(self, open_capture: Callable, is_file: bool = False):
+        """
+        Args:
+            open_capture: 開啟攝影機的函式 (回傳 cv2.VideoCapture)
+            is_file: 影片檔 (依原始 FPS 讀取, 不然會瞬間讀完)
+        """
+        self._open_capture = open_capture
+        self.is_file = is_file
+        self.cap = None
+        self.grabbed = 0
+        self.retrieved = 0
+        self._failures = 0
+        self._want = False
+        self._frame = None
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def skipped(self) -> int:
+        """略過 (未解碼) 的舊影像數"""
+        return self.grabbed - self.retrieved
+
+    def start(self, cap):
+        """以已開啟的攝影機啟動擷取執行緒"""
+        self.cap = cap
+        self._thread = threading.Thread(target=self._run, name="frame-grabber", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2.0)
+
+    def read(self, timeout: float = READ_TIMEOUT):
+        """取出下一幀最新影像 (逾時或已停止時回傳 None)"""
+        with self._cond:
+            self._want = True
+            self._cond.wait_for(lambda: self._frame is not None or self._stop.is_set(), timeout)
+            self._want = False
+            frame, self._frame = self._frame, None
+            return frame
+
+    def _run(self):
+        cap = self.cap
+        fps = cap.get(cv2.CAP_PROP_FPS) if cap is not None else 0
+        frame_interval = 1.0 / fps if 0 < fps < 120 else 1.0 / 15
+        try:
+            while not self._stop.is_set():
+                started = time.monotonic()
+                if cap is not None and cap.isOpened() and cap.grab():
+                    self._failures = 0
+                    self.grabbed += 1
+                    with self._cond:
+                        if self._want:
+                            ok, frame = cap.retrieve()
+                            if ok:
+                                self.retrieved += 1
+                                self._frame = frame
+                                self._cond.notify_all()
+                    if self.is_file:
+                        self._stop.wait(max(0.0, frame_interval - (time.monotonic() - started)))
+                    continue
+
+                self._failures += 1
+                if self._failures == 1:
+                    print("⚠️ 讀取影像失敗")
+                if self._failures >= MAX_READ_FAILURES:
+                    print("🔄 攝影機讀取持續失敗, 重新開啟")
+                    if cap is not None:
+                        cap.release()
+                    cap = self.cap = self._open_capture()
+                    self._failures = 0
+                self._stop.wait(0.1)
+        finally:
+            if cap is not None:
+                cap.release()
+
+
+class EdgePrefilter:
+    """
+    邊緣端預篩選: 只在畫面有動靜 (或偵測到人) 時上傳
+
+    - motion: 縮小灰階畫面與上一幀的差異超過門檻
+    - person: 有動靜時再以 HOG 行人偵測確認 (沒有動靜時不執行, 節省 CPU)
+
+    觸發後持續上傳 hold_seconds 秒 (伺服器需連續多幀才判定吸菸);
+    其餘時間每 keepalive_seconds 秒上傳一幀, 維持攝影機在線狀態。
+    """
+
+    def __init__(self, mode: str = 'motion', hold_seconds: float = 3.0, keepalive_seconds: float = 5.0,
+                 motion_threshold: float = 0.01, detect_width: int = 320):
+        self.mode = mode
+        self.hold_seconds = hold_seconds
+        self.keepalive_seconds = keepalive_seconds
+        self.motion_threshold = motion_threshold
+        self.detect_width = detect_width
+        self.active_until = 0.0
+        self.last_upload = 0.0
+        self.skipped = 0
+        self.keepalives = 0
+        self._prev = None
+        self._hog = None
+        if mode == 'person' and not hasattr(cv2, 'HOGDescriptor'):
+            # OpenCV 5 起 HOG 移到 contrib, 沒有時只用動態偵測
+            print("⚠️ 此 OpenCV 版本沒有 HOGDescriptor, 預篩選改用動態偵測")
+        elif mode == 'person':
+            self._hog = cv2.HOGDescriptor()
+            self._hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+
+    def should_upload(self, frame) -> bool:
+        """判斷這一幀是否需要上傳"""
+        now = time.monotonic()
+        if self._is_relevant(frame):
+            self.active_until = now + self.hold_seconds
+        if now < self.active_until or now - self.last_upload >= self.keepalive_seconds:
+            if now >= self.active_until:
+                self.keepalives += 1
+            self.last_upload = now
+            return True
+        self.skipped += 1
+        return False
+
+    def _is_relevant(self, frame) -> bool:
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.detect_width / width)
+        small = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+        prev, self._prev = self._prev, gray
+        if prev is None or prev.shape != gray.shape:
+            return True
+        _, diff = cv2.threshold(cv2.absdiff(prev, gray), 25, 255, cv2.THRESH_BINARY)
+        moving = cv2.countNonZero(diff) / diff.size >= self.motion_threshold
+        if not moving or self._hog is None:
+            return moving
+
+        rects, _ = self._hog.detectMultiScale(small, winStride=(8, 8))
+        return len(rects) > 0
+
 
 class CameraClient:
-    def __init__(self, server_url: str, api_key: str, camera_source: str, camera_type: str = 'local'):
+    def __init__(self, server_url: str, api_key: str, camera_source: str, camera_type: str = 'local',
+                 max_size: int = 0, target_kbps: float = 1500, prefilter: str = 'off',
+                 keepalive: float = 5.0, prefilter_hold: float = 3.0, buffer_frames: int = 30,
+                 reconnect_max: float = 30.0):
         """
         初始化攝影機客戶端
         
@@ -28,136 +233,205 @@ class CameraClient:
                 - RTSP: "rtsp://username:password@ip:port/stream"
                 - HTTP: "http://ip:port/video"
             camera_type: 攝影機類型 ('local', 'usb', 'rtsp')
+            max_size: 上傳影像長邊上限 (0 = 使用伺服器公告的模型輸入尺寸)
+            target_kbps: 目標上傳位元率 (kbps, 0 = 固定品質)
+            prefilter: 邊緣預篩選 ('off', 'motion', 'person'), 沒有動靜時只每 keepalive 秒上傳一幀
+            keepalive: 預篩選時沒有動靜的上傳間隔 (秒)
+            prefilter_hold: 觸發後持續上傳的秒數
+            buffer_frames: 斷線期間暫存的影像數 (啟用預篩選時只暫存有動靜的影像; 0 = 不暫存)
+            reconnect_max: 重新連線等待時間上限 (秒)
         """
         self.server_url = server_url
         self.api_key = api_key
         self.camera_source = camera_source
         self.camera_type = camera_type
-        self.cap = None
+        self.grabber = None
         self.is_running = False
+        self.user_max_size = max_size
+        self.max_size = max_size
+        self.max_fps = DEFAULT_MAX_FPS
+        self.last_alert_time = 0
+        self.quality = AdaptiveJpegQuality(target_kbps)
+        self.reconnect_max = reconnect_max
+        self.buffer: Deque[Tuple[float, str]] = deque(maxlen=buffer_frames)  # (拍攝時間, 影像)
+        self.buffer_dropped = 0
+        self.prefilter = None
+        if prefilter != 'off':
+            self.prefilter = EdgePrefilter(prefilter, hold_seconds=prefilter_hold, keepalive_seconds=keepalive)
         
     def init_camera(self):
-        """初始化攝影機"""
+        """初始化攝影機並啟動擷取執行緒"""
+        cap = self.open_capture()
+        if cap is None:
+            return False
+        is_file = self.camera_type == 'rtsp' and Path(self.camera_source).is_file()
+        self.grabber = FrameGrabber(self.open_capture, is_file=is_file)
+        self.grabber.start(cap)
+        return True
+    
+    def open_capture(self):
+        """開啟攝影機 (失敗時回傳 None)"""
+        cap = None
         try:
             if self.camera_type in ['local', 'usb']:
                 # USB 或本地攝影機
                 camera_id = int(self.camera_source)
-                self.cap = cv2.VideoCapture(camera_id)
+                cap = cv2.VideoCapture(camera_id)
                 
                 # 設定解析度 (降低以減少頻寬)
-                self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 960)
-                self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 540)
-                self.cap.set(cv2.CAP_PROP_FPS, 15)
+                cap.set(cv2.CAP_PROP_FRAME_WIDTH, 960)
+                cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 540)
+                cap.set(cv2.CAP_PROP_FPS, 15)
                 
             elif self.camera_type == 'rtsp':
                 # RTSP 串流 (例如小米監視器)
-                self.cap = cv2.VideoCapture(self.camera_source)
+                cap = cv2.VideoCapture(self.camera_source)
                 
                 # RTSP 建議設定
-                self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # 減少延遲
+                cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # 減少延遲
             
-            if not self.cap.isOpened():
+            if cap is None or not cap.isOpened():
                 raise Exception("無法開啟攝影機")
             
             print(f"✅ 攝影機初始化成功 [{self.camera_type}]: {self.camera_source}")
-            return True
+            return cap
             
         except Exception as e:
             print(f"❌ 攝影機初始化失敗: {e}")
-            return False
-    
-    def read_frame(self):
-        """讀取一幀影像"""
-        if self.cap is None or not self.cap.isOpened():
-            return None
-        
-        ret, frame = self.cap.read()
-        if not ret:
-            print("⚠️ 讀取影像失敗")
+            if cap is not None:
+                cap.release()
             return None
-        
-        return frame
     
+    def resize_frame(self, frame):
+        """縮小到模型輸入尺寸 (長邊不超過 max_size, 只縮小不放大)"""
+        if not self.max_size:
+            return frame
+        height, width = frame.shape[:2]
+        scale = self.max_size / max(height, width)
+        if scale >= 1:
+            return frame
+        return cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
     def encode_frame(self, frame):
         """將影像編碼為 base64"""
-        # 壓縮影像品質以減少頻寬
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 85]
+        # 壓縮影像品質以減少頻寬 (品質依上傳位元率調整)
+        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality.quality]
         _, buffer = cv2.imencode('.jpg', frame, encode_param)
         frame_base64 = base64.b64encode(buffer).decode('utf-8')
         return frame_base64
+
+    async def receive_config(self, websocket):
+        """接收伺服器連線後公告的上傳參數 (協商)"""
+        try:
+            data = json.loads(await asyncio.wait_for(websocket.recv(), timeout=2.0))
+        except asyncio.TimeoutError:
+            print("⚠️ 伺服器未公告上傳參數, 使用預設值")
+            return
+        if data.get("type") == "config":
+            self.apply_config(data.get("data", {}))
+
+    def apply_config(self, config: dict):
+        """套用伺服器公告的上傳參數 (連線時與串流中負載改變時)"""
+        version = config.get("protocol_version", 0)
+        if version > PROTOCOL_VERSION:
+            print(f"⚠️ 伺服器協定版本 {version} 較新 (客戶端: {PROTOCOL_VERSION}), 僅套用支援的參數")
+        if config.get("encoding", "jpeg") != "jpeg":
+            print(f"⚠️ 不支援的編碼 {config['encoding']}, 繼續使用 JPEG")
+
+        max_size = config.get("max_size") or config.get("model_input_size")
+        if not self.user_max_size and max_size:
+            self.max_size = int(max_size)
+        if config.get("max_fps"):
+            self.max_fps = float(config["max_fps"])
+        print(f"📐 上傳參數: 長邊 {self.max_size or '原始'} / 最高 {self.max_fps:g} FPS")
+
+    async def receive_response(self, websocket) -> dict:
+        """接收偵測回應 (途中收到的 config 訊息直接套用)"""
+        while True:
+            data = json.loads(await asyncio.wait_for(websocket.recv(), timeout=1.0))
+            if data.get("type") != "config":
+                return data
+            self.apply_config(data.get("data", {}))
     
+    def handle_response(self, data: dict):
+        """處理伺服器的偵測回應 (警報每 5 秒最多顯示一次)"""
+        if data.get("type") != "alert":
+            return
+        current_time = time.time()
+        if current_time - self.last_alert_time > 5:
+            print(f"🚨 警報！偵測到吸菸行為 [{self.camera_source}]")
+            print(f"   信心度: {data['data'].get('max_confidence', 0):.2f}")
+            self.last_alert_time = current_time
+
+    def next_encoded_frame(self):
+        """讀取、縮小並編碼一幀 (閘道模式在執行緒中呼叫)"""
+        frame = self.read_frame()
+        if frame is None or not self.should_upload(frame):
+            return None
+        return self.encode_frame(self.resize_frame(frame))
+
+    def should_upload(self, frame) -> bool:
+        """邊緣預篩選 (未啟用時每幀都上傳)"""
+        return self.prefilter is None or self.prefilter.should_upload(frame)
+
+    def status_text(self) -> str:
+        """上傳狀態 (位元率、JPEG 品質、預篩選略過幀數)"""
+        text = f"{self.quality.kbps:.0f} kbps, JPEG 品質 {self.quality.quality}"
+        if self.grabber is not None:
+            text += f", 捨棄舊影像 {self.grabber.skipped} 幀"
+        if self.prefilter is not None:
+            text += f", 略過 {self.prefilter.skipped} 幀"
+        return text
+
     async def start_streaming(self):
-        """開始串流到伺服器"""
+        """
+        開始串流到伺服器
+
+        斷線後依指數退避自動重連, 期間攝影機保持開啟並持續讀取 (RTSP 重新開啟很慢);
+        斷線期間的影像 (啟用預篩選時只保留有動靜的) 暫存在記憶體, 重連後先補送。
+        """
         if not self.init_camera():
             return
         
         ws_url = f"{self.server_url}/ws/upload/{self.api_key}"
-        print(f"🔄 正在連線到伺服器: {ws_url}")
+        self.is_running = True
+        attempt = 0
         
         try:
-            async with websockets.connect(ws_url) as websocket:
-                print("✅ 已連線到伺服器")
-                self.is_running = True
+            while self.is_running:
+                print(f"🔄 正在連線到伺服器: {ws_url}")
+                try:
+                    async with websockets.connect(ws_url) as websocket:
+                        print("✅ 已連線到伺服器")
+                        attempt = 0
+                        await self.receive_config(websocket)
+                        await self.send_buffered(websocket)
+                        await self.stream_frames(websocket)
                 
-                frame_count = 0
-                last_alert_time = 0
+                except websockets.exceptions.InvalidStatusCode as e:
+                    print(f"❌ 連線失敗: {e}")
+                    print("💡 請檢查:")
+                    print("   1. 伺服器是否正在運行")
+                    print("   2. 網路連線是否正常")
                 
-                while self.is_running:
-                    # 讀取影像
-                    frame = self.read_frame()
-                    if frame is None:
-                        await asyncio.sleep(0.1)
-                        continue
-                    
-                    # 編碼影像
-                    frame_base64 = self.encode_frame(frame)
-                    
-                    # 發送到伺服器
-                    try:
-                        await websocket.send(json.dumps({
-                            "type": "frame",
-                            "data": frame_base64
-                        }))
-                        
-                        frame_count += 1
-                        
-                        # 接收伺服器回應
-                        response = await asyncio.wait_for(
-                            websocket.recv(),
-                            timeout=1.0
-                        )
-                        
-                        data = json.loads(response)
-                        
-                        # 處理警報
-                        if data.get("type") == "alert":
-                            current_time = time.time()
-                            # 避免頻繁警報(每 5 秒最多一次)
-                            if current_time - last_alert_time > 5:
-                                print(f"🚨 警報！偵測到吸菸行為")
-                                print(f"   信心度: {data['data'].get('max_confidence', 0):.2f}")
-                                last_alert_time = current_time
-                        
-                        # 顯示狀態 (每 30 幀顯示一次)
-                        if frame_count % 30 == 0:
-                            print(f"📊 已上傳 {frame_count} 幀影像")
-                    
-                    except asyncio.TimeoutError:
-                        print("⚠️ 伺服器回應超時")
-                        continue
-                    except Exception as e:
-                        print(f"❌ 發送失敗: {e}")
+                except websockets.exceptions.ConnectionClosed as e:
+                    if e.rcvd is not None and e.rcvd.code == 1008:
+                        # 伺服器拒絕 (API Key 錯誤), 重連也不會成功
+                        print(f"❌ 伺服器拒絕連線: {e.rcvd.reason or 'API Key 是否正確?'}")
                         break
-                    
-                    # 控制 FPS (約 15 FPS)
-                    await asyncio.sleep(0.066)
-        
-        except websockets.exceptions.InvalidStatusCode as e:
-            print(f"❌ 連線失敗: {e}")
-            print("💡 請檢查:")
-            print("   1. API Key 是否正確")
-            print("   2. 伺服器是否正在運行")
-            print("   3. 網路連線是否正常")
+                    print(f"⚠️ 連線中斷: {e}")
+                
+                except (OSError, asyncio.TimeoutError) as e:
+                    print(f"⚠️ 無法連線到伺服器: {e}")
+                
+                if not self.is_running:
+                    break
+                
+                # 等待重連 (攝影機持續讀取, 暫存有動靜的影像)
+                delay = reconnect_delay(attempt, self.reconnect_max)
+                attempt += 1
+                print(f"⏳ {delay:.1f} 秒後重新連線 (第 {attempt} 次)")
+                await self.buffer_frames(delay)
         
         except Exception as e:
             print(f"❌ 錯誤: {e}")
@@ -165,14 +439,276 @@ class CameraClient:
         finally:
             self.stop()
     
+    async def stream_frames(self, websocket):
+        """連線中的上傳迴圈 (連線中斷時拋出例外)"""
+        frame_count = 0
+        
+        while self.is_running:
+            frame_start = time.monotonic()
+
+            # 讀取影像 (擷取執行緒提供的最新一幀)
+            frame = await asyncio.to_thread(self.read_frame)
+            if frame is None:
+                continue
+            
+            # 邊緣預篩選: 沒有動靜時不上傳 (定期送出保持連線的影像)
+            if not self.should_upload(frame):
+                await asyncio.sleep(max(0.0, 1.0 / self.max_fps - (time.monotonic() - frame_start)))
+                continue
+            
+            # 縮小並編碼影像
+            frame_base64 = self.encode_frame(self.resize_frame(frame))
+            
+            # 發送到伺服器
+            await websocket.send(json.dumps({
+                "type": "frame",
+                "data": frame_base64
+            }))
+            
+            frame_count += 1
+            self.quality.record(len(frame_base64))
+            
+            try:
+                # 接收伺服器回應
+                data = await self.receive_response(websocket)
+                
+                # 處理警報
+                self.handle_response(data)
+            except asyncio.TimeoutError:
+                print("⚠️ 伺服器回應超時")
+                continue
+            
+            # 顯示狀態 (每 30 幀顯示一次)
+            if frame_count % 30 == 0:
+                print(f"📊 已上傳 {frame_count} 幀影像 ({self.status_text()})")
+            
+            # 控制 FPS (依伺服器公告的最高幀率)
+            await asyncio.sleep(max(0.0, 1.0 / self.max_fps - (time.monotonic() - frame_start)))
+    
+    async def buffer_frames(self, seconds: float):
+        """斷線期間持續讀取攝影機, 有動靜的影像放入暫存 (保持 RTSP 串流不中斷)"""
+        deadline = time.monotonic() + seconds
+        interval = 1.0 / BUFFER_FPS
+        while self.is_running and time.monotonic() < deadline:
+            frame = await asyncio.to_thread(self.read_frame)
+            if frame is not None:
+                self.buffer_frame(frame)
+            await asyncio.sleep(max(0.0, min(interval, deadline - time.monotonic())))
+    
+    def buffer_frame(self, frame):
+        """暫存一幀斷線期間的影像 (啟用預篩選時只暫存有動靜的影像, 滿了丟棄最舊的)"""
+        if not self.buffer.maxlen:
+            return
+        if self.prefilter is not None:
+            self.prefilter.should_upload(frame)
+            if time.monotonic() >= self.prefilter.active_until:
+                return
+        if len(self.buffer) == self.buffer.maxlen:
+            self.buffer_dropped += 1
+        self.buffer.append((time.time(), self.encode_frame(self.resize_frame(frame))))
+    
+    async def send_buffered(self, websocket):
+        """重連後補送斷線期間暫存的影像"""
+        if not self.buffer:
+            return
+        print(f"📤 補送斷線期間暫存的 {len(self.buffer)} 幀影像"
+              + (f" (已丟棄 {self.buffer_dropped} 幀)" if self.buffer_dropped else ""))
+        while self.buffer and self.is_running:
+            captured_at, frame_base64 = self.buffer.popleft()
+            # 伺服器依拍攝時間記錄, 不當作即時畫面 (不觸發即時警報)
+            await websocket.send(json.dumps({
+                "type": "frame",
+                "data": frame_base64,
+                "buffered": True,
+                "captured_at": captured_at
+            }))
+            try:
+                self.handle_response(await self.receive_response(websocket))
+            except asyncio.TimeoutError:
+                print("⚠️ 伺服器回應超時")
+        self.buffer_dropped = 0
+    
+    def read_frame(self):
+        """取出最新一幀影像 (阻塞最多 READ_TIMEOUT 秒, 在執行緒中呼叫)"""
+        if self.grabber is None:
+            return None
+        return self.grabber.read()
+    
     def stop(self):
         """停止串流"""
         self.is_running = False
-        if self.cap is not None:
-            self.cap.release()
+        if self.grabber is not None:
+            self.grabber.stop()
         print("⏹️ 攝影機已停止")
 
 
+class GatewayClient:
+    """
+    邊緣閘道模式: 以一條 /ws/gateway 連線上傳多台攝影機
+
+    交握時送出所有攝影機的 API Key, 之後每幀標記 camera_id;
+    每台攝影機各自依伺服器公告的參數縮小、編碼與控制幀率。
+    """
+
+    def __init__(self, server_url: str, cameras: List[dict], **options):
+        """
+        Args:
+            cameras: [{"api_key": ..., "source": ..., "type": "rtsp"}, ...]
+            options: 每台攝影機的 CameraClient 參數 (max_size, target_kbps, prefilter...)
+        """
+        self.server_url = server_url
+        self.clients = [
+            CameraClient(server_url, cam["api_key"], str(cam["source"]), cam.get("type", "local"), **options)
+            for cam in cameras
+        ]
+        self.streams: Dict[int, CameraClient] = {}          # {camera_id: client}
+        self.responses: Dict[int, asyncio.Queue] = {}       # {camera_id: 偵測回應}
+        self.is_running = False
+
+    async def start_streaming(self):
+        """開啟所有攝影機並透過閘道連線上傳"""
+        clients = [client for client in self.clients if client.init_camera()]
+        if not clients:
+            print("❌ 沒有可用的攝影機")
+            return
+
+        ws_url = f"{self.server_url}/ws/gateway"
+        self.is_running = True
+        attempt = 0
+
+        try:
+            while self.is_running:
+                print(f"🔄 正在連線到伺服器: {ws_url} ({len(clients)} 台攝影機)")
+                try:
+                    async with websockets.connect(ws_url) as websocket:
+                        if not await self._handshake(websocket, clients):
+                            break
+                        attempt = 0
+                        await self._run_session(websocket)
+
+                except websockets.exceptions.InvalidStatusCode as e:
+                    print(f"❌ 連線失敗: {e}")
+
+                except websockets.exceptions.ConnectionClosed as e:
+                    if e.rcvd is not None and e.rcvd.code == 1008:
+                        print(f"❌ 伺服器拒絕連線: {e.rcvd.reason}")
+                        break
+                    print(f"⚠️ 連線中斷: {e}")
+
+                except ConnectionError as e:
+                    print(f"⚠️ 連線中斷: {e}")
+
+                except (OSError, asyncio.TimeoutError) as e:
+                    print(f"⚠️ 無法連線到伺服器: {e}")
+
+                if not self.is_running:
+                    break
+
+                # 攝影機保持開啟, 等待後以同一組 API Key 重新交握
+                delay = reconnect_delay(attempt, clients[0].reconnect_max)
+                attempt += 1
+                print(f"⏳ {delay:.1f} 秒後重新連線 (第 {attempt} 次)")
+                await asyncio.sleep(delay)
+
+        except Exception as e:
+            print(f"❌ 錯誤: {e}")
+
+        finally:
+            self.stop()
+
+    async def _handshake(self, websocket, clients: List[CameraClient]) -> bool:
+        """送出 hello 並依 ready 訊息對應 camera_id (重連時重新對應)"""
+        await websocket.send(json.dumps({
+            "type": "hello",
+            "protocol_version": PROTOCOL_VERSION,
+            "api_keys": [client.api_key for client in clients]
+        }))
+        ready = json.loads(await asyncio.wait_for(websocket.recv(), timeout=10.0))
+        if ready.get("type") != "ready":
+            print(f"❌ 交握失敗: {ready}")
+            return False
+
+        by_key = {client.api_key: client for client in clients}
+        self.streams.clear()
+        self.responses.clear()
+        for api_key, camera_id in ready.get("cameras", {}).items():
+            self.streams[camera_id] = by_key[api_key]
+            self.responses[camera_id] = asyncio.Queue()
+        for api_key in ready.get("rejected", []):
+            print(f"⚠️ API Key 無效, 略過攝影機: {str(api_key)[:8]}...")
+        print(f"✅ 已連線到伺服器 ({len(self.streams)} 台攝影機)")
+        return bool(self.streams)
+
+    async def _run_session(self, websocket):
+        """一條閘道連線的收送工作 (任一工作結束即結束連線)"""
+        receiver = asyncio.create_task(self._receive(websocket))
+        senders = [
+            asyncio.create_task(self._send_camera(websocket, camera_id, client))
+            for camera_id, client in self.streams.items()
+        ]
+        try:
+            done, pending = await asyncio.wait([receiver, *senders], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in [receiver, *senders]:
+                task.cancel()
+        for task in done:
+            if task.exception():
+                raise task.exception()
+
+    async def _receive(self, websocket):
+        """分送伺服器訊息給各攝影機"""
+        async for message in websocket:
+            data = json.loads(message)
+            client = self.streams.get(data.get("camera_id"))
+            if client is None:
+                if data.get("type") == "error":
+                    print(f"⚠️ 伺服器錯誤: {data.get('message')}")
+                continue
+            if data.get("type") == "config":
+                client.apply_config(data.get("data", {}))
+            elif data.get("type") == "alert":
+                client.handle_response(data)
+            else:
+                self.responses[data["camera_id"]].put_nowait(data)
+        raise ConnectionError("伺服器已關閉連線")
+
+    async def _send_camera(self, websocket, camera_id: int, client: CameraClient):
+        """單一攝影機的上傳迴圈 (等到上一幀的回應才送下一幀)"""
+        frame_count = 0
+        responses = self.responses[camera_id]
+        while self.is_running:
+            frame_start = time.monotonic()
+            frame_base64 = await asyncio.to_thread(client.next_encoded_frame)
+            if frame_base64 is None:
+                # 讀取失敗或被預篩選略過
+                await asyncio.sleep(max(0.0, 1.0 / client.max_fps - (time.monotonic() - frame_start)))
+                continue
+
+            await websocket.send(json.dumps({
+                "type": "frame",
+                "camera_id": camera_id,
+                "data": frame_base64
+            }))
+            frame_count += 1
+            client.quality.record(len(frame_base64))
+
+            try:
+                await asyncio.wait_for(responses.get(), timeout=1.0)
+            except asyncio.TimeoutError:
+                print(f"⚠️ 伺服器回應超時 [Camera {camera_id}]")
+
+            if frame_count % 30 == 0:
+                print(f"📊 [Camera {camera_id}] 已上傳 {frame_count} 幀影像 ({client.status_text()})")
+
+            await asyncio.sleep(max(0.0, 1.0 / client.max_fps - (time.monotonic() - frame_start)))
+
+    def stop(self):
+        """停止所有攝影機"""
+        self.is_running = False
+        for client in self.clients:
+            client.stop()
+
+
 def main():
     """主程式"""
     parser = argparse.ArgumentParser(description='吸菸監控系統 - 攝影機客戶端')
@@ -187,8 +723,14 @@ def main():
     parser.add_argument(
         '--api-key',
         type=str,
-        required=True,
-        help='攝影機 API Key (必填)'
+        help='攝影機 API Key (單一攝影機模式必填)'
+    )
+    
+    parser.add_argument(
+        '--gateway',
+        type=str,
+        help='閘道模式: 攝影機清單 JSON 檔 [{"api_key": ..., "source": ..., "type": ...}, ...],\n'
+             '所有攝影機共用一條連線上傳'
     )
     
     parser.add_argument(
@@ -209,8 +751,64 @@ def main():
         help='攝影機類型 (預設: local)'
     )
     
+    parser.add_argument(
+        '--max-size',
+        type=int,
+        default=0,
+        help='上傳影像長邊上限 (預設: 0 = 使用伺服器公告的模型輸入尺寸)'
+    )
+    
+    parser.add_argument(
+        '--target-kbps',
+        type=float,
+        default=1500,
+        help='目標上傳位元率 kbps, 依此調整 JPEG 品質 (預設: 1500, 0 = 固定品質)'
+    )
+    
+    parser.add_argument(
+        '--prefilter',
+        type=str,
+        choices=['off', 'motion', 'person'],
+        default='off',
+        help='邊緣預篩選: 只在有動靜 / 偵測到人時上傳 (預設: off)'
+    )
+    
+    parser.add_argument(
+        '--keepalive',
+        type=float,
+        default=5.0,
+        help='預篩選時沒有動靜的上傳間隔秒數 (預設: 5)'
+    )
+    
+    parser.add_argument(
+        '--prefilter-hold',
+        type=float,
+        default=3.0,
+        help='預篩選觸發後持續上傳的秒數 (預設: 3)'
+    )
+    
+    parser.add_argument(
+        '--buffer-frames',
+        type=int,
+        default=30,
+        help='斷線期間暫存的影像數, 重連後補送 (啟用 --prefilter 時只暫存有動靜的影像, 預設: 30)'
+    )
+    
+    parser.add_argument(
+        '--reconnect-max',
+        type=float,
+        default=30.0,
+        help='重新連線等待秒數上限 (預設: 30)'
+    )
+    
     args = parser.parse_args()
     
+    if args.gateway:
+        run_gateway(args)
+        return
+    if not args.api_key:
+        parser.error("需要 --api-key (或使用 --gateway)")
+    
     print("=" * 60)
     print("🎥 吸菸監控系統 - 攝影機客戶端")
     print("=" * 60)
@@ -225,7 +823,8 @@ def main():
         server_url=args.server,
         api_key=args.api_key,
         camera_source=args.source,
-        camera_type=args.type
+        camera_type=args.type,
+        **client_options(args)
     )
     
     # 開始串流
@@ -236,6 +835,45 @@ def main():
         client.stop()
 
 
+def client_options(args) -> dict:
+    """命令列參數 → CameraClient 參數"""
+    return {
+        "max_size": args.max_size,
+        "target_kbps": args.target_kbps,
+        "prefilter": args.prefilter,
+        "keepalive": args.keepalive,
+        "prefilter_hold": args.prefilter_hold,
+        "buffer_frames": args.buffer_frames,
+        "reconnect_max": args.reconnect_max,
+    }
+
+
+def run_gateway(args):
+    """閘道模式主程式"""
+    with open(args.gateway, encoding='utf-8') as f:
+        cameras = json.load(f)
+    
+    print("=" * 60)
+    print("🎥 吸菸監控系統 - 邊緣閘道")
+    print("=" * 60)
+    print(f"伺服器: {args.server}")
+    for cam in cameras:
+        print(f"  [{cam.get('type', 'local')}] {cam['source']} (API Key: {cam['api_key'][:8]}...)")
+    print("=" * 60)
+    
+    gateway = GatewayClient(
+        server_url=args.server,
+        cameras=cameras,
+        **client_options(args)
+    )
+    
+    try:
+        asyncio.run(gateway.start_streaming())
+    except KeyboardInterrupt:
+        print("\n⏹️ 使用者中斷")
+        gateway.stop()
+
+
 if __name__ == "__main__":
     # 使用範例:
     # 
@@ -247,5 +885,8 @@ if __name__ == "__main__":
     # 
     # 3. 本地攝影機:
     #    python camera_client.py --api-key YOUR_API_KEY --type local --source 0
+    # 
+    # 4. 邊緣閘道 (多台攝影機共用一條連線):
+    #    python camera_client.py --gateway cameras.json
     
     main()
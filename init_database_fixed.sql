@@ -54,6 +54,7 @@ CREATE TABLE IF NOT EXISTS detections (
     is_smoking BOOLEAN DEFAULT FALSE,
     confidence FLOAT,
     screenshot_path VARCHAR(500),
+    clip_path VARCHAR(500),
     detection_details TEXT,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
@@ -0,0 +1,88 @@
+"""
+即時警報推送 (Server-Sent Events)
+
+save_detection 寫入偵測記錄後, 將新記錄與統計數字的增量推送給該用戶所有開啟中的
+儀表板, 取代每 60 秒輪詢 /api/statistics、/api/detections、/api/detections/trend。
+
+多個 worker 時設定 relay (state_store.publish 的 alerts 頻道): 事件先送到共用頻道,
+每個 worker 收到後再推送給連在自己身上的儀表板 (deliver)。
+"""
+
+import asyncio
+import json
+from typing import Callable, Dict, Optional, Set
+
+from server.config import ALERT_STREAM_QUEUE_SIZE
+
+
+class AlertSubscriber:
+    """單一儀表板連線 (佇列滿時丟棄最舊事件)"""
+
+    def __init__(self, max_queue: int = ALERT_STREAM_QUEUE_SIZE):
+        self.queue: "asyncio.Queue[str]" = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+
+    def offer(self, message: str):
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait(message)
+
+
+class AlertBroker:
+    """依用戶分送警報事件"""
+
+    def __init__(self):
+        self.subscribers: Dict[int, Set[AlertSubscriber]] = {}  # {user_id: {subscriber, ...}}
+        self.relay: Optional[Callable[[dict], bool]] = None      # 跨 worker 轉送 (回傳 False 時本地推送)
+
+    def subscribe(self, user_id: int) -> AlertSubscriber:
+        subscriber = AlertSubscriber()
+        self.subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, user_id: int, subscriber: AlertSubscriber):
+        subscribers = self.subscribers.get(user_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self.subscribers[user_id]
+
+    def publish(self, user_id: int, event: str, data: dict):
+        """推送事件給該用戶所有連線 (多個 worker 時經由 relay 轉送)"""
+        if self.relay is not None and self.relay({"user_id": user_id, "event": event, "data": data}):
+            return
+        self.deliver_local(user_id, event, data)
+
+    def deliver(self, message: dict):
+        """推送其他 worker 轉送來的事件"""
+        self.deliver_local(message["user_id"], message["event"], message["data"])
+
+    def deliver_local(self, user_id: int, event: str, data: dict):
+        """推送事件給本進程中該用戶的連線 (沒有連線時不做任何事)"""
+        subscribers = self.subscribers.get(user_id)
+        if not subscribers:
+            return
+        message = format_sse(event, data)
+        for subscriber in list(subscribers):
+            subscriber.offer(message)
+
+    def get_stats(self) -> Dict:
+        return {
+            "users": len(self.subscribers),
+            "connections": sum(len(s) for s in self.subscribers.values()),
+        }
+
+
+def format_sse(event: str, data: dict) -> str:
+    """組成 SSE 訊息"""
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+# 建立全域實例
+alert_broker = AlertBroker()
@@ -1,13 +1,17 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from server.database import get_db, User
-from server.config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from sqlalchemy import select, event, inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, object_session
+from server.database import get_async_db, User
+from server.config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, USER_CACHE_TTL
+from server.state_store import state_store
 import secrets
+import time
 
 # 密碼加密
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -54,11 +58,84 @@ def decode_token(token: str) -> dict:
         return None
 
 
+# ==================== 用戶快取 ====================
+
+# 避免每個受保護的 API 都查一次 users 表。
+# 經由 ORM commit 的異動立即清除 (多個 worker 時經由 state_store 的 control 頻道通知其他 worker);
+# 直接以 SQL 修改 users 表時, 最遲 USER_CACHE_TTL 秒後才會讀到新資料
+_user_cache: Dict[str, Tuple[User, float]] = {}  # {username: (user, 到期時間)}
+
+
+def get_cached_user(username: str) -> Optional[User]:
+    """從快取取得用戶 (過期則回傳 None)"""
+    entry = _user_cache.get(username)
+    if entry is None:
+        return None
+    user, expire_at = entry
+    if time.monotonic() >= expire_at:
+        _user_cache.pop(username, None)
+        return None
+    return user
+
+
+def cache_user(user: User):
+    """將用戶放入快取 (需為已載入欄位的物件)"""
+    if USER_CACHE_TTL <= 0:
+        return
+    _user_cache[user.username] = (user, time.monotonic() + USER_CACHE_TTL)
+
+
+def invalidate_user_cache(username: Optional[str] = None):
+    """清除用戶快取 (未指定 username 則全部清除)"""
+    if username is None:
+        _user_cache.clear()
+    else:
+        _user_cache.pop(username, None)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_on_user_change(mapper, connection, target):
+    """
+    用戶資料異動: 記錄要清除的 username (含改名前的舊 username), commit 後才清除
+
+    flush 時就清除的話, commit 前其他請求會重新讀到舊資料並放回快取
+    """
+    usernames = {target.username, *(inspect(target).attrs.username.history.deleted or ())}
+    session = object_session(target)
+    if session is None:
+        for username in usernames:
+            invalidate_user_cache(username)
+        return
+    session.info.setdefault("invalidate_users", set()).update(usernames)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    """commit 後清除本進程的快取, 並通知其他 worker"""
+    usernames = session.info.pop("invalidate_users", None)
+    if not usernames:
+        return
+    for username in usernames:
+        invalidate_user_cache(username)
+    if state_store.shared:
+        try:
+            state_store.publish("control", {"type": "user_updated", "usernames": sorted(usernames)})
+        except RuntimeError:
+            # 沒有執行中的事件迴圈 (同步工具程式): 其他 worker 最遲 USER_CACHE_TTL 秒後重新讀取
+            pass
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_invalidations(session):
+    session.info.pop("invalidate_users", None)
+
+
 # ==================== 用戶認證 ====================
 
-def authenticate_user(db: Session, username: str, password: str):
+async def authenticate_user(db: AsyncSession, username: str, password: str):
     """驗證用戶登入"""
-    user = db.query(User).filter(User.username == username).first()
+    user = await db.scalar(select(User).filter(User.username == username))
     if not user:
         return False
     if not verify_password(password, user.hashed_password):
@@ -66,11 +143,16 @@ def authenticate_user(db: Session, username: str, password: str):
     return user
 
 
-def get_current_user(
+async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> User:
     """取得當前登入用戶 (用於 API 路由保護)"""
+    return await get_user_from_token(credentials.credentials, db)
+
+
+async def get_user_from_token(token: str, db: AsyncSession) -> User:
+    """由 JWT Token 取得用戶 (WebSocket / MJPEG 等無法帶 Authorization 標頭時使用)"""
     
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -78,7 +160,6 @@ def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    token = credentials.credentials
     payload = decode_token(token)
     
     if payload is None:
@@ -88,9 +169,14 @@ def get_current_user(
     if username is None:
         raise credentials_exception
     
-    user = db.query(User).filter(User.username == username).first()
+    user = get_cached_user(username)
     if user is None:
-        raise credentials_exception
+        user = await db.scalar(select(User).filter(User.username == username))
+        if user is None:
+            raise credentials_exception
+        # 從 session 分離後放入快取, 之後的請求不需再查詢
+        db.expunge(user)
+        cache_user(user)
     
     if not user.is_active:
         raise HTTPException(status_code=400, detail="用戶已被停用")
@@ -112,16 +198,22 @@ def generate_camera_api_key() -> str:
     return secrets.token_urlsafe(32)
 
 
-def verify_camera_api_key(api_key: str, db: Session):
-    """驗證攝影機 API Key"""
+async def verify_camera_api_key(api_key: str, db: AsyncSession):
+    """驗證攝影機 API Key, 回傳攝影機設定快照 (CameraConfig)"""
     from server.database import Camera
-    camera = db.query(Camera).filter(Camera.api_key == api_key).first()
+    from server.camera_cache import camera_cache
+
+    config = camera_cache.get(api_key)
+    if config is not None:
+        return config
+
+    camera = await db.scalar(select(Camera).filter(Camera.api_key == api_key))
     if not camera:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="無效的攝影機 API Key"
         )
-    return camera
+    return camera_cache.put(camera)
 
 
 # ==================== Pydantic 模型 (用於 API) ====================
@@ -0,0 +1,20 @@
+"""
+重連 / 重啟退避時間
+
+指數退避加上隨機抖動, 避免大量攝影機在網路恢復時同一時間重連。
+"""
+
+import random
+
+from server.config import RTSP_RESTART_BASE_DELAY, RTSP_RESTART_MAX_DELAY
+
+
+def backoff_delay(attempt: int, base: float = RTSP_RESTART_BASE_DELAY,
+                  max_delay: float = RTSP_RESTART_MAX_DELAY) -> float:
+    """
+    第 attempt 次 (從 0 起算) 重試前的等待秒數
+
+    上限為 base * 2^attempt (不超過 max_delay), 實際等待取其一半到全部之間的隨機值
+    """
+    delay = min(max_delay, base * (2 ** min(attempt, 16)))
+    return random.uniform(delay / 2, delay)
@@ -0,0 +1,137 @@
+"""
+攝影機設定快取
+
+攝影機以不綁定 session 的不可變快照 (CameraConfig) 傳遞, 每幀偵測不需查詢資料庫:
+
+- API Key 快取: 攝影機重連時不必反覆查詢 cameras 表, CAMERA_CACHE_TTL 秒後過期
+- 即時設定登錄表: 連線中的攝影機每幀讀取最新快照, 設定變更 (包含其他 worker 轉送的
+  camera_updated 事件) 直接替換快照, 下一幀即生效
+"""
+
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from server.config import CAMERA_CACHE_TTL
+
+
+@dataclass(frozen=True)
+class CameraConfig:
+    """攝影機設定快照 (不綁定 session, 可在每幀偵測時直接讀取)"""
+    id: int
+    user_id: int
+    camera_name: str
+    camera_type: str
+    camera_source: str
+    location: Optional[str]
+    api_key: str
+    is_active: bool
+    confidence_threshold: float
+    iou_threshold: float
+    enable_alert: bool
+    enable_screenshot: bool
+    draw_bbox: bool
+    detect_mode: str
+
+    @classmethod
+    def from_camera(cls, camera) -> "CameraConfig":
+        """由 Camera ORM 物件建立快照"""
+        return cls(
+            id=camera.id,
+            user_id=camera.user_id,
+            camera_name=camera.camera_name,
+            camera_type=camera.camera_type,
+            camera_source=camera.camera_source,
+            location=camera.location,
+            api_key=camera.api_key,
+            is_active=bool(camera.is_active),
+            confidence_threshold=camera.confidence_threshold,
+            iou_threshold=camera.iou_threshold,
+            enable_alert=bool(camera.enable_alert),
+            enable_screenshot=bool(camera.enable_screenshot),
+            draw_bbox=bool(camera.draw_bbox),
+            detect_mode=camera.detect_mode,
+        )
+
+
+class CameraConfigCache:
+    """
+    攝影機設定快取與即時設定登錄表
+
+    - API Key → 設定: 避免攝影機重連時反覆查詢 cameras 表
+    - 攝影機 ID → 設定: 連線中的攝影機每幀讀取, update_camera 直接推送新快照,
+      不需重新連線即可套用; 快照不可變, 只做整個物件替換, 讀取端不需加鎖
+    """
+
+    def __init__(self, ttl: int = CAMERA_CACHE_TTL):
+        self.ttl = ttl
+        self._by_key: Dict[str, Tuple[CameraConfig, float]] = {}  # {api_key: (config, 到期時間)}
+        self._live: Dict[int, CameraConfig] = {}  # {camera_id: config} 連線中的攝影機
+        self._live_refs: Dict[int, int] = {}  # {camera_id: 連線數}
+
+    def get(self, api_key: str) -> Optional[CameraConfig]:
+        """取得快取的攝影機設定 (過期則回傳 None)"""
+        entry = self._by_key.get(api_key)
+        if entry is None:
+            return None
+        config, expire_at = entry
+        if time.monotonic() >= expire_at:
+            self._by_key.pop(api_key, None)
+            return None
+        return config
+
+    def put(self, camera) -> CameraConfig:
+        """由 Camera ORM 物件建立快照並放入快取"""
+        config = CameraConfig.from_camera(camera)
+        if self.ttl > 0 and config.api_key:
+            self._by_key[config.api_key] = (config, time.monotonic() + self.ttl)
+        return config
+
+    def update(self, camera) -> CameraConfig:
+        """攝影機設定變更時推送新快照 (連線中的攝影機下一幀即套用)"""
+        return self.apply(CameraConfig.from_camera(camera))
+
+    def apply(self, config: CameraConfig) -> CameraConfig:
+        """套用設定快照 (例如其他 worker 轉送的設定變更)"""
+        if self.ttl > 0 and config.api_key:
+            self._by_key[config.api_key] = (config, time.monotonic() + self.ttl)
+        if config.id in self._live:
+            self._live[config.id] = config
+        return config
+
+    def invalidate(self, api_key: Optional[str] = None, camera_id: Optional[int] = None):
+        """清除快取 (未指定 api_key 則全部清除); 指定 camera_id 時一併移出登錄表"""
+        if api_key is None:
+            self._by_key.clear()
+        else:
+            self._by_key.pop(api_key, None)
+        if camera_id is not None:
+            self._live.pop(camera_id, None)
+            self._live_refs.pop(camera_id, None)
+
+    # ---------- 連線中攝影機登錄表 ----------
+
+    def register(self, config: CameraConfig) -> bool:
+        """攝影機連線時登錄 (同一攝影機可有多條連線), 第一條連線回傳 True"""
+        self._live.setdefault(config.id, config)
+        refs = self._live_refs.get(config.id, 0) + 1
+        self._live_refs[config.id] = refs
+        return refs == 1
+
+    def unregister(self, camera_id: int) -> bool:
+        """攝影機斷線時移除 (最後一條連線斷開才移除), 最後一條連線回傳 True"""
+        refs = self._live_refs.get(camera_id, 0) - 1
+        if refs > 0:
+            self._live_refs[camera_id] = refs
+            return False
+        was_live = self._live_refs.pop(camera_id, None) is not None
+        self._live.pop(camera_id, None)
+        return was_live
+
+    def get_live(self, camera_id: int) -> Optional[CameraConfig]:
+        """取得連線中攝影機的最新設定 (每幀呼叫, 只做 dict 查詢)"""
+        return self._live.get(camera_id)
+
+
+# 建立全域實例
+camera_cache = CameraConfigCache()
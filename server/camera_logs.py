@@ -0,0 +1,102 @@
+"""
+攝影機客戶端日誌
+
+每台攝影機一個日誌檔 logs/camera_{camera_id}.log, 超過 CAMERA_LOG_MAX_MB 時輪替為
+camera_{camera_id}.log.1 ~ .{CAMERA_LOG_BACKUPS}, 最舊的自動刪除, 總大小有上限。
+
+子進程的輸出經由管線逐行寫入 (重啟時附加, 不會清掉異常結束前的輸出);
+內建擷取引擎也寫入同一個檔案。tail_log 只讀取檔案最後 N 位元組。
+"""
+
+import logging
+import os
+import threading
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import IO, Dict
+
+from server.config import CAMERA_LOG_DIR, CAMERA_LOG_MAX_MB, CAMERA_LOG_BACKUPS
+
+_loggers: Dict[int, logging.Logger] = {}
+_lock = threading.Lock()
+
+
+def log_path(camera_id: int) -> Path:
+    return CAMERA_LOG_DIR / f"camera_{camera_id}.log"
+
+
+def get_camera_logger(camera_id: int) -> logging.Logger:
+    """取得攝影機的日誌 (第一次使用時建立輪替檔案)"""
+    with _lock:
+        logger = _loggers.get(camera_id)
+        if logger is None:
+            CAMERA_LOG_DIR.mkdir(parents=True, exist_ok=True)
+            handler = RotatingFileHandler(
+                log_path(camera_id),
+                maxBytes=int(CAMERA_LOG_MAX_MB * 1024 * 1024),
+                backupCount=CAMERA_LOG_BACKUPS,
+                encoding="utf-8",
+                delay=True
+            )
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            logger = logging.getLogger(f"camera_client.{camera_id}")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            _loggers[camera_id] = logger
+        return logger
+
+
+def close_camera_log(camera_id: int):
+    """關閉攝影機日誌檔"""
+    with _lock:
+        logger = _loggers.pop(camera_id, None)
+    if logger is None:
+        return
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def pump_output(camera_id: int, stream: IO[bytes]) -> threading.Thread:
+    """在背景執行緒逐行將子進程輸出寫入日誌, 讀到 EOF (進程結束) 時停止"""
+    logger = get_camera_logger(camera_id)
+
+    def run():
+        with stream:
+            for line in iter(stream.readline, b""):
+                logger.info(line.decode("utf-8", errors="replace").rstrip())
+
+    thread = threading.Thread(target=run, name=f"camera-log-{camera_id}", daemon=True)
+    thread.start()
+    return thread
+
+
+def tail_log(camera_id: int, max_bytes: int = 16 * 1024) -> str:
+    """
+    讀取日誌最後 max_bytes 位元組 (目前檔案不足時接上前一個輪替檔)
+
+    只 seek 到檔尾讀取, 不讀整個檔案; 第一行不完整時捨去。
+    """
+    chunks = []
+    remaining = max_bytes
+    for path in (log_path(camera_id), Path(f"{log_path(camera_id)}.1")):
+        if remaining <= 0:
+            break
+        try:
+            with open(path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                start = max(0, size - remaining)
+                f.seek(start)
+                chunks.insert(0, f.read())
+                remaining -= size - start
+                if start > 0:
+                    break
+        except OSError:
+            continue
+
+    data = b"".join(chunks)
+    if remaining <= 0 and b"\n" in data:
+        data = data[data.index(b"\n") + 1:]
+    return data.decode("utf-8", errors="replace")
@@ -0,0 +1,302 @@
+"""
+吸菸事件前後影片片段
+
+每台攝影機在記憶體中保留最近幾秒的 JPEG 影格 (客戶端上傳的原始 JPEG, 不重新編碼)。
+穩定吸菸事件觸發時, 取出事件前 CLIP_PRE_SECONDS 秒的影格, 再繼續收集
+CLIP_POST_SECONDS 秒, 直接封裝成 MJPEG AVI 寫入磁碟。
+
+記憶體上限:
+- 每台攝影機: CLIP_PRE_SECONDS 秒且不超過 CLIP_BUFFER_MAX_MB
+- 全部攝影機: CLIP_TOTAL_BUFFER_MB (包含收集中與等待寫入的片段), 超過時從佔用最多的
+  攝影機丟棄最舊影格; 緩衝區已清空仍超過時, 收集中的片段以現有影格提早結束
+
+片段由 CLIP_WRITER_THREADS 條背景執行緒依序寫入, 關閉時寫完所有片段
+(偵測記錄已指向片段路徑)。
+"""
+
+import os
+import queue
+import struct
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+from server.config import (
+    CLIP_ENABLED, CLIP_PRE_SECONDS, CLIP_POST_SECONDS,
+    CLIP_BUFFER_MAX_MB, CLIP_TOTAL_BUFFER_MB, CLIP_WRITER_THREADS
+)
+from server.jpeg_header import jpeg_size
+
+Frame = Tuple[float, bytes]  # (時間戳, JPEG 資料)
+
+
+# ==================== MJPEG AVI 封裝 ====================
+
+def _chunk(fourcc: bytes, payload: bytes) -> bytes:
+    data = fourcc + struct.pack("<I", len(payload)) + payload
+    return data + b"\0" if len(payload) % 2 else data
+
+
+def _list(list_type: bytes, payload: bytes) -> bytes:
+    return b"LIST" + struct.pack("<I", len(payload) + 4) + list_type + payload
+
+
+def write_mjpeg_avi(filepath: Path, frames: List[bytes], fps: float):
+    """將 JPEG 影格直接封裝成 MJPEG AVI (不重新編碼)"""
+    if not frames:
+        raise ValueError("沒有影格")
+    width, height = jpeg_size(frames[0])
+    fps = max(1, round(fps))
+    max_frame = max(len(f) for f in frames)
+
+    avih = struct.pack(
+        "<IIIIIIIIII16x",
+        int(1_000_000 / fps),           # dwMicroSecPerFrame
+        max_frame * fps,                # dwMaxBytesPerSec
+        0,                              # dwPaddingGranularity
+        0x10,                           # dwFlags: AVIF_HASINDEX
+        len(frames),                    # dwTotalFrames
+        0,                              # dwInitialFrames
+        1,                              # dwStreams
+        max_frame,                      # dwSuggestedBufferSize
+        width, height
+    )
+    strh = struct.pack(
+        "<4s4sIHHIIIIIIIIhhhh",
+        b"vids", b"MJPG",
+        0, 0, 0, 0,                     # dwFlags, wPriority, wLanguage, dwInitialFrames
+        1, fps,                         # dwScale, dwRate
+        0, len(frames),                 # dwStart, dwLength
+        max_frame, 0xFFFFFFFF, 0,       # dwSuggestedBufferSize, dwQuality, dwSampleSize
+        0, 0, width, height             # rcFrame
+    )
+    strf = struct.pack(
+        "<IiiHH4sIiiII",
+        40, width, height, 1, 24, b"MJPG", width * height * 3, 0, 0, 0, 0
+    )
+    hdrl = _list(b"hdrl", _chunk(b"avih", avih) + _list(b"strl", _chunk(b"strh", strh) + _chunk(b"strf", strf)))
+
+    movi_chunks = []
+    index = []
+    offset = 4  # idx1 的位移以 'movi' 標記為起點
+    for frame in frames:
+        chunk = _chunk(b"00dc", frame)
+        index.append(struct.pack("<4sIII", b"00dc", 0x10, offset, len(frame)))
+        movi_chunks.append(chunk)
+        offset += len(chunk)
+    movi = _list(b"movi", b"".join(movi_chunks))
+    idx1 = _chunk(b"idx1", b"".join(index))
+
+    body = b"AVI " + hdrl + movi + idx1
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = filepath.with_name(filepath.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(b"RIFF" + struct.pack("<I", len(body)) + body)
+    os.replace(tmp_path, filepath)
+
+
+# ==================== 環狀緩衝區 ====================
+
+class FrameRingBuffer:
+    """單一攝影機最近影格的環狀緩衝區 (依秒數與位元組數限制)"""
+
+    def __init__(self, max_seconds: float, max_bytes: int):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.frames: Deque[Frame] = deque()
+        self.nbytes = 0
+
+    def append(self, ts: float, data: bytes) -> int:
+        """加入影格, 回傳因超出限制而釋放的位元組數"""
+        self.frames.append((ts, data))
+        self.nbytes += len(data)
+        freed = 0
+        while self.frames and (self.nbytes > self.max_bytes or ts - self.frames[0][0] > self.max_seconds):
+            freed += self.pop_oldest()
+        return freed
+
+    def pop_oldest(self) -> int:
+        _, data = self.frames.popleft()
+        self.nbytes -= len(data)
+        return len(data)
+
+    def since(self, ts: float) -> List[Frame]:
+        return [f for f in self.frames if f[0] >= ts]
+
+
+class _PendingClip:
+    """事件觸發後等待收集事件後影格的片段"""
+
+    def __init__(self, filepath: Path, frames: List[Frame], end_ts: float):
+        self.filepath = filepath
+        self.frames = frames
+        self.end_ts = end_ts
+        self.nbytes = sum(len(data) for _, data in frames)
+
+    def append(self, ts: float, data: bytes):
+        self.frames.append((ts, data))
+        self.nbytes += len(data)
+
+
+class ClipRecorder:
+    """管理所有攝影機的緩衝區與事件片段寫入"""
+
+    def __init__(self, pre_seconds: float = CLIP_PRE_SECONDS, post_seconds: float = CLIP_POST_SECONDS,
+                 camera_max_bytes: int = CLIP_BUFFER_MAX_MB * 1024 * 1024,
+                 total_max_bytes: int = CLIP_TOTAL_BUFFER_MB * 1024 * 1024, enabled: bool = CLIP_ENABLED,
+                 threads: int = CLIP_WRITER_THREADS):
+        self.enabled = enabled
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.camera_max_bytes = camera_max_bytes
+        self.total_max_bytes = total_max_bytes
+        self.threads = max(1, threads)
+        self.buffers: Dict[int, FrameRingBuffer] = {}
+        self.pending: Dict[int, List[_PendingClip]] = {}
+        self.total_bytes = 0    # 環狀緩衝區
+        self.pending_bytes = 0  # 收集中與等待寫入的片段 (寫入執行緒寫完才扣除)
+        self.stats = {"clips_written": 0, "clips_failed": 0, "clips_truncated": 0, "frames_evicted": 0}
+        self._queue: "queue.Queue[Optional[_PendingClip]]" = queue.Queue()
+        self._workers: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def add_frame(self, camera_id: int, data: bytes, ts: Optional[float] = None):
+        """加入一張已編碼的 JPEG 影格 (每幀呼叫)"""
+        if not self.enabled:
+            return
+        ts = ts if ts is not None else time.time()
+        buffer = self.buffers.get(camera_id)
+        if buffer is None:
+            buffer = self.buffers[camera_id] = FrameRingBuffer(self.pre_seconds, self.camera_max_bytes)
+        self.total_bytes += len(data)
+        self.total_bytes -= buffer.append(ts, data)
+
+        pending = self.pending.get(camera_id)
+        if pending:
+            for clip in list(pending):
+                clip.append(ts, data)
+                self._add_pending_bytes(len(data))
+                if ts >= clip.end_ts:
+                    pending.remove(clip)
+                    self._write_async(clip)
+        self._enforce_total_budget()
+
+    def trigger(self, camera_id: int, filepath: Path) -> bool:
+        """吸菸事件觸發: 取出事件前影格並開始收集事件後影格"""
+        buffer = self.buffers.get(camera_id)
+        if not self.enabled or buffer is None or not buffer.frames:
+            return False
+        now = buffer.frames[-1][0]
+        clip = _PendingClip(filepath, buffer.since(now - self.pre_seconds), now + self.post_seconds)
+        self.pending.setdefault(camera_id, []).append(clip)
+        self._add_pending_bytes(clip.nbytes)
+        self._enforce_total_budget()
+        return True
+
+    def remove(self, camera_id: int):
+        """攝影機斷線: 以現有影格完成未結束的片段並釋放緩衝區"""
+        for clip in self.pending.pop(camera_id, []):
+            self._write_async(clip)
+        buffer = self.buffers.pop(camera_id, None)
+        if buffer is not None:
+            self.total_bytes -= buffer.nbytes
+
+    def flush(self):
+        """以現有影格完成所有未結束的片段 (關閉前呼叫)"""
+        for camera_id in list(self.pending):
+            for clip in self.pending.pop(camera_id):
+                self._write_async(clip)
+
+    def stop(self, timeout: float = 30.0):
+        """寫完佇列中的片段後停止寫入執行緒"""
+        with self._lock:
+            workers = self._workers
+            self._workers = []
+        for _ in workers:
+            self._queue.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.stats)
+            pending_bytes = self.pending_bytes
+        return {
+            **stats,
+            "enabled": self.enabled,
+            "cameras": len(self.buffers),
+            "buffered_mb": round(self.total_bytes / 1024 / 1024, 2),
+            "pending_mb": round(pending_bytes / 1024 / 1024, 2),
+            "budget_mb": round(self.total_max_bytes / 1024 / 1024, 2),
+            "pending_clips": sum(len(p) for p in self.pending.values()),
+            "write_queue": self._queue.qsize(),
+        }
+
+    def _add_pending_bytes(self, nbytes: int):
+        with self._lock:
+            self.pending_bytes += nbytes
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _enforce_total_budget(self):
+        """總記憶體超過上限時, 從佔用最多的攝影機丟棄最舊影格; 緩衝區都已清空則提早結束收集中的片段"""
+        while self.total_bytes + self.pending_bytes > self.total_max_bytes:
+            largest = max(self.buffers.values(), key=lambda b: b.nbytes, default=None)
+            if largest is None or not largest.frames:
+                self._truncate_pending()
+                break
+            self.total_bytes -= largest.pop_oldest()
+            self._count("frames_evicted")
+
+    def _truncate_pending(self):
+        """片段不再收集事件後影格, 以現有影格寫入 (等待寫入期間仍計入上限)"""
+        for camera_id in list(self.pending):
+            for clip in self.pending.pop(camera_id):
+                self._count("clips_truncated")
+                self._write_async(clip)
+
+    def _write_async(self, clip: _PendingClip):
+        if not self._workers:
+            self._start()
+        self._queue.put(clip)
+
+    def _start(self):
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.threads):
+                worker = threading.Thread(target=self._run, name=f"clip-writer-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _run(self):
+        while True:
+            clip = self._queue.get()
+            if clip is None:
+                return
+            try:
+                self._write(clip)
+            finally:
+                with self._lock:
+                    self.pending_bytes -= clip.nbytes
+                clip.frames = []
+
+    def _write(self, clip: _PendingClip):
+        frames = clip.frames
+        try:
+            duration = frames[-1][0] - frames[0][0]
+            fps = (len(frames) - 1) / duration if duration > 0 else 15
+            write_mjpeg_avi(clip.filepath, [data for _, data in frames], fps)
+            self._count("clips_written")
+        except Exception as e:
+            self._count("clips_failed")
+            print(f"❌ 事件影片寫入失敗 [{clip.filepath.name}]: {e}")
+
+
+# 建立全域實例
+clip_recorder = ClipRecorder()
@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 from pathlib import Path
 
@@ -12,12 +13,30 @@ DB_USER = os.getenv("DB_USER", "root")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "")
 DB_NAME = os.getenv("DB_NAME", "smoking_detection")
 
-DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# 資料庫類型: mysql / sqlite (單機部署可用 sqlite, 不需架設 MySQL)
+DB_TYPE = os.getenv("DB_TYPE", "mysql").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "smoking_detection.db")
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 20000))  # page cache 大小 (KB)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+if DB_TYPE == "sqlite":
+    DATABASE_URL = f"sqlite:///{SQLITE_PATH}"
+    ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{SQLITE_PATH}"
+else:
+    DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    ASYNC_DATABASE_URL = f"mysql+aiomysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
 
 # JWT 設定
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-this")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
+# 已驗證用戶快取秒數 (0 = 停用); 直接以 SQL 修改 users 表時, 最久要等這麼久才生效
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 60))
+
+# 攝影機設定快取秒數 (API Key 驗證用, 0 = 停用)
+CAMERA_CACHE_TTL = int(os.getenv("CAMERA_CACHE_TTL", 300))
 
 # 伺服器設定
 SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
@@ -27,6 +46,8 @@ SERVER_PORT = int(os.getenv("SERVER_PORT", 8000))
 MODEL_PATH = os.getenv("MODEL_PATH", "GP_v2.pt")
 
 # 偵測設定
+MODEL_INPUT_SIZE = int(os.getenv("MODEL_INPUT_SIZE", 640))  # 模型輸入尺寸, 客戶端上傳前縮小到此長邊
+REDUCED_DECODE = os.getenv("REDUCED_DECODE", "true").lower() == "true"  # 大尺寸上傳影像以 1/2~1/8 縮小解碼
 DEFAULT_CONFIDENCE = 0.7
 DEFAULT_IOU = 0.5
 
@@ -35,3 +56,82 @@ UPLOAD_DIR = Path("uploads")
 SCREENSHOT_DIR = Path("screenshots")
 UPLOAD_DIR.mkdir(exist_ok=True)
 SCREENSHOT_DIR.mkdir(exist_ok=True)
+
+# 截圖背景寫入 (overflow: sync = 佇列滿時改交給執行緒池寫入, drop = 丟棄)
+SCREENSHOT_WRITER_THREADS = int(os.getenv("SCREENSHOT_WRITER_THREADS", 2))
+SCREENSHOT_QUEUE_SIZE = int(os.getenv("SCREENSHOT_QUEUE_SIZE", 64))
+SCREENSHOT_QUEUE_OVERFLOW = os.getenv("SCREENSHOT_QUEUE_OVERFLOW", "sync")
+SCREENSHOT_JPEG_QUALITY = int(os.getenv("SCREENSHOT_JPEG_QUALITY", 95))
+
+# 截圖縮圖 / WebP 版本
+SCREENSHOT_THUMB_WIDTH = int(os.getenv("SCREENSHOT_THUMB_WIDTH", 320))
+SCREENSHOT_THUMB_QUALITY = int(os.getenv("SCREENSHOT_THUMB_QUALITY", 75))
+SCREENSHOT_WEBP = os.getenv("SCREENSHOT_WEBP", "false").lower() == "true"
+SCREENSHOT_WEBP_QUALITY = int(os.getenv("SCREENSHOT_WEBP_QUALITY", 80))
+# 吸菸事件前後影片 (記憶體環狀緩衝區, 單位: 秒 / MB)
+CLIP_ENABLED = os.getenv("CLIP_ENABLED", "true").lower() == "true"
+CLIP_PRE_SECONDS = float(os.getenv("CLIP_PRE_SECONDS", 5))
+CLIP_POST_SECONDS = float(os.getenv("CLIP_POST_SECONDS", 5))
+CLIP_BUFFER_MAX_MB = int(os.getenv("CLIP_BUFFER_MAX_MB", 16))      # 每台攝影機上限
+CLIP_TOTAL_BUFFER_MB = int(os.getenv("CLIP_TOTAL_BUFFER_MB", 256))  # 全部攝影機上限
+CLIP_WRITER_THREADS = int(os.getenv("CLIP_WRITER_THREADS", 1))  # 片段寫入執行緒數
+
+# 即時畫面轉播 JPEG 品質
+LIVE_VIEW_JPEG_QUALITY = int(os.getenv("LIVE_VIEW_JPEG_QUALITY", 70))
+
+# 即時警報推送 (SSE)
+ALERT_STREAM_QUEUE_SIZE = int(os.getenv("ALERT_STREAM_QUEUE_SIZE", 100))
+ALERT_STREAM_HEARTBEAT = int(os.getenv("ALERT_STREAM_HEARTBEAT", 15))  # 秒
+
+SCREENSHOT_CACHE_MAX_AGE = int(os.getenv("SCREENSHOT_CACHE_MAX_AGE", 31536000))  # 截圖寫入後不變, 瀏覽器快取一年
+CLIP_JPEG_QUALITY = int(os.getenv("CLIP_JPEG_QUALITY", 80))  # 內建擷取的影格需自行編碼
+
+# RTSP 擷取方式 (inprocess = 伺服器內建解碼, subprocess = 啟動 camera_client.py 子進程)
+RTSP_INGEST_MODE = os.getenv("RTSP_INGEST_MODE", "inprocess")
+INGEST_LOOP_FILES = os.getenv("INGEST_LOOP_FILES", "true").lower() == "true"  # 影片檔播完重頭播放
+
+# RTSP 客戶端監控與自動重啟 (指數退避 + 抖動, 單位: 秒)
+RTSP_RESTART_BASE_DELAY = float(os.getenv("RTSP_RESTART_BASE_DELAY", 1))
+RTSP_RESTART_MAX_DELAY = float(os.getenv("RTSP_RESTART_MAX_DELAY", 60))
+RTSP_MAX_CONCURRENT_RESTARTS = int(os.getenv("RTSP_MAX_CONCURRENT_RESTARTS", 4))
+RTSP_SUPERVISOR_INTERVAL = float(os.getenv("RTSP_SUPERVISOR_INTERVAL", 1))
+RTSP_STARTUP_GRACE = float(os.getenv("RTSP_STARTUP_GRACE", 5))     # 重啟後存活多久才算啟動完成
+RTSP_STABLE_SECONDS = float(os.getenv("RTSP_STABLE_SECONDS", 60))  # 穩定執行多久後重置退避
+
+# 伺服器啟動時自動啟動所有啟用中的 RTSP 攝影機 (每台間隔 RTSP_AUTOSTART_STAGGER 秒, 避免同時連線)
+RTSP_AUTOSTART = os.getenv("RTSP_AUTOSTART", "true").lower() == "true"
+RTSP_AUTOSTART_STAGGER = float(os.getenv("RTSP_AUTOSTART_STAGGER", 0.5))
+# 每隔幾秒依存活中的 worker 重新分配 RTSP 攝影機 (worker 當機後由其他 worker 接手)
+RTSP_REBALANCE_SECONDS = float(os.getenv("RTSP_REBALANCE_SECONDS", 10))
+
+# 攝影機客戶端日誌 (依大小輪替, 每台最多保留 (1 + CAMERA_LOG_BACKUPS) * CAMERA_LOG_MAX_MB)
+CAMERA_LOG_DIR = Path(os.getenv("CAMERA_LOG_DIR", "logs"))
+CAMERA_LOG_MAX_MB = float(os.getenv("CAMERA_LOG_MAX_MB", 5))
+CAMERA_LOG_BACKUPS = int(os.getenv("CAMERA_LOG_BACKUPS", 3))
+
+# 上傳串流參數協商 (每台攝影機最高幀率; 伺服器忙碌時依推論時間自動調降)
+STREAM_MAX_FPS = float(os.getenv("STREAM_MAX_FPS", 15))
+STREAM_LOW_POWER_FPS = float(os.getenv("STREAM_LOW_POWER_FPS", 5))  # detect_mode = low_power
+STREAM_MIN_FPS = float(os.getenv("STREAM_MIN_FPS", 1))
+STREAM_TARGET_UTILIZATION = float(os.getenv("STREAM_TARGET_UTILIZATION", 0.8))  # 推論時間佔比上限
+
+# 邊緣閘道多攝影機上傳 (/ws/gateway)
+GATEWAY_MAX_CAMERAS = int(os.getenv("GATEWAY_MAX_CAMERAS", 64))   # 單一連線最多攝影機數
+GATEWAY_HELLO_TIMEOUT = float(os.getenv("GATEWAY_HELLO_TIMEOUT", 10))  # 秒
+
+# 攝影機執行狀態儲存 (memory = 單一 worker; redis = 多個 worker / 多台主機共用, 需安裝 redis 套件)
+STATE_STORE = os.getenv("STATE_STORE", "memory").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+STATE_KEY_PREFIX = os.getenv("STATE_KEY_PREFIX", "smoking:")
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"  # 每個 worker 進程唯一
+CAMERA_LEASE_SECONDS = float(os.getenv("CAMERA_LEASE_SECONDS", 30))  # worker 當機後多久可由其他 worker 接手
+WORKER_HEARTBEAT_SECONDS = float(os.getenv("WORKER_HEARTBEAT_SECONDS", 5))
+
+# 推論工作進程 (0 = 在 web 進程內推論; N = 啟動 N 個進程, 攝影機依 ID 分配, 影像經共用記憶體傳遞)
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 0))
+INFERENCE_SLOTS_PER_WORKER = int(os.getenv("INFERENCE_SLOTS_PER_WORKER", 2))  # 每個進程同時排隊的影格數
+INFERENCE_SLOT_MB = float(os.getenv("INFERENCE_SLOT_MB", 8))  # 每格共用記憶體大小 (1080p BGR 約 6 MB)
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", 10))  # 秒 (包含等待空閒格子的時間)
+# 推論進程連續逾時幾次視為卡住: 強制結束並重啟, 其攝影機改由其他進程處理
+INFERENCE_MAX_TIMEOUTS = int(os.getenv("INFERENCE_MAX_TIMEOUTS", 3))
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", 0))  # 每個進程的 torch 執行緒數 (0 = CPU 核心數 / 進程數)
@@ -1,12 +1,48 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, Text, Enum, ForeignKey
+from sqlalchemy import create_engine, event, inspect, text, func, cast, Date, Column, Integer, String, Float, Boolean, DateTime, Text, Enum, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from datetime import datetime
-from server.config import DATABASE_URL
-
-# 建立資料庫引擎
-engine = create_engine(DATABASE_URL, echo=True)
+from server.config import DATABASE_URL, ASYNC_DATABASE_URL, IS_SQLITE, SQLITE_CACHE_SIZE_KB, SQLITE_BUSY_TIMEOUT_MS
+
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    """每條新連線套用 SQLite 效能設定"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")           # 讀寫不互相阻塞
+    cursor.execute("PRAGMA synchronous=NORMAL")         # WAL 模式下安全且較快
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+# 建立資料庫引擎 (同步: 給 setup_database.py 等腳本使用)
+if IS_SQLITE:
+    # SQLite: FastAPI 會在不同執行緒使用同一連線, 需關閉 check_same_thread
+    engine = create_engine(
+        DATABASE_URL,
+        echo=True,
+        connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    )
+    event.listen(engine, "connect", _set_sqlite_pragma)
+else:
+    engine = create_engine(DATABASE_URL, echo=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# 建立非同步資料庫引擎 (給 FastAPI 路由使用, 查詢時不阻塞事件迴圈)
+if IS_SQLITE:
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        echo=True,
+        connect_args={"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    )
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragma)
+else:
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, echo=True, pool_recycle=3600)
+# expire_on_commit=False: commit 後仍可讀取屬性, 避免在非同步環境觸發 lazy load
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 # ==================== 資料表定義 ====================
@@ -51,7 +87,11 @@ class Camera(Base):
     enable_screenshot = Column(Boolean, default=True)
     nms_threshold = Column(Float, default=0.5)
     draw_bbox = Column(Boolean, default=True)
-    detect_mode = Column(Enum('real_time', 'low_power'), default='real_time')
+    # SQLite 沒有原生 ENUM, 改用 VARCHAR + CHECK 約束
+    detect_mode = Column(
+        Enum('real_time', 'low_power', name='detect_mode', native_enum=not IS_SQLITE, create_constraint=IS_SQLITE),
+        default='real_time'
+    )
     
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
@@ -75,6 +115,7 @@ class Detection(Base):
     is_smoking = Column(Boolean, default=False)
     confidence = Column(Float)
     screenshot_path = Column(String(500))
+    clip_path = Column(String(500))  # 事件前後影片 (相對於 SCREENSHOT_DIR)
     detection_details = Column(Text)
     
     created_at = Column(DateTime, default=datetime.now)
@@ -100,12 +141,41 @@ class SystemSettings(Base):
 
 # ==================== 資料庫操作函數 ====================
 
+def date_column(column):
+    """取得日期分組用的欄位運算式 (MySQL 用 CAST, SQLite 用 date())"""
+    if IS_SQLITE:
+        return func.date(column)
+    return cast(column, Date)
+
+
+def date_key(value) -> str:
+    """將日期分組結果轉成 'YYYY-MM-DD' 字串 (SQLite 回傳字串, MySQL 回傳 date)"""
+    if isinstance(value, str):
+        return value[:10]
+    return value.strftime('%Y-%m-%d')
+
+
 def init_db():
     """初始化資料庫(建立所有表)"""
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
     print("✅ 資料庫表建立完成")
 
 
+def add_missing_columns():
+    """為既有資料表補上新增的可為 NULL 欄位 (create_all 不會修改已存在的表)"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                print(f"✅ 已新增欄位 {table.name}.{column.name}")
+
+
 def get_db():
     """取得資料庫 session (用於 FastAPI 依賴注入)"""
     db = SessionLocal()
@@ -115,6 +185,12 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    """取得非同步資料庫 session (用於 FastAPI 路由與 WebSocket)"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 def create_tables():
     """強制重建所有表 (開發用)"""
     Base.metadata.drop_all(bind=engine)
@@ -0,0 +1,118 @@
+"""
+吸菸偵測核心 (YOLO 追蹤 + 人 / 香菸配對)
+
+web 進程 (main.run_detection) 與推論工作進程 (inference_pool) 共用,
+此模組不依賴 FastAPI / 資料庫, 工作進程只需載入模型。
+"""
+
+import numpy as np
+
+from server.config import MODEL_INPUT_SIZE
+
+
+def empty_detection() -> dict:
+    """沒有模型 (或推論失敗) 時的偵測結果"""
+    return {
+        "has_person": False,
+        "has_cigarette": False,
+        "is_smoking": False,
+        "boxes": [],
+        "max_confidence": 0
+    }
+
+
+def load_model(model_path: str, warmup: int = 3):
+    """載入 YOLO 模型並預熱 (推論工作進程使用; web 進程由 main.init_model 載入)"""
+    import torch
+    from ultralytics import YOLO
+
+    model = YOLO(model_path)
+    if torch.cuda.is_available():
+        model.to('cuda')
+    dummy_img = np.zeros((MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, 3), dtype=np.uint8)
+    for _ in range(warmup):
+        model(dummy_img, verbose=False, imgsz=MODEL_INPUT_SIZE)
+    return model
+
+
+def track_frame(model, frame, conf: float, iou: float, scale: float = 1):
+    """
+    執行吸菸偵測（使用追蹤）, 回傳 (偵測結果, YOLO result)
+
+    scale: frame 為縮小解碼時的倍數, 偵測框座標換算回原始影像尺寸
+    """
+    results = model.track(
+        frame,
+        conf=conf,
+        iou=iou,
+        imgsz=MODEL_INPUT_SIZE,
+        persist=True,
+        verbose=False,
+        tracker="botsort.yaml"
+    )
+
+    result = results[0]
+    boxes = result.boxes
+
+    persons = []
+    cigarettes = []
+
+    # 🔥 動態取得類別名稱（不寫死）
+    for box in boxes:
+        cls = int(box.cls[0])
+        track_id = int(box.id[0]) if box.id is not None else -1
+        x1, y1, x2, y2 = (v * scale for v in box.xyxy[0].tolist())
+        conf = float(box.conf[0])
+
+        # 🔥 從模型取得類別名稱
+        class_name = result.names[cls]
+
+        obj = {
+            "id": track_id,
+            "x1": x1, "y1": y1, "x2": x2, "y2": y2,
+            "confidence": conf,
+            "class": cls,
+            "label": class_name
+        }
+
+        # 🔥 根據類別名稱判斷（不是根據數字）
+        if class_name.lower() == "person":
+            persons.append(obj)
+        elif class_name.lower() == "cigarette":
+            cigarettes.append(obj)
+
+    # 判斷吸菸
+    is_smoking = False
+    smoking_pairs = []
+    max_confidence = 0
+
+    for person in persons:
+        for cigarette in cigarettes:
+            cig_center_x = (cigarette["x1"] + cigarette["x2"]) / 2
+            cig_center_y = (cigarette["y1"] + cigarette["y2"]) / 2
+
+            p_x1, p_y1, p_x2, p_y2 = person["x1"], person["y1"], person["x2"], person["y2"]
+
+            margin = 50
+            if (p_x1 - margin <= cig_center_x <= p_x2 + margin and
+                p_y1 - margin <= cig_center_y <= p_y2 + margin):
+                is_smoking = True
+                smoking_pairs.append({
+                    "person_id": person["id"],
+                    "cigarette_id": cigarette["id"]
+                })
+
+                max_conf = max(person["confidence"], cigarette["confidence"])
+                if max_conf > max_confidence:
+                    max_confidence = max_conf
+
+    detection_data = {
+        "has_person": len(persons) > 0,
+        "has_cigarette": len(cigarettes) > 0,
+        "is_smoking": is_smoking,
+        "smoking_pairs": smoking_pairs,
+        "max_confidence": max_confidence,
+        "boxes": persons + cigarettes
+    }
+
+    return detection_data, result
@@ -0,0 +1,122 @@
+"""
+不可變檔案 (截圖) 的 HTTP 快取回應
+
+- 強 ETag (檔案大小 + 修改時間, 截圖寫入後不再變動)
+- Cache-Control: immutable, 瀏覽器重新整理時不再重抓
+- If-None-Match / If-Modified-Since → 304
+- Range / If-Range → 206 部分內容
+"""
+
+import asyncio
+import mimetypes
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+
+from server.config import SCREENSHOT_CACHE_MAX_AGE
+
+IMMUTABLE_CACHE_CONTROL = f"private, max-age={SCREENSHOT_CACHE_MAX_AGE}, immutable"
+
+
+def make_etag(stat_result: os.stat_result) -> str:
+    """由檔案大小與修改時間 (奈秒) 產生強 ETag"""
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match 比對 (支援多個值與 *)"""
+    if header.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header.split(",")]
+    # If-None-Match 使用弱比對: 去掉 W/ 前綴後比較
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def _not_modified_since(header: str, stat_result: os.stat_result) -> bool:
+    try:
+        since = parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return int(stat_result.st_mtime) <= since
+
+
+def parse_range(header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析單一 bytes Range, 回傳 (start, end) 含頭尾
+
+    格式錯誤回傳 None (忽略 Range 回整個檔案);
+    超出範圍拋出 ValueError (回 416)
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_str, _, end_str = spec.strip().partition("-")
+    try:
+        if start_str == "":
+            # bytes=-N: 最後 N 個位元組
+            length = int(end_str)
+            start, end = max(0, file_size - length), file_size - 1
+            if length == 0:
+                start = file_size
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+    except ValueError:
+        return None
+    if start >= file_size or start > end:
+        raise ValueError("Range 超出檔案大小")
+    return start, min(end, file_size - 1)
+
+
+def _read_range(filepath: Path, start: int, end: int) -> bytes:
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        return f.read(end - start + 1)
+
+
+async def cached_file_response(request: Request, filepath: Path, media_type: Optional[str] = None) -> Response:
+    """回傳帶有快取標頭的檔案, 並處理 304 與 Range 請求"""
+    stat_result = os.stat(filepath)
+    etag = make_etag(stat_result)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+
+    # 條件式請求: If-None-Match 優先於 If-Modified-Since
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif "if-modified-since" in request.headers:
+        if _not_modified_since(request.headers["if-modified-since"], stat_result):
+            return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        file_size = stat_result.st_size
+        try:
+            byte_range = parse_range(range_header, file_size)
+        except ValueError:
+            return Response(
+                status_code=416,
+                headers={**headers, "Content-Range": f"bytes */{file_size}"}
+            )
+        if byte_range is not None:
+            start, end = byte_range
+            content = await asyncio.to_thread(_read_range, filepath, start, end)
+            return Response(
+                content=content,
+                status_code=206,
+                media_type=media_type or mimetypes.guess_type(str(filepath))[0] or "application/octet-stream",
+                headers={**headers, "Content-Range": f"bytes {start}-{end}/{file_size}"}
+            )
+
+    return FileResponse(filepath, media_type=media_type, headers=headers, stat_result=stat_result)
@@ -0,0 +1,60 @@
+"""
+上傳影像解碼
+
+客戶端上傳的 JPEG 比模型輸入尺寸大很多時, 以 libjpeg 的 DCT 縮放直接解碼成
+1/2、1/4 或 1/8 大小 (IMREAD_REDUCED_COLOR_*), 比完整解碼後再縮小快得多。
+縮小後的長邊不會小於 MODEL_INPUT_SIZE, 偵測結果的座標再換算回原始尺寸。
+
+完整解析度只在需要時 (截圖) 才從原始 JPEG 解碼。
+"""
+
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from server.config import MODEL_INPUT_SIZE, REDUCED_DECODE
+from server.jpeg_header import jpeg_size
+
+# 縮小倍數 → imdecode 旗標
+REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+
+
+def choose_reduction(jpeg_bytes: bytes, target_size: int = MODEL_INPUT_SIZE) -> int:
+    """依影像尺寸選擇縮小倍數 (縮小後長邊仍不小於 target_size)"""
+    if not REDUCED_DECODE:
+        return 1
+    try:
+        width, height = jpeg_size(jpeg_bytes)
+    except (ValueError, IndexError):
+        return 1
+    long_side = max(width, height)
+    for factor in REDUCED_FLAGS:
+        if long_side // factor >= target_size:
+            return factor
+    return 1
+
+
+def decode_frame(jpeg_bytes: bytes, target_size: int = MODEL_INPUT_SIZE) -> Tuple[Optional[np.ndarray], int]:
+    """
+    解碼上傳影像供偵測使用
+
+    Returns:
+        (影像, 縮小倍數); 解碼失敗時影像為 None
+    """
+    np_arr = np.frombuffer(jpeg_bytes, np.uint8)
+    factor = choose_reduction(jpeg_bytes, target_size)
+    if factor > 1:
+        frame = cv2.imdecode(np_arr, REDUCED_FLAGS[factor])
+        if frame is not None:
+            return frame, factor
+    return cv2.imdecode(np_arr, cv2.IMREAD_COLOR), 1
+
+
+def decode_full(jpeg_bytes: bytes) -> Optional[np.ndarray]:
+    """完整解析度解碼 (截圖用)"""
+    return cv2.imdecode(np.frombuffer(jpeg_bytes, np.uint8), cv2.IMREAD_COLOR)
@@ -0,0 +1,482 @@
+"""
+推論工作進程池
+
+偵測在 web 進程的事件迴圈中依序執行時, 受 GIL 限制只能用到一個核心。
+INFERENCE_WORKERS = N 時, web 進程只負責 I/O (WebSocket、解碼、資料庫),
+另外啟動 N 個推論進程, 各自載入模型並負責一部分攝影機:
+
+- 分配: 依攝影機 ID 以 rendezvous hashing (state_store.pick_worker) 選擇進程,
+  同一台攝影機固定送到同一個進程 (YOLO 追蹤器狀態在進程內)
+- 傳遞: 每個進程一塊共用記憶體, 分成 INFERENCE_SLOTS_PER_WORKER 格;
+  影格直接複製進空閒的格子, 管線只傳送格子編號與參數 (不 pickle 影像);
+  超過格子大小的影格才改用 pickle 傳送
+- 重新分配: 進程異常結束 (或連續 INFERENCE_MAX_TIMEOUTS 次逾時, 視為卡住並強制結束) 時,
+  該進程的攝影機自動改送到其他進程 (其餘攝影機不動), 依指數退避重啟後再移回;
+  也可在執行中增減進程數 (scale)
+
+推論失敗或沒有可用進程時回傳空的偵測結果, 不中斷串流。
+"""
+
+import asyncio
+import itertools
+import multiprocessing as mp
+import os
+import threading
+import time
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+
+from server.backoff import backoff_delay
+from server.config import (
+    MODEL_PATH, INFERENCE_WORKERS, INFERENCE_SLOTS_PER_WORKER, INFERENCE_SLOT_MB, INFERENCE_TIMEOUT,
+    INFERENCE_MAX_TIMEOUTS, INFERENCE_THREADS, RTSP_STABLE_SECONDS
+)
+from server.detector import empty_detection, load_model, track_frame
+from server.state_store import pick_worker
+from server.stream_control import stream_governor
+
+
+# 超過這段時間沒有送出影格的攝影機不計入進程的攝影機數 (已斷線)
+ASSIGNMENT_IDLE_SECONDS = 30.0
+
+
+class InferenceError(Exception):
+    """推論進程回報錯誤或已結束"""
+
+
+def _worker_main(name: str, conn, shm_name: str, slot_bytes: int, model_path: str, threads: int):
+    """推論進程主程式: 載入模型後依序處理 web 進程送來的影格"""
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+
+    # 共用記憶體由 web 進程建立與刪除 (spawn 的子進程與 web 進程共用 resource_tracker)
+    shm = SharedMemory(name=shm_name)
+    try:
+        model = load_model(model_path)
+        conn.send(("ready", os.getpid()))
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            if request is None:
+                break
+
+            req_id, slot, shape, conf, iou, scale, frame = request
+            started = time.perf_counter()
+            try:
+                if frame is None:
+                    frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=slot * slot_bytes)
+                detection_data, _ = track_frame(model, frame, conf, iou, scale)
+                reply = (req_id, slot, detection_data, None, time.perf_counter() - started)
+            except Exception as e:
+                reply = (req_id, slot, None, f"{type(e).__name__}: {e}", time.perf_counter() - started)
+            finally:
+                frame = None  # 釋放共用記憶體的 view
+            conn.send(reply)
+    finally:
+        shm.close()
+
+
+class InferenceWorker:
+    """單一推論進程 (web 進程端的狀態)"""
+
+    def __init__(self, index: int, slots: int, slot_bytes: int):
+        self.index = index
+        self.name = f"inference-{index}"
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.shm = SharedMemory(create=True, size=slots * slot_bytes)
+        self.free_slots: "asyncio.Queue[int]" = asyncio.Queue(maxsize=slots)
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.process = None
+        self.conn = None
+        self.pid: Optional[int] = None
+        self.ready = False
+        self.draining = False  # 縮減進程數時: 不再分配新影格, 處理完即結束
+        self.spawn_time = 0.0
+        self.restarts = 0
+        self.failures = 0
+        self.next_restart: Optional[float] = None
+        self.last_exit_code: Optional[int] = None
+        self.processed = 0
+        self.errors = 0
+        self.timeouts = 0  # 連續逾時次數 (收到回應即歸零)
+        self.avg_ms: Optional[float] = None
+        self.reset_slots()
+
+    def reset_slots(self):
+        """收回所有格子 (同一個佇列, 等待中的請求會被喚醒)"""
+        while not self.free_slots.empty():
+            self.free_slots.get_nowait()
+        for slot in range(self.slots):
+            self.free_slots.put_nowait(slot)
+
+    def slot_view(self, slot: int, shape) -> np.ndarray:
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=slot * self.slot_bytes)
+
+    def fail_pending(self, message: str):
+        """進程結束: 等待中的請求全部失敗, 格子全部收回"""
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(InferenceError(message))
+        self.pending.clear()
+        self.reset_slots()
+
+    def get_status(self) -> Dict:
+        return {
+            "name": self.name,
+            "pid": self.pid,
+            "ready": self.ready,
+            "draining": self.draining,
+            "alive": self.process is not None and self.process.is_alive(),
+            "inflight": len(self.pending),
+            "processed": self.processed,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "avg_ms": round(self.avg_ms, 2) if self.avg_ms is not None else None,
+            "restarts": self.restarts,
+            "last_exit_code": self.last_exit_code,
+        }
+
+
+class InferencePool:
+    """管理推論進程, 依攝影機分配影格"""
+
+    def __init__(self, size: int = INFERENCE_WORKERS, slots: int = INFERENCE_SLOTS_PER_WORKER,
+                 slot_mb: float = INFERENCE_SLOT_MB, model_path: str = MODEL_PATH,
+                 timeout: float = INFERENCE_TIMEOUT, supervisor_interval: float = 1.0):
+        self.size = size
+        self.slots = max(1, slots)
+        self.slot_bytes = int(slot_mb * 1024 * 1024)
+        self.model_path = model_path
+        self.timeout = timeout
+        self.supervisor_interval = supervisor_interval
+        self.workers: Dict[str, InferenceWorker] = {}
+        self.assignments: Dict[int, str] = {}  # {camera_id: 上次處理的進程}
+        self.last_routed: Dict[int, float] = {}  # {camera_id: 上次送出影格的時間}
+        self._ids = itertools.count()
+        self._ctx = mp.get_context("spawn")  # 不 fork 已初始化 CUDA / 事件迴圈的 web 進程
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._supervisor: Optional[asyncio.Task] = None
+        self._removing: Set[asyncio.Task] = set()  # 縮減中的進程 (等待結束)
+        self.pickled = 0       # 超過格子大小, 改以 pickle 傳送的影格數
+        self.unavailable = 0   # 沒有可用進程而略過的影格數
+        self.timeouts = 0
+        self.hung = 0          # 連續逾時而強制結束的進程數
+        self.reassigned = 0    # 攝影機改由其他進程處理的次數
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def start(self):
+        """啟動所有推論進程與監控工作 (需在事件迴圈中呼叫)"""
+        self._loop = asyncio.get_running_loop()
+        for index in range(self.size):
+            self._add_worker(index)
+        self._supervisor = self._loop.create_task(self._supervise())
+        print(f"🧠 啟動 {self.size} 個推論進程 (每個 {self.slots} 格共用記憶體, 每格 {self.slot_bytes // 1024 // 1024} MB)")
+
+    def _add_worker(self, index: int):
+        worker = InferenceWorker(index, self.slots, self.slot_bytes)
+        self.workers[worker.name] = worker
+        self._spawn(worker)
+
+    def _threads_per_worker(self) -> int:
+        if INFERENCE_THREADS:
+            return INFERENCE_THREADS
+        return max(1, (os.cpu_count() or 1) // max(1, self.size))
+
+    def _spawn(self, worker: InferenceWorker):
+        parent_conn, child_conn = self._ctx.Pipe()
+        worker.process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker.name, child_conn, worker.shm.name, worker.slot_bytes, self.model_path,
+                  self._threads_per_worker()),
+            name=worker.name,
+            daemon=True
+        )
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.ready = False
+        worker.timeouts = 0
+        worker.next_restart = None
+        worker.spawn_time = time.monotonic()
+        threading.Thread(
+            target=self._read_replies, args=(worker, parent_conn), name=f"{worker.name}-reader", daemon=True
+        ).start()
+
+    def _read_replies(self, worker: InferenceWorker, conn):
+        """讀取推論進程的回應 (背景執行緒), 交回事件迴圈處理"""
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            self._loop.call_soon_threadsafe(self._on_message, worker, conn, message)
+        # 進程結束: 立即停止分配, 不必等監控工作發現
+        self._loop.call_soon_threadsafe(self._on_disconnect, worker, conn)
+
+    def _on_disconnect(self, worker: InferenceWorker, conn):
+        if conn is not worker.conn or not worker.ready:
+            return
+        worker.ready = False
+        worker.fail_pending(f"{worker.name} 已結束")
+        self._workers_changed()
+
+    def _on_message(self, worker: InferenceWorker, conn, message):
+        if conn is not worker.conn:
+            return  # 已重啟, 舊進程的回應
+        if message[0] == "ready":
+            worker.ready = True
+            worker.pid = message[1]
+            print(f"✅ 推論進程 {worker.name} 已就緒 (pid {worker.pid})")
+            self._workers_changed()
+            return
+        if not worker.ready:
+            return  # 已判定結束 (逾時強制結束 / 斷線), 格子已全部收回, 不再處理舊回應
+
+        req_id, slot, detection_data, error, seconds = message
+        worker.free_slots.put_nowait(slot)
+        worker.timeouts = 0
+        worker.processed += 1
+        worker.avg_ms = seconds * 1000 if worker.avg_ms is None else worker.avg_ms + 0.1 * (seconds * 1000 - worker.avg_ms)
+        future = worker.pending.pop(req_id, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            worker.errors += 1
+            future.set_exception(InferenceError(error))
+        else:
+            future.set_result(detection_data)
+
+    def _workers_changed(self):
+        """可用進程改變: 更新上傳幀率的可用推論容量"""
+        stream_governor.parallelism = max(1, len(self._routable()))
+
+    def _routable(self) -> List[str]:
+        return [name for name, worker in self.workers.items() if worker.ready and not worker.draining]
+
+    def route(self, camera_id: int) -> Optional[InferenceWorker]:
+        """攝影機目前分配到的進程 (沒有可用進程時回傳 None)"""
+        name = pick_worker(camera_id, self._routable())
+        if name is None:
+            return None
+        self.last_routed[camera_id] = time.monotonic()
+        previous = self.assignments.get(camera_id)
+        if previous != name:
+            if previous is not None:
+                self.reassigned += 1
+            self.assignments[camera_id] = name
+        return self.workers[name]
+
+    async def detect(self, camera_id: int, frame: np.ndarray, conf: float, iou: float, scale: float = 1) -> dict:
+        """送到攝影機所屬的推論進程並等待偵測結果 (失敗時回傳空結果)"""
+        worker = self.route(camera_id)
+        if worker is None:
+            self.unavailable += 1
+            return empty_detection()
+
+        # 等待空閒格子也計入逾時 (進程卡住時格子不會收回)
+        deadline = self._loop.time() + self.timeout
+        try:
+            slot = await asyncio.wait_for(worker.free_slots.get(), self.timeout)
+        except asyncio.TimeoutError:
+            self._on_timeout(worker)
+            return empty_detection()
+        if not worker.ready:
+            # 等待格子期間進程結束
+            worker.free_slots.put_nowait(slot)
+            self.unavailable += 1
+            return empty_detection()
+
+        payload = None
+        if frame.dtype == np.uint8 and frame.nbytes <= worker.slot_bytes:
+            worker.slot_view(slot, frame.shape)[...] = frame
+        else:
+            payload = frame
+            self.pickled += 1
+
+        req_id = next(self._ids)
+        future = self._loop.create_future()
+        worker.pending[req_id] = future
+        try:
+            worker.conn.send((req_id, slot, frame.shape, conf, iou, scale, payload))
+        except (OSError, ValueError):
+            worker.pending.pop(req_id, None)
+            worker.free_slots.put_nowait(slot)
+            self._on_disconnect(worker, worker.conn)
+            self.unavailable += 1
+            return empty_detection()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), max(0.0, deadline - self._loop.time()))
+        except asyncio.TimeoutError:
+            # 格子在回應到達時才收回 (進程可能仍在讀取)
+            worker.pending.pop(req_id, None)
+            if future.done() and not future.cancelled():
+                future.exception()  # 同時被判定結束 (fail_pending): 取出例外, 避免未處理的警告
+            self._on_timeout(worker)
+        except InferenceError as e:
+            print(f"⚠️ 推論失敗 [{worker.name}, Camera {camera_id}]: {e}")
+        return empty_detection()
+
+    def _on_timeout(self, worker: InferenceWorker):
+        """推論逾時: 連續 INFERENCE_MAX_TIMEOUTS 次視為進程卡住, 強制結束後由監控工作重啟"""
+        self.timeouts += 1
+        worker.timeouts += 1
+        if worker.timeouts < INFERENCE_MAX_TIMEOUTS or not worker.ready:
+            return
+        self.hung += 1
+        print(f"❌ 推論進程 {worker.name} 連續 {worker.timeouts} 次逾時, 強制結束, 其攝影機暫由其他進程處理")
+        worker.ready = False
+        worker.process.kill()
+        worker.fail_pending(f"{worker.name} 無回應")
+        self._workers_changed()
+
+    async def _supervise(self):
+        while True:
+            try:
+                self._check_workers()
+            except Exception as e:
+                print(f"❌ 推論進程監控錯誤: {e}")
+            await asyncio.sleep(self.supervisor_interval)
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for name, worker in list(self.workers.items()):
+            if worker.draining and (not worker.pending or not worker.process.is_alive()):
+                worker.fail_pending(f"{name} 已停止")
+                self._remove_worker(worker)
+                continue
+
+            if worker.process is not None and worker.process.is_alive():
+                # 穩定執行一段時間後重置退避
+                if worker.failures and now - worker.spawn_time >= RTSP_STABLE_SECONDS:
+                    worker.failures = 0
+                continue
+
+            if worker.next_restart is None:
+                # 進程異常結束: 攝影機暫時改送到其他進程, 排定重啟
+                worker.last_exit_code = worker.process.exitcode if worker.process is not None else None
+                worker.ready = False
+                worker.conn.close()
+                worker.fail_pending(f"{name} 已結束")
+                self._workers_changed()
+                delay = backoff_delay(worker.failures)
+                worker.failures += 1
+                worker.next_restart = now + delay
+                print(f"❌ 推論進程 {name} 異常結束 (exit code {worker.last_exit_code}), "
+                      f"{delay:.1f} 秒後重啟, 其攝影機暫由其他進程處理")
+            elif now >= worker.next_restart:
+                worker.restarts += 1
+                print(f"🔄 重新啟動推論進程 {name} (第 {worker.restarts} 次)")
+                self._spawn(worker)
+
+    def scale(self, count: int) -> dict:
+        """調整推論進程數 (新增的進程就緒後開始分配; 減少時等待處理中的影格完成)"""
+        if not self.enabled:
+            return {
+                "success": False,
+                "message": "未啟用推論進程 (INFERENCE_WORKERS=0)",
+                "status": "disabled"
+            }
+        if count < 1:
+            return {
+                "success": False,
+                "message": "推論進程數至少為 1",
+                "status": "error"
+            }
+
+        active = sorted((w for w in self.workers.values() if not w.draining), key=lambda w: w.index)
+        self.size = count
+        if count > len(active):
+            next_index = max((w.index for w in self.workers.values()), default=-1) + 1
+            for index in range(next_index, next_index + count - len(active)):
+                self._add_worker(index)
+        else:
+            for worker in active[count:]:
+                worker.draining = True
+            self._workers_changed()
+        print(f"🧠 推論進程數調整為 {count}")
+        return {
+            "success": True,
+            "message": f"推論進程數調整為 {count}",
+            "status": "scaled"
+        }
+
+    def _remove_worker(self, worker: InferenceWorker):
+        """移出進程池; 等待進程結束與釋放共用記憶體放到執行緒中, 不阻塞事件迴圈"""
+        self.workers.pop(worker.name, None)
+        worker.ready = False
+        task = self._loop.create_task(self._shutdown_removed(worker))
+        self._removing.add(task)
+        task.add_done_callback(self._removing.discard)
+
+    async def _shutdown_removed(self, worker: InferenceWorker):
+        await asyncio.to_thread(self._shutdown_worker, worker)
+        print(f"⏹️ 推論進程 {worker.name} 已停止")
+
+    def _shutdown_worker(self, worker: InferenceWorker, timeout: float = 5.0):
+        process = worker.process
+        if process is not None and process.is_alive():
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout)
+        if worker.conn is not None:
+            worker.conn.close()
+        worker.ready = False
+        worker.shm.close()
+        worker.shm.unlink()
+
+    def stop(self):
+        """停止所有推論進程並釋放共用記憶體"""
+        if self._supervisor is not None:
+            self._loop.call_soon_threadsafe(self._supervisor.cancel)
+            self._supervisor = None
+        for worker in list(self.workers.values()):
+            self._shutdown_worker(worker)
+        self.workers.clear()
+        print("已停止所有推論進程")
+
+    def _prune_assignments(self):
+        """移除已斷線的攝影機 (一段時間沒有影格), 避免統計與記錄無限增加"""
+        idle_before = time.monotonic() - ASSIGNMENT_IDLE_SECONDS
+        for camera_id, routed_at in list(self.last_routed.items()):
+            if routed_at < idle_before:
+                del self.last_routed[camera_id]
+                self.assignments.pop(camera_id, None)
+
+    def get_stats(self) -> Dict:
+        self._prune_assignments()
+        cameras: Dict[str, int] = {}
+        for name in self.assignments.values():
+            cameras[name] = cameras.get(name, 0) + 1
+        return {
+            "enabled": self.enabled,
+            "workers": [
+                {**worker.get_status(), "cameras": cameras.get(name, 0)}
+                for name, worker in self.workers.items()
+            ],
+            "slots_per_worker": self.slots,
+            "slot_mb": round(self.slot_bytes / 1024 / 1024, 1),
+            "pickled_frames": self.pickled,
+            "unavailable_frames": self.unavailable,
+            "timeouts": self.timeouts,
+            "hung_workers": self.hung,
+            "reassigned": self.reassigned,
+        }
+
+
+# 建立全域實例
+inference_pool = InferencePool()
@@ -0,0 +1,390 @@
+"""
+內建 RTSP / 影片檔擷取引擎
+
+取代 RTSPClientManager 啟動 camera_client.py 子進程、再經 ws://localhost 回傳
+base64 JPEG 的做法: 每台攝影機一條解碼執行緒直接讀取 RTSP / 檔案, 只保留最新一幀,
+由事件迴圈中的處理工作取出後交給偵測流程 (不經 JPEG 編碼與 WebSocket)。
+
+介面與 RTSPClientManager 相同 (start / stop / get_status / stop_all; stop / stop_all 為協程,
+等待處理工作結束後才返回), 由 RTSP_INGEST_MODE 選擇使用哪一個。監控方式也相同: 處理工作異常結束時依指數退避
+(加抖動) 重新啟動, 同時進行中的重啟 / 重新連線最多 RTSP_MAX_CONCURRENT_RESTARTS 個。
+"""
+
+import asyncio
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import cv2
+
+from server.backoff import backoff_delay
+from server.camera_logs import get_camera_logger
+from server.config import (
+    INGEST_LOOP_FILES, RTSP_MAX_CONCURRENT_RESTARTS, RTSP_SUPERVISOR_INTERVAL,
+    RTSP_STARTUP_GRACE, RTSP_STABLE_SECONDS
+)
+
+# 所有來源共用: 同時進行中的重新連線數上限 (網路恢復時不會所有攝影機同時重連)
+_reconnect_slots = threading.BoundedSemaphore(max(1, RTSP_MAX_CONCURRENT_RESTARTS))
+
+
+class SourceReader:
+    """單一來源的解碼執行緒 (只保留最新一幀, 處理不及時自動跳幀)"""
+
+    def __init__(self, camera_id: int, source: str, loop: asyncio.AbstractEventLoop):
+        self.camera_id = camera_id
+        self.source = source
+        self.is_file = not source.lower().startswith(("rtsp://", "rtsps://", "http://", "https://")) and not source.isdigit()
+        self._loop = loop
+        self._frame_ready = asyncio.Event()
+        self._lock = threading.Lock()
+        self._frame = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"ingest-{camera_id}", daemon=True)
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.reconnects = 0
+        self._failures = 0  # 連續失敗次數 (決定退避時間)
+        self._log = get_camera_logger(camera_id)
+        self.error: Optional[str] = None
+        self.finished = False
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout: float = 5.0):
+        self._thread.join(timeout)
+
+    async def next_frame(self):
+        """等待並取出最新一幀 (來源結束時回傳 None)"""
+        while True:
+            with self._lock:
+                frame, self._frame = self._frame, None
+                if frame is None:
+                    self._frame_ready.clear()
+            if frame is not None:
+                return frame
+            if self.finished or self._stop.is_set():
+                return None
+            await self._frame_ready.wait()
+
+    def _publish(self, frame):
+        with self._lock:
+            if self._frame is not None:
+                self.frames_dropped += 1
+            self._frame = frame
+        self._loop.call_soon_threadsafe(self._frame_ready.set)
+
+    def _open(self):
+        source = int(self.source) if self.source.isdigit() else self.source
+        cap = cv2.VideoCapture(source)
+        if not self.is_file:
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # 減少延遲
+        return cap
+
+    def _reopen(self):
+        """重新連線 (等待共用的連線名額, 可被 stop 中斷; 中斷時回傳 None)"""
+        while not _reconnect_slots.acquire(timeout=0.5):
+            if self._stop.is_set():
+                return None
+        try:
+            return self._open()
+        finally:
+            _reconnect_slots.release()
+
+    def _wait_reconnect(self):
+        """依連續失敗次數退避後再重連 (可被 stop 中斷)"""
+        self.reconnects += 1
+        self._stop.wait(backoff_delay(self._failures))
+        self._failures += 1
+
+    def _run(self):
+        cap = None
+        try:
+            while not self._stop.is_set():
+                if cap is None or not cap.isOpened():
+                    cap = self._reopen() if self._failures else self._open()
+                    if cap is None:
+                        continue
+                    if not cap.isOpened():
+                        self.error = f"無法開啟來源: {self.source}"
+                        self._log.info(self.error)
+                        if self.is_file:
+                            break
+                        self._wait_reconnect()
+                        continue
+                    self.error = None
+                    read_since_rewind = 0
+                    self._log.info(f"已開啟來源: {self.source}")
+                    fps = cap.get(cv2.CAP_PROP_FPS) or 15
+                    frame_interval = 1.0 / fps if 0 < fps < 120 else 1.0 / 15
+
+                started = time.monotonic()
+                ok, frame = cap.read()
+                if not ok:
+                    if self.is_file and INGEST_LOOP_FILES and read_since_rewind:
+                        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                        read_since_rewind = 0
+                        continue
+                    if self.is_file:
+                        if INGEST_LOOP_FILES:
+                            # 重頭播放仍讀不到影格 (檔案損毀或沒有影像串流), 不再重試
+                            self.error = f"影片檔沒有可讀取的影格: {self.source}"
+                            self._log.info(self.error)
+                        break
+                    # RTSP 中斷: 重新連線
+                    self.error = "讀取影像失敗, 重新連線"
+                    self._log.info(self.error)
+                    cap.release()
+                    cap = None
+                    self._wait_reconnect()
+                    continue
+
+                self._failures = 0
+                self.frames_read += 1
+                read_since_rewind += 1
+                self._publish(frame)
+
+                # 影片檔依原始 FPS 播放 (RTSP 由來源控制速度)
+                if self.is_file:
+                    self._stop.wait(max(0.0, frame_interval - (time.monotonic() - started)))
+        finally:
+            if cap is not None:
+                cap.release()
+            self.finished = True
+            self._log.info("擷取結束")
+            self._loop.call_soon_threadsafe(self._frame_ready.set)
+
+
+FrameConsumer = Callable[[int, str, SourceReader], Awaitable[None]]
+
+
+class IngestEngine:
+    """管理所有內建擷取來源 (介面同 RTSPClientManager)"""
+
+    def __init__(self):
+        self.clients: Dict[int, dict] = {}
+        self._consumer: Optional[FrameConsumer] = None
+        self._supervisor: Optional[asyncio.Task] = None
+        self.total_restarts = 0
+
+    def set_frame_consumer(self, consumer: FrameConsumer):
+        """設定每台攝影機的處理工作 (由 main.py 提供: consumer(camera_id, api_key, reader))"""
+        self._consumer = consumer
+
+    def start(self, camera_id: int, api_key: str, rtsp_url: str) -> dict:
+        """啟動攝影機擷取 (需在事件迴圈中呼叫)"""
+        if camera_id in self.clients:
+            if self.clients[camera_id]["state"] != "finished":
+                return {
+                    "success": False,
+                    "message": "擷取已在執行中",
+                    "status": self.clients[camera_id]["state"]
+                }
+            self._discard(camera_id)
+
+        if self._consumer is None:
+            return {
+                "success": False,
+                "message": "尚未設定影像處理流程",
+                "status": "error"
+            }
+
+        client = {
+            "api_key": api_key,
+            "rtsp_url": rtsp_url,
+            "reader": None,
+            "task": None,
+            "state": "starting",
+            "restarts": 0,
+            "failures": 0,           # 連續異常結束次數 (決定退避時間)
+            "last_error": None,
+            "next_restart": None,
+            "start_time": time.time()
+        }
+        self._spawn(camera_id, client)
+        self.clients[camera_id] = client
+        self._ensure_supervisor()
+        print(f"RTSP 擷取已啟動 [Camera {camera_id}] (內建)")
+        return {
+            "success": True,
+            "message": "RTSP 擷取已啟動",
+            "status": "started"
+        }
+
+    async def stop(self, camera_id: int) -> dict:
+        """停止攝影機擷取 (等待處理工作的清理完成, 之後可立即以新設定重新啟動)"""
+        if camera_id not in self.clients:
+            return {
+                "success": False,
+                "message": "擷取未在執行",
+                "status": "not_running"
+            }
+        task = self._discard(camera_id)
+        if task is not None:
+            await asyncio.wait({task})
+        print(f"RTSP 擷取已停止 [Camera {camera_id}]")
+        return {
+            "success": True,
+            "message": "RTSP 擷取已停止",
+            "status": "stopped"
+        }
+
+    def get_status(self, camera_id: int) -> dict:
+        """取得擷取狀態"""
+        client = self.clients.get(camera_id)
+        if client is None:
+            return {
+                "running": False,
+                "status": "not_running"
+            }
+        reader: Optional[SourceReader] = client["reader"]
+        running = client["task"] is not None and not client["task"].done()
+        status = {
+            "running": running,
+            "status": client["state"],
+            "restarts": client["restarts"],
+            "last_error": client["last_error"]
+        }
+        if running:
+            status.update({
+                "uptime": time.time() - client["start_time"],
+                "frames_read": reader.frames_read,
+                "frames_dropped": reader.frames_dropped,
+                "reconnects": reader.reconnects,
+                "error": reader.error
+            })
+        if client["next_restart"] is not None:
+            status["next_restart_in"] = round(max(0.0, client["next_restart"] - time.monotonic()), 1)
+        return status
+
+    def get_stats(self) -> dict:
+        """所有擷取來源統計"""
+        states: Dict[str, int] = {}
+        for client in self.clients.values():
+            states[client["state"]] = states.get(client["state"], 0) + 1
+        readers = [client["reader"] for client in self.clients.values() if client["reader"] is not None]
+        return {
+            "clients": len(self.clients),
+            "states": states,
+            "running": sum(1 for r in readers if not r.finished),
+            "total_restarts": self.total_restarts,
+            "total_reconnects": sum(r.reconnects for r in readers),
+            "frames_dropped": sum(r.frames_dropped for r in readers),
+            "max_concurrent_restarts": RTSP_MAX_CONCURRENT_RESTARTS
+        }
+
+    async def stop_all(self):
+        """停止所有擷取"""
+        for camera_id in list(self.clients.keys()):
+            await self.stop(camera_id)
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
+        print("已停止所有 RTSP 擷取")
+
+    def _spawn(self, camera_id: int, client: dict):
+        """建立解碼執行緒與處理工作"""
+        loop = asyncio.get_running_loop()
+        reader = SourceReader(camera_id, client["rtsp_url"], loop)
+        reader.start()
+        client["reader"] = reader
+        client["task"] = loop.create_task(self._consume(camera_id, client["api_key"], reader))
+        client["spawn_time"] = time.monotonic()
+        client["next_restart"] = None
+
+    async def _consume(self, camera_id: int, api_key: str, reader: SourceReader) -> Optional[str]:
+        """執行處理工作, 回傳錯誤訊息 (正常結束時為解碼執行緒的錯誤, 沒有則為 None)"""
+        try:
+            await self._consumer(camera_id, api_key, reader)
+            return reader.error
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            get_camera_logger(camera_id).exception("影像處理失敗")
+            print(f"❌ RTSP 擷取處理失敗 [Camera {camera_id}]: {e}")
+            return str(e)
+        finally:
+            reader.stop()
+
+    def _discard(self, camera_id: int) -> Optional[asyncio.Task]:
+        """移除並停止擷取, 回傳已取消的處理工作 (尚未結束時由呼叫端等待)"""
+        client = self.clients.pop(camera_id)
+        if client["reader"] is not None:
+            client["reader"].stop()
+        task = client["task"]
+        if task is not None:
+            task.cancel()
+        return task
+
+    # ==================== 監控與自動重啟 ====================
+
+    def _ensure_supervisor(self):
+        """啟動監控工作 (需在事件迴圈中呼叫)"""
+        if self._supervisor is None or self._supervisor.done():
+            self._supervisor = asyncio.get_running_loop().create_task(self._supervise())
+
+    async def _supervise(self):
+        while self.clients:
+            try:
+                self._check_clients()
+            except Exception as e:
+                print(f"❌ RTSP 擷取監控錯誤: {e}")
+            await asyncio.sleep(RTSP_SUPERVISOR_INTERVAL)
+        self._supervisor = None
+
+    def _check_clients(self):
+        now = time.monotonic()
+
+        for camera_id, client in list(self.clients.items()):
+            task = client["task"]
+            if task is None:
+                continue
+            reader: SourceReader = client["reader"]
+            if not task.done():
+                uptime = now - client["spawn_time"]
+                if client["state"] in ("starting", "restarting") and (reader.frames_read or uptime >= RTSP_STARTUP_GRACE):
+                    client["state"] = "running"
+                # 穩定執行一段時間後重置退避
+                if client["failures"] and uptime >= RTSP_STABLE_SECONDS:
+                    client["failures"] = 0
+                continue
+
+            client["task"] = None
+            error = task.result()
+            if error is None:
+                # 來源正常結束 (影片檔播放完畢), 不重啟
+                client["state"] = "finished"
+                continue
+
+            # 處理工作異常結束: 排定重啟
+            client["last_error"] = error
+            delay = backoff_delay(client["failures"])
+            client["failures"] += 1
+            client["state"] = "backoff"
+            client["next_restart"] = now + delay
+            print(f"⚠️ RTSP 擷取異常結束 [Camera {camera_id}] ({error}), {delay:.1f} 秒後重啟")
+
+        # 依排定時間重啟, 限制同時進行中的重啟數量
+        in_flight = sum(1 for c in self.clients.values() if c["state"] == "restarting")
+        due = sorted(
+            (c["next_restart"], camera_id) for camera_id, c in self.clients.items()
+            if c["state"] == "backoff" and c["next_restart"] <= now
+        )
+        for _, camera_id in due:
+            if in_flight >= RTSP_MAX_CONCURRENT_RESTARTS:
+                break
+            client = self.clients[camera_id]
+            get_camera_logger(camera_id).info(f"===== 重新啟動 RTSP 擷取 (第 {client['restarts'] + 1} 次重啟) =====")
+            self._spawn(camera_id, client)
+            client["state"] = "restarting"
+            client["restarts"] += 1
+            self.total_restarts += 1
+            in_flight += 1
+
+
+# 建立全域實例
+ingest_engine = IngestEngine()
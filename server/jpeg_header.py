@@ -0,0 +1,28 @@
+"""
+JPEG 標頭解析
+
+只讀取 SOF 標記取得影像尺寸, 不需解碼 (上傳影像縮小解碼與事件影片封裝共用)。
+"""
+
+import struct
+from typing import Tuple
+
+
+def jpeg_size(data: bytes) -> Tuple[int, int]:
+    """從 JPEG SOF 標記讀取 (寬, 高), 不需解碼"""
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+            i += 1 if marker == 0xFF else 2
+            continue
+        length = struct.unpack(">H", data[i + 2:i + 4])[0]
+        # SOF0 ~ SOF15 (排除 DHT / JPG / DAC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height
+        i += 2 + length
+    raise ValueError("無法從 JPEG 讀取影像尺寸")
@@ -0,0 +1,122 @@
+"""
+即時畫面轉播
+
+攝影機上傳的影像在偵測後繪製偵測框, 每幀只編碼一次 JPEG, 再分送給所有觀看者
+(WebSocket 或 MJPEG)。每位觀看者只保留最新一幀, 網路慢的觀看者會自動跳幀,
+不影響其他人; 沒有觀看者時不繪製也不編碼。
+
+多個 worker 時, 觀看者連到的 worker 不一定是處理該攝影機的 worker: 有觀看者的 worker
+定期公告 (add_remote_viewers), 處理該攝影機的 worker 編碼後經由 relay 轉送,
+其他 worker 收到後以 deliver 分送給本地觀看者。
+"""
+
+import asyncio
+import time
+from typing import Callable, Dict, Iterable, Optional, Set
+
+import cv2
+
+from server.config import LIVE_VIEW_JPEG_QUALITY
+
+
+class Viewer:
+    """單一觀看者 (只保留最新一幀)"""
+
+    def __init__(self):
+        self.queue: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize=1)
+        self.dropped = 0
+
+    def offer(self, jpeg: bytes):
+        """放入最新影格, 上一幀還沒送出就直接取代"""
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait(jpeg)
+
+    async def next_frame(self) -> bytes:
+        return await self.queue.get()
+
+
+class LiveViewHub:
+    """管理每台攝影機的觀看者並分送影格"""
+
+    def __init__(self, jpeg_quality: int = LIVE_VIEW_JPEG_QUALITY):
+        self.jpeg_quality = jpeg_quality
+        self.viewers: Dict[int, Set[Viewer]] = {}  # {camera_id: {viewer, ...}}
+        self.remote: Dict[int, float] = {}  # {camera_id: 到期時間} 其他 worker 上的觀看者
+        self.relay: Optional[Callable[[int, bytes], None]] = None  # 轉送影格給其他 worker
+        self.frames_encoded = 0
+        self.frames_relayed = 0
+
+    def has_viewers(self, camera_id: int) -> bool:
+        return bool(self.viewers.get(camera_id)) or self.has_remote_viewers(camera_id)
+
+    def has_remote_viewers(self, camera_id: int) -> bool:
+        expire_at = self.remote.get(camera_id)
+        if expire_at is None:
+            return False
+        if time.monotonic() >= expire_at:
+            del self.remote[camera_id]
+            return False
+        return True
+
+    def add_remote_viewers(self, camera_ids: Iterable[int], ttl: float):
+        """其他 worker 公告有觀看者 (ttl 秒內沒有再次公告即停止轉送)"""
+        expire_at = time.monotonic() + ttl
+        for camera_id in camera_ids:
+            self.remote[camera_id] = expire_at
+
+    def subscribe(self, camera_id: int) -> Viewer:
+        viewer = Viewer()
+        self.viewers.setdefault(camera_id, set()).add(viewer)
+        return viewer
+
+    def unsubscribe(self, camera_id: int, viewer: Viewer):
+        viewers = self.viewers.get(camera_id)
+        if viewers is None:
+            return
+        viewers.discard(viewer)
+        if not viewers:
+            del self.viewers[camera_id]
+
+    async def publish(self, camera_id: int, annotated_frame):
+        """編碼一次並分送給該攝影機所有觀看者"""
+        if not self.has_viewers(camera_id) or annotated_frame is None:
+            return
+        ok, buffer = await asyncio.to_thread(
+            cv2.imencode, '.jpg', annotated_frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality]
+        )
+        if not ok:
+            return
+        self.frames_encoded += 1
+        jpeg = buffer.tobytes()
+        self.deliver(camera_id, jpeg)
+        if self.relay is not None and self.has_remote_viewers(camera_id):
+            self.relay(camera_id, jpeg)
+            self.frames_relayed += 1
+
+    def deliver(self, camera_id: int, jpeg: bytes):
+        """分送已編碼的影格給本地觀看者 (包含其他 worker 轉送來的影格)"""
+        for viewer in list(self.viewers.get(camera_id, ())):
+            viewer.offer(jpeg)
+
+    def get_stats(self) -> Dict:
+        return {
+            "frames_encoded": self.frames_encoded,
+            "frames_relayed": self.frames_relayed,
+            "remote_cameras": [camera_id for camera_id in list(self.remote) if self.has_remote_viewers(camera_id)],
+            "cameras": {
+                camera_id: {
+                    "viewers": len(viewers),
+                    "dropped_frames": sum(v.dropped for v in viewers)
+                }
+                for camera_id, viewers in self.viewers.items()
+            }
+        }
+
+
+# 建立全域實例
+live_view = LiveViewHub()
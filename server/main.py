@@ -9,28 +9,52 @@ project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
 # ==================== 標準函式庫 ====================
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, File, UploadFile
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, File, UploadFile, Query
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from sqlalchemy import select, func, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from ultralytics import YOLO
 import cv2
 import numpy as np
 from datetime import datetime, timedelta
 import asyncio
 import json
+import time
 import base64
+import dataclasses
 from pathlib import Path
 from typing import List, Optional
 import torch
 # ==================== 專案模組 ====================
-from server.database import get_db, User, Camera, Detection, init_db
+from server.database import get_async_db, AsyncSessionLocal, User, Camera, Detection, init_db, date_column, date_key
 from server.auth import (
     authenticate_user, create_access_token, get_current_user, 
     get_password_hash, UserCreate, UserLogin, Token, UserResponse,
-    generate_camera_api_key, verify_camera_api_key
+    generate_camera_api_key, verify_camera_api_key, get_user_from_token, get_current_active_admin,
+    invalidate_user_cache
+)
+from server.camera_cache import camera_cache, CameraConfig
+from server.screenshot_writer import screenshot_writer
+from server.screenshot_variants import SCREENSHOT_SIZES, ensure_variant
+from server.file_cache import cached_file_response
+from server.screenshot_storage import new_screenshot_path, new_clip_path, resolve_screenshot
+from server.clip_recorder import clip_recorder
+from server.live_view import live_view
+from server.alert_stream import alert_broker
+from server.ingest import ingest_engine, SourceReader
+from server.rtsp_manager import rtsp_manager, RTSPClientManager
+from server.camera_logs import tail_log
+from server.stream_control import StreamSession, stream_governor, PROTOCOL_VERSION
+from server.frame_decode import decode_frame, decode_full
+from server.state_store import state_store, pick_worker, CameraBusyError
+from server.detector import empty_detection, track_frame
+from server.inference_pool import inference_pool
+from server.config import (
+    MODEL_PATH, MODEL_INPUT_SIZE, SCREENSHOT_DIR, ALERT_STREAM_HEARTBEAT, CLIP_JPEG_QUALITY,
+    RTSP_AUTOSTART, RTSP_AUTOSTART_STAGGER, RTSP_REBALANCE_SECONDS, WORKER_HEARTBEAT_SECONDS,
+    GATEWAY_MAX_CAMERAS, GATEWAY_HELLO_TIMEOUT
 )
-from server.config import MODEL_PATH, SCREENSHOT_DIR
 from pydantic import BaseModel
 
 # ==================== FastAPI 應用程式 ====================
@@ -47,19 +71,15 @@ app.add_middleware(
 
 # ==================== 全域變數 ====================
 model = None
-active_websockets = {} # {camera_id: [websocket1, websocket2, ...]}
-last_detection_time = {}
-DETECTION_COOLDOWN = timedelta(seconds=10)
-DETECTION_STABLE_FRAMES = 3
-smoking_frame_counter = {}
-
-# 🔥 新增：為每個攝影機維護追蹤狀態
-camera_trackers = {}  # {camera_id: tracker_state}
-# 全域變數
-last_detection_time = {}  # {camera_id: datetime}
+active_websockets = live_view.viewers  # {camera_id: {viewer, ...}} 即時畫面觀看者
+# 連續吸菸幀數、警報冷卻時間存放在 state_store (多個 worker 共用);
+# YOLO 追蹤器狀態留在處理該攝影機的進程 (攝影機以租約黏著在同一個 worker)
 DETECTION_COOLDOWN = timedelta(seconds=10)  # 同一攝影機10秒內只記一次
 DETECTION_STABLE_FRAMES = 3  # 連續3幀偵測到才算真正吸菸
-smoking_frame_counter = {}  # {camera_id: 目前連續吸菸幀數}
+LAST_SEEN_UPDATE_INTERVAL = timedelta(seconds=5)  # last_seen 最多每5秒寫入一次
+rtsp_rebalance_task = None  # 定期分配 RTSP 攝影機給存活中的 worker
+rtsp_rebalance_requested = asyncio.Event()  # 立即重新分配 (攝影機啟動 / 停止時)
+state_tasks = []  # worker 心跳 / 跨 worker 事件訂閱
 from fastapi.staticfiles import StaticFiles
 import os
 
@@ -101,6 +121,7 @@ class DetectionResponse(BaseModel):
     is_smoking: bool
     confidence: float
     screenshot_path: Optional[str]
+    clip_path: Optional[str] = None
     
     class Config:
         from_attributes = True
@@ -188,11 +209,11 @@ def init_model():
         
         # ⭐ GPU Warm-up (重要!)
         print(f"\n🔥 GPU Warm-up...")
-        dummy_img = np.zeros((640, 640, 3), dtype=np.uint8)
+        dummy_img = np.zeros((MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, 3), dtype=np.uint8)
         
         # 執行多次 warm-up
         for i in range(5):
-            _ = model(dummy_img, verbose=False, imgsz=640)
+            _ = model(dummy_img, verbose=False, imgsz=MODEL_INPUT_SIZE)
         
         print(f"✅ Warm-up 完成")
         
@@ -203,7 +224,7 @@ def init_model():
         
         for i in range(10):
             start = time.time()
-            _ = model(dummy_img, verbose=False, imgsz=640)
+            _ = model(dummy_img, verbose=False, imgsz=MODEL_INPUT_SIZE)
             elapsed = time.time() - start
             times.append(elapsed)
         
@@ -251,23 +272,196 @@ def init_model():
 async def startup_event():
     """啟動時初始化"""
     init_db()
-    init_model()
+    if inference_pool.enabled:
+        # 推論在獨立進程執行, web 進程不載入模型
+        inference_pool.start()
+    else:
+        init_model()
     SCREENSHOT_DIR.mkdir(exist_ok=True)
+    screenshot_writer.start()
+    if state_store.shared:
+        alert_broker.relay = lambda message: state_store.publish("alerts", message)
+        live_view.relay = relay_live_frame
+        state_tasks.append(asyncio.create_task(state_store.run_heartbeat()))
+        state_tasks.append(asyncio.create_task(state_store.listen({
+            "alerts": alert_broker.deliver,
+            "control": handle_control_event,
+            "live": handle_live_frame,
+        })))
+        state_tasks.append(asyncio.create_task(run_viewer_announcements()))
+        print(f"🔗 共用狀態儲存已啟用 (worker: {state_store.worker_id})")
+    global rtsp_rebalance_task
+    rtsp_rebalance_task = asyncio.create_task(run_rtsp_rebalance())
     print("✅ 系統初始化完成")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """關閉時停止 RTSP 串流, 並寫完尚未寫入的截圖與事件影片"""
+    if rtsp_rebalance_task is not None:
+        rtsp_rebalance_task.cancel()
+    await stop_all_rtsp()
+    await asyncio.to_thread(screenshot_writer.stop)
+    # 偵測記錄已指向片段路徑: 以現有影格寫完收集中的片段
+    clip_recorder.flush()
+    await asyncio.to_thread(clip_recorder.stop)
+    if inference_pool.enabled:
+        await asyncio.to_thread(inference_pool.stop)
+    for task in state_tasks:
+        task.cancel()
+    await state_store.close()
+
+
+async def run_rtsp_rebalance():
+    """
+    定期將應執行的 RTSP 攝影機分配給存活中的 worker
+
+    worker 當機 (心跳過期) 時由其他 worker 接手它的攝影機, 新 worker 加入時移交一部分;
+    攝影機啟動 / 停止時收到 rtsp_rebalance 事件立即執行一次
+    """
+    if RTSP_AUTOSTART:
+        async with AsyncSessionLocal() as db:
+            camera_ids = (await db.scalars(select(Camera.id).filter(
+                Camera.camera_type == "rtsp",
+                Camera.is_active == True
+            ))).all()
+        await state_store.add_rtsp_cameras(camera_ids)
+    if state_store.shared:
+        # 等其他 worker 登錄心跳, 避免啟動時全部分配給第一個 worker
+        await asyncio.sleep(state_store.heartbeat_seconds)
+
+    while True:
+        rtsp_rebalance_requested.clear()
+        try:
+            await rebalance_rtsp()
+        except Exception as e:
+            print(f"⚠️ RTSP 攝影機分配失敗: {e}")
+        try:
+            await asyncio.wait_for(rtsp_rebalance_requested.wait(), RTSP_REBALANCE_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def rebalance_rtsp():
+    """啟動分配給本進程的 RTSP 攝影機, 停止不再分配給本進程 (或已停止 / 刪除) 的攝影機"""
+    desired = await state_store.rtsp_cameras()
+    workers = await state_store.live_workers()
+    mine = {camera_id for camera_id in desired
+            if pick_worker(camera_id, workers) in (state_store.worker_id, None)}
+
+    for camera_id in list(rtsp_manager.clients):
+        if camera_id not in mine:
+            await stop_rtsp(camera_id)
+
+    pending = mine - set(rtsp_manager.clients)
+    if not pending:
+        return
+    async with AsyncSessionLocal() as db:
+        cameras = (await db.scalars(select(Camera).filter(
+            Camera.id.in_(pending),
+            Camera.camera_type == "rtsp"
+        ))).all()
+    # 已刪除 (或改為其他類型) 的攝影機移出清單
+    await state_store.remove_rtsp_cameras(pending - {camera.id for camera in cameras})
+    if not cameras:
+        return
+
+    # 逐台間隔啟動, 避免同時連線造成 CPU 尖峰
+    print(f"📡 啟動 {len(cameras)} 台 RTSP 攝影機 (間隔 {RTSP_AUTOSTART_STAGGER} 秒)")
+    for i, camera in enumerate(cameras):
+        if i:
+            await asyncio.sleep(RTSP_AUTOSTART_STAGGER)
+        if camera.id in rtsp_manager.clients:
+            continue
+        result = rtsp_manager.start(camera.id, camera.api_key, camera.camera_source)
+        if not result["success"]:
+            print(f"⚠️ RTSP 攝影機 [{camera.camera_name}] 啟動失敗: {result['message']}")
+
+
+# ==================== 跨 worker 控制事件 ====================
+
+async def broadcast_control(message: dict):
+    """
+    送出控制事件: 多個 worker 時經由 state_store 送給每個 worker (包含自己),
+    由處理該攝影機的 worker 套用; 單一進程直接在本地處理
+    """
+    if not state_store.publish("control", message):
+        await handle_control_event(message)
+
+
+async def handle_control_event(message: dict):
+    """
+    處理控制事件
+
+    - camera_updated:  套用新設定快照; restart_rtsp 時以新網址重新啟動本進程的 RTSP 擷取
+    - camera_deleted:  清除快取並停止本進程的 RTSP 擷取
+    - rtsp_rebalance:  立即重新分配 RTSP 攝影機
+    - user_updated:    清除用戶快取 (其他 worker 修改了用戶資料)
+    - viewers:         其他 worker 上有觀看者, 處理該攝影機時轉送即時畫面
+    """
+    event = message.get("type")
+    if event == "camera_updated":
+        config = camera_cache.apply(CameraConfig(**message["camera"]))
+        if message.get("restart_rtsp") and config.id in rtsp_manager.clients:
+            await stop_rtsp(config.id)
+            if config.camera_type == "rtsp":
+                rtsp_manager.start(config.id, config.api_key, config.camera_source)
+    elif event == "camera_deleted":
+        camera_id = message["camera_id"]
+        camera_cache.invalidate(message.get("api_key"), camera_id=camera_id)
+        if camera_id in rtsp_manager.clients:
+            await stop_rtsp(camera_id)
+    elif event == "rtsp_rebalance":
+        rtsp_rebalance_requested.set()
+    elif event == "user_updated":
+        for username in message["usernames"]:
+            invalidate_user_cache(username)
+    elif event == "viewers":
+        if message.get("worker") != state_store.worker_id:
+            live_view.add_remote_viewers(message["camera_ids"], ttl=state_store.heartbeat_seconds * 3)
+
+
+# ==================== 跨 worker 即時畫面 ====================
+
+def announce_viewers(camera_ids: List[int]):
+    """公告本進程有觀看者的攝影機, 由處理該攝影機的 worker 轉送即時畫面"""
+    if camera_ids and state_store.shared:
+        state_store.publish("control", {"type": "viewers", "worker": state_store.worker_id, "camera_ids": camera_ids})
+
+
+async def run_viewer_announcements():
+    """定期重新公告 (觀看者離開後, 其他 worker 最多 3 次心跳後停止轉送)"""
+    while True:
+        announce_viewers(list(live_view.viewers))
+        await asyncio.sleep(state_store.heartbeat_seconds)
+
+
+def relay_live_frame(camera_id: int, jpeg: bytes):
+    """轉送已編碼的即時畫面給其他 worker 的觀看者 (pub/sub 只傳文字, 以 base64 編碼)"""
+    state_store.publish("live", {
+        "worker": state_store.worker_id,
+        "camera_id": camera_id,
+        "jpeg": base64.b64encode(jpeg).decode("ascii"),
+    })
+
+
+def handle_live_frame(message: dict):
+    if message["worker"] != state_store.worker_id:
+        live_view.deliver(message["camera_id"], base64.b64decode(message["jpeg"]))
+
+
 # ==================== 認證 API ====================
 
 @app.post("/api/auth/register", response_model=UserResponse)
-async def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
     """用戶註冊"""
     # 檢查用戶名是否已存在
-    db_user = db.query(User).filter(User.username == user.username).first()
+    db_user = await db.scalar(select(User).filter(User.username == user.username))
     if db_user:
         raise HTTPException(status_code=400, detail="用戶名已被使用")
     
     # 檢查 email 是否已存在
-    db_user = db.query(User).filter(User.email == user.email).first()
+    db_user = await db.scalar(select(User).filter(User.email == user.email))
     if db_user:
         raise HTTPException(status_code=400, detail="Email 已被使用")
     
@@ -280,16 +474,16 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
         full_name=user.full_name
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     return db_user
 
 
 @app.post("/api/auth/login", response_model=Token)
-async def login(user_login: UserLogin, db: Session = Depends(get_db)):
+async def login(user_login: UserLogin, db: AsyncSession = Depends(get_async_db)):
     """用戶登入"""
-    user = authenticate_user(db, user_login.username, user_login.password)
+    user = await authenticate_user(db, user_login.username, user_login.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -315,7 +509,7 @@ async def get_me(current_user: User = Depends(get_current_user)):
 async def create_camera(
     camera: CameraCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """新增攝影機"""
     api_key = generate_camera_api_key()
@@ -330,8 +524,10 @@ async def create_camera(
     )
     
     db.add(db_camera)
-    db.commit()
-    db.refresh(db_camera)
+    await db.commit()
+    await db.refresh(db_camera)
+
+    alert_broker.publish(current_user.id, "counters", {"total_cameras": 1})
     
     return {
         "id": db_camera.id,
@@ -344,10 +540,10 @@ async def create_camera(
 @app.get("/api/cameras")
 async def list_cameras(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """列出用戶的所有攝影機"""
-    cameras = db.query(Camera).filter(Camera.user_id == current_user.id).all()
+    cameras = (await db.scalars(select(Camera).filter(Camera.user_id == current_user.id))).all()
     return cameras
 
 
@@ -355,13 +551,13 @@ async def list_cameras(
 async def get_camera(
     camera_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """取得攝影機詳細資訊"""
-    camera = db.query(Camera).filter(
+    camera = await db.scalar(select(Camera).filter(
         Camera.id == camera_id,
         Camera.user_id == current_user.id
-    ).first()
+    ))
     
     if not camera:
         raise HTTPException(status_code=404, detail="攝影機不存在")
@@ -374,13 +570,13 @@ async def update_camera(
     camera_id: int,
     camera_update: CameraUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """更新攝影機設定"""
-    camera = db.query(Camera).filter(
+    camera = await db.scalar(select(Camera).filter(
         Camera.id == camera_id,
         Camera.user_id == current_user.id
-    ).first()
+    ))
     
     if not camera:
         raise HTTPException(status_code=404, detail="攝影機不存在")
@@ -394,8 +590,16 @@ async def update_camera(
     # for key, value in update_data.items():
     #     setattr(camera, key, value)
     
-    db.commit()
-    db.refresh(camera)
+    await db.commit()
+    await db.refresh(camera)
+
+    # 推送新設定給連線中的攝影機 (下一幀即生效, 不需重新連線);
+    # RTSP 網址變更: 處理該攝影機的 worker 以新網址重新啟動串流
+    await broadcast_control({
+        "type": "camera_updated",
+        "camera": dataclasses.asdict(CameraConfig.from_camera(camera)),
+        "restart_rtsp": "camera_source" in update_data,
+    })
     
     return {"message": "攝影機設定已更新", "camera": camera}
 
@@ -404,23 +608,182 @@ async def update_camera(
 async def delete_camera(
     camera_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """刪除攝影機"""
-    camera = db.query(Camera).filter(
+    camera = await db.scalar(select(Camera).filter(
         Camera.id == camera_id,
         Camera.user_id == current_user.id
-    ).first()
+    ))
     
     if not camera:
         raise HTTPException(status_code=404, detail="攝影機不存在")
     
-    db.delete(camera)
-    db.commit()
+    await state_store.remove_rtsp_cameras([camera_id])
+    await broadcast_control({"type": "camera_deleted", "camera_id": camera_id, "api_key": camera.api_key})
+    await db.delete(camera)
+    await db.commit()
+    alert_broker.publish(current_user.id, "counters", {"total_cameras": -1})
     
     return {"message": "攝影機已刪除"}
 
 
+# ==================== RTSP 串流管理 API ====================
+
+async def get_rtsp_camera(camera_id: int, current_user: User, db: AsyncSession) -> Camera:
+    """取得用戶的 RTSP 攝影機"""
+    camera = await db.scalar(select(Camera).filter(
+        Camera.id == camera_id,
+        Camera.user_id == current_user.id
+    ))
+
+    if not camera:
+        raise HTTPException(status_code=404, detail="攝影機不存在")
+    if camera.camera_type != "rtsp":
+        raise HTTPException(status_code=400, detail="只有 RTSP 攝影機可由伺服器擷取")
+    return camera
+
+
+@app.post("/api/cameras/{camera_id}/rtsp/start")
+async def start_rtsp_stream(
+    camera_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """啟動 RTSP 攝影機串流"""
+    camera = await get_rtsp_camera(camera_id, current_user, db)
+    return await request_rtsp_start(camera)
+
+
+@app.post("/api/cameras/{camera_id}/rtsp/stop")
+async def stop_rtsp_stream(
+    camera_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """停止 RTSP 攝影機串流"""
+    camera = await get_rtsp_camera(camera_id, current_user, db)
+    return await request_rtsp_stop(camera.id)
+
+
+@app.get("/api/cameras/{camera_id}/rtsp/status")
+async def get_rtsp_stream_status(
+    camera_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """取得 RTSP 攝影機串流狀態"""
+    camera = await get_rtsp_camera(camera_id, current_user, db)
+    return rtsp_manager.get_status(camera.id)
+
+
+@app.get("/api/cameras/{camera_id}/rtsp/logs", response_class=PlainTextResponse)
+async def get_rtsp_stream_logs(
+    camera_id: int,
+    kb: int = Query(16, ge=1, le=1024),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """取得 RTSP 攝影機日誌最後 kb KB (只讀檔尾, 不讀整個檔案)"""
+    camera = await get_rtsp_camera(camera_id, current_user, db)
+    return await asyncio.to_thread(tail_log, camera.id, kb * 1024)
+
+
+async def request_rtsp_start(camera: Camera) -> dict:
+    """
+    啟動 RTSP 串流: 加入應執行清單, 由 pick_worker 選出的 worker 執行
+
+    分配給本進程時直接啟動並回傳結果, 否則通知其他 worker 重新分配
+    """
+    await state_store.add_rtsp_cameras([camera.id])
+    worker = pick_worker(camera.id, await state_store.live_workers())
+    if worker in (state_store.worker_id, None):
+        return rtsp_manager.start(camera.id, camera.api_key, camera.camera_source)
+    await broadcast_control({"type": "rtsp_rebalance"})
+    return {"success": True, "message": f"已交由 worker {worker} 啟動", "status": "dispatched", "worker": worker}
+
+
+async def request_rtsp_stop(camera_id: int) -> dict:
+    """停止 RTSP 串流: 移出應執行清單, 在本進程執行時直接停止, 否則通知處理中的 worker"""
+    await state_store.remove_rtsp_cameras([camera_id])
+    if camera_id in rtsp_manager.clients or not state_store.shared:
+        return await stop_rtsp(camera_id)
+    await broadcast_control({"type": "rtsp_rebalance"})
+    return {"success": True, "message": "已通知處理中的 worker 停止", "status": "dispatched"}
+
+
+async def stop_rtsp(camera_id: int) -> dict:
+    """
+    停止 RTSP 串流, 等到舊串流的清理完成才返回 (之後可立即重新啟動)
+
+    子進程模式需等待進程結束, 放到執行緒中避免阻塞事件迴圈;
+    內建擷取等待處理工作結束 (離線狀態、事件影片、租約都已處理)
+    """
+    if isinstance(rtsp_manager, RTSPClientManager):
+        return await asyncio.to_thread(rtsp_manager.stop, camera_id)
+    return await rtsp_manager.stop(camera_id)
+
+
+async def stop_all_rtsp():
+    """停止所有 RTSP 串流"""
+    if isinstance(rtsp_manager, RTSPClientManager):
+        rtsp_manager.stop_all()
+    else:
+        await rtsp_manager.stop_all()
+
+
+async def list_rtsp_cameras(current_user: User, db: AsyncSession) -> List[Camera]:
+    return (await db.scalars(select(Camera).filter(
+        Camera.user_id == current_user.id,
+        Camera.camera_type == "rtsp"
+    ))).all()
+
+
+@app.post("/api/rtsp/start-all")
+async def start_all_rtsp_streams(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """啟動用戶所有啟用中的 RTSP 攝影機 (逐台間隔啟動)"""
+    results = {}
+    started = 0
+    for camera in await list_rtsp_cameras(current_user, db):
+        if not camera.is_active:
+            continue
+        if started:
+            await asyncio.sleep(RTSP_AUTOSTART_STAGGER)
+        results[camera.id] = await request_rtsp_start(camera)
+        if results[camera.id]["success"]:
+            started += 1
+    return {"started": started, "results": results}
+
+
+@app.post("/api/rtsp/stop-all")
+async def stop_all_rtsp_streams(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """停止用戶所有 RTSP 攝影機"""
+    results = {}
+    desired = await state_store.rtsp_cameras()
+    for camera in await list_rtsp_cameras(current_user, db):
+        if camera.id in desired or camera.id in rtsp_manager.clients:
+            results[camera.id] = await request_rtsp_stop(camera.id)
+    return {"stopped": sum(1 for r in results.values() if r["success"]), "results": results}
+
+
+@app.get("/api/rtsp/status")
+async def get_all_rtsp_stream_status(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """取得用戶所有 RTSP 攝影機串流狀態"""
+    return {
+        camera.id: {"camera_name": camera.camera_name, **rtsp_manager.get_status(camera.id)}
+        for camera in await list_rtsp_cameras(current_user, db)
+    }
+
+
 # ==================== 偵測記錄 API ====================
 
 from datetime import datetime, timedelta
@@ -433,11 +796,11 @@ async def get_detections(
     end_date: Optional[str] = None,
     limit: int = 50,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """取得偵測記錄（可依攝影機 & 日期區間篩選）"""
 
-    query = db.query(Detection).filter(Detection.user_id == current_user.id)
+    query = select(Detection).filter(Detection.user_id == current_user.id)
     
     # 攝影機篩選
     if camera_id:
@@ -459,12 +822,12 @@ async def get_detections(
             raise HTTPException(status_code=400, detail="end_date 格式錯誤，需為 YYYY-MM-DD")
 
     # 排序 + 限制
-    detections = query.order_by(Detection.timestamp.desc()).limit(limit).all()
+    detections = (await db.scalars(query.order_by(Detection.timestamp.desc()).limit(limit))).all()
     
     # 加入攝影機名稱
     result = []
     for d in detections:
-        camera = db.query(Camera).filter(Camera.id == d.camera_id).first()
+        camera = await db.get(Camera, d.camera_id)
         result.append({
             "id": d.id,
             "timestamp": d.timestamp,
@@ -474,7 +837,8 @@ async def get_detections(
             "has_cigarette": d.has_cigarette,
             "is_smoking": d.is_smoking,
             "confidence": d.confidence,
-            "screenshot_path": d.screenshot_path
+            "screenshot_path": d.screenshot_path,
+            "clip_path": d.clip_path
         })
     
     return result
@@ -484,27 +848,31 @@ async def get_detections(
 @app.get("/api/statistics")
 async def get_statistics(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """取得統計資料"""
     # 總偵測數
-    total = db.query(Detection).filter(Detection.user_id == current_user.id).count()
+    total = await db.scalar(
+        select(func.count(Detection.id)).filter(Detection.user_id == current_user.id)
+    )
     
     # 今日偵測數
     today = datetime.now().date()
-    today_count = db.query(Detection).filter(
+    today_count = await db.scalar(select(func.count(Detection.id)).filter(
         Detection.user_id == current_user.id,
         Detection.timestamp >= today
-    ).count()
+    ))
     
     # 攝影機數量
-    camera_count = db.query(Camera).filter(Camera.user_id == current_user.id).count()
+    camera_count = await db.scalar(
+        select(func.count(Camera.id)).filter(Camera.user_id == current_user.id)
+    )
     
     # 在線攝影機數
-    online_cameras = db.query(Camera).filter(
+    online_cameras = await db.scalar(select(func.count(Camera.id)).filter(
         Camera.user_id == current_user.id,
         Camera.is_online == True
-    ).count()
+    ))
     
     return {
         "total_detections": total,
@@ -523,7 +891,7 @@ from collections import defaultdict
 async def get_detection_trend(
     days: int = 7,  # 預設顯示7天
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """取得偵測趨勢數據"""
     try:
@@ -533,22 +901,21 @@ async def get_detection_trend(
         
         # 查詢每天的偵測數量
         # 使用 SQLAlchemy 的 func 來做日期分組
-        from sqlalchemy import func, cast, Date
-        
-        daily_counts = db.query(
-            cast(Detection.timestamp, Date).label('date'),
+        day = date_column(Detection.timestamp)
+        daily_counts = (await db.execute(select(
+            day.label('date'),
             func.count(Detection.id).label('count')
         ).filter(
             Detection.user_id == current_user.id,
             Detection.timestamp >= start_date,
             Detection.timestamp <= end_date
         ).group_by(
-            cast(Detection.timestamp, Date)
-        ).all()
+            day
+        ))).all()
         
         # 建立日期到數量的映射
         date_count_map = {
-            count.date.strftime('%Y-%m-%d'): count.count 
+            date_key(count.date): count.count 
             for count in daily_counts
         }
         
@@ -565,8 +932,8 @@ async def get_detection_trend(
             current += timedelta(days=1)
         
         # 如果需要，也可以加入吸菸偵測的統計
-        smoking_counts = db.query(
-            cast(Detection.timestamp, Date).label('date'),
+        smoking_counts = (await db.execute(select(
+            day.label('date'),
             func.count(Detection.id).label('count')
         ).filter(
             Detection.user_id == current_user.id,
@@ -574,11 +941,11 @@ async def get_detection_trend(
             Detection.timestamp <= end_date,
             Detection.is_smoking == True  # 只統計吸菸偵測
         ).group_by(
-            cast(Detection.timestamp, Date)
-        ).all()
+            day
+        ))).all()
         
         smoking_count_map = {
-            count.date.strftime('%Y-%m-%d'): count.count 
+            date_key(count.date): count.count 
             for count in smoking_counts
         }
         
@@ -607,16 +974,16 @@ async def get_detection_trend(
 @app.get("/api/detections/hourly-trend")
 async def get_hourly_trend(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """取得今日每小時的偵測趨勢"""
     try:
-        from sqlalchemy import func, extract
+        from sqlalchemy import extract
         
         today = datetime.now().date()
         tomorrow = today + timedelta(days=1)
         
-        hourly_counts = db.query(
+        hourly_counts = (await db.execute(select(
             extract('hour', Detection.timestamp).label('hour'),
             func.count(Detection.id).label('count')
         ).filter(
@@ -625,7 +992,7 @@ async def get_hourly_trend(
             Detection.timestamp < tomorrow
         ).group_by(
             extract('hour', Detection.timestamp)
-        ).all()
+        ))).all()
         
         # 建立小時映射
         hour_count_map = {int(count.hour): count.count for count in hourly_counts}
@@ -646,214 +1013,648 @@ async def get_hourly_trend(
             "success": False,
             "error": str(e)
         }
+# ==================== 即時警報推送 (SSE) ====================
+
+@app.get("/api/alerts/stream")
+async def alert_stream(request: Request, token: str):
+    """儀表板即時警報 (EventSource 無法帶標頭, token 以 query string 傳入)"""
+    async with AsyncSessionLocal() as db:
+        user = await get_user_from_token(token, db)
+    user_id = user.id
+
+    async def stream():
+        subscriber = alert_broker.subscribe(user_id)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), timeout=ALERT_STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    message = ": keepalive\n\n"
+                yield message
+        finally:
+            alert_broker.unsubscribe(user_id, subscriber)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 # ==================== WebSocket 即時串流 (客戶端上傳) ====================
 
 @app.websocket("/ws/upload/{api_key}")
-async def websocket_upload(websocket: WebSocket, api_key: str, db: Session = Depends(get_db)):
+async def websocket_upload(websocket: WebSocket, api_key: str, db: AsyncSession = Depends(get_async_db)):
     """接收客戶端攝影機上傳的影像並進行偵測"""
     await websocket.accept()
     
     # 驗證 API Key
     try:
-        camera = verify_camera_api_key(api_key, db)
+        camera = await verify_camera_api_key(api_key, db)
     except HTTPException:
         await websocket.close(code=1008, reason="無效的 API Key")
         return
     
-    # 更新攝影機狀態
-    camera.is_online = True
-    camera.last_seen = datetime.now()
-    db.commit()
-    
-    print(f"📷 攝影機 [{camera.camera_name}] 已連線")
-    
-    # 🔥 重置追蹤狀態（當攝影機重新連線時）
-    # YOLO 的追蹤器會自動管理，但可以在這裡初始化計數器
-    smoking_frame_counter[camera.id] = 0
+    camera_id = camera.id
+    try:
+        last_seen = await camera_connected(camera, db)
+    except CameraBusyError as e:
+        # 由持有租約的 worker 處理, 客戶端稍後重連
+        await websocket.close(code=1013, reason=str(e))
+        return
+
+    # 公告上傳參數 (解析度 / 幀率 / 編碼), 負載改變時於串流中重新公告
+    session = StreamSession(stream_governor)
     
     try:
+        await send_stream_settings(websocket, session, camera)
+
         while True:
             # 接收 base64 編碼的影像
             data = await websocket.receive_json()
             
             if data.get("type") == "frame":
-                frame_base64 = data.get("data")
-                
-                # 解碼影像
-                img_data = base64.b64decode(frame_base64)
-                np_arr = np.frombuffer(img_data, np.uint8)
-                frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-                
-                # 🔥 執行偵測（自動追蹤）
-                detection_data, annotated_frame = detect_smoking(frame, camera)
-                
-                # 檢查是否偵測到吸菸
-                if detection_data and detection_data["is_smoking"]:
-                    cam_id = camera.id
-                    now = datetime.now()
-
-                    # 初始化該攝影機的計數器
-                    if cam_id not in smoking_frame_counter:
-                        smoking_frame_counter[cam_id] = 0
-                    smoking_frame_counter[cam_id] += 1
-
-                    # 若連續3幀偵測到吸菸才算真正吸菸
-                    if smoking_frame_counter[cam_id] >= DETECTION_STABLE_FRAMES:
-                        # 冷卻時間檢查
-                        last_time = last_detection_time.get(cam_id)
-                        if not last_time or (now - last_time > DETECTION_COOLDOWN):
-                            print(f"⚠️ [{camera.camera_name}] 偵測到穩定吸菸行為！")
-                            
-                            # 🔥 加入追蹤資訊到記錄
-                            smoking_info = detection_data.get("smoking_pairs", [])
-                            if smoking_info:
-                                print(f"   吸菸者 ID: {[p['person_id'] for p in smoking_info]}")
-
-                            if camera.enable_screenshot:
-                                screenshot_path = save_screenshot(annotated_frame, camera, db)
-                                detection_data["screenshot_path"] = screenshot_path
-
-                            save_detection(detection_data, camera, db)
-                            last_detection_time[cam_id] = now
-
-                            await websocket.send_json({
-                                "type": "alert",
-                                "data": detection_data
-                            })
-                            
-                            # 🔥 重置計數器（避免連續觸發）
-                            smoking_frame_counter[cam_id] = 0
-                else:
-                    # 若中斷吸菸，重設計數器
-                    smoking_frame_counter[camera.id] = 0
-                
-                # 回傳偵測結果
-                await websocket.send_json({
-                    "type": "detection_result",
-                    "data": detection_data
-                })
-                
-                # 更新最後上線時間
-                camera.last_seen = datetime.now()
-                db.commit()
+                # 取得最新設定 (PUT /api/cameras/{id} 修改後立即生效)
+                camera = camera_cache.get_live(camera_id) or camera
+                if await handle_upload_frame(websocket, camera, session, data.get("data"), db,
+                                             captured_at=buffered_capture_time(data)):
+                    # 更新最後上線時間 (節流, 避免每幀寫入資料庫)
+                    last_seen = await touch_last_seen(db, camera_id, last_seen)
     
     except WebSocketDisconnect:
-        camera.is_online = False
-        db.commit()
-        
-        # 🔥 清理追蹤狀態
-        if camera.id in smoking_frame_counter:
-            del smoking_frame_counter[camera.id]
-        
+        await set_camera_status(db, camera.id, is_online=False, last_seen=datetime.now())
         print(f"📷 攝影機 [{camera.camera_name}] 已斷線")
 
+    finally:
+        await camera_disconnected(camera)
 
-# ==================== 偵測邏輯 ====================
 
-def detect_smoking(frame, camera: Camera):
-    """執行吸菸偵測（使用追蹤）"""
-    if model is None:
-        return {
-            "has_person": False,
-            "has_cigarette": False,
-            "is_smoking": False,
-            "boxes": [],
-            "max_confidence": 0
-        }, frame
-    
-    results = model.track(
-        frame,
-        conf=camera.confidence_threshold,
-        iou=camera.iou_threshold,
-        persist=True,
-        verbose=False,
-        tracker="botsort.yaml"
-    )
+@app.websocket("/ws/gateway")
+async def websocket_gateway(websocket: WebSocket, db: AsyncSession = Depends(get_async_db)):
+    """
+    邊緣閘道多攝影機上傳 (一條連線傳送多台攝影機的影像)
+
+    1. 客戶端: {"type": "hello", "protocol_version": 1, "api_keys": [...]}
+    2. 伺服器: {"type": "ready", "cameras": {api_key: camera_id}, "rejected": [api_key, ...]},
+       接著每台攝影機一則 {"type": "config", "camera_id": id, "data": {...}}
+    3. 客戶端: {"type": "frame", "camera_id": id, "data": base64}
+       伺服器回應 alert / detection_result / config 皆帶 camera_id
+    """
+    await websocket.accept()
+
+    # 交握: 逐一驗證攝影機 API Key
+    try:
+        hello = await asyncio.wait_for(websocket.receive_json(), timeout=GATEWAY_HELLO_TIMEOUT)
+    except (asyncio.TimeoutError, ValueError, WebSocketDisconnect):
+        await websocket.close(code=1008, reason="需要 hello 訊息")
+        return
+    api_keys = hello.get("api_keys") if hello.get("type") == "hello" else None
+    if not isinstance(api_keys, list) or not api_keys:
+        await websocket.close(code=1008, reason="需要 hello 訊息")
+        return
+
+    streams = {}  # {camera_id: {"camera", "session", "last_seen"}}
+    accepted = {}
+    rejected = []
+    for api_key in api_keys[:GATEWAY_MAX_CAMERAS]:
+        try:
+            camera = await verify_camera_api_key(str(api_key), db)
+        except HTTPException:
+            rejected.append(api_key)
+            continue
+        if camera.id in streams:
+            accepted[api_key] = camera.id
+            continue
+        streams[camera.id] = {"camera": camera, "session": StreamSession(stream_governor)}
+        accepted[api_key] = camera.id
+    rejected.extend(api_keys[GATEWAY_MAX_CAMERAS:])
+
+    if not streams:
+        await websocket.close(code=1008, reason="無效的 API Key")
+        return
+
+    connected = []  # 已取得租約的攝影機 (結束時釋放)
+    try:
+        for camera_id, stream in list(streams.items()):
+            try:
+                stream["last_seen"] = await camera_connected(stream["camera"], db)
+            except CameraBusyError as e:
+                # 由其他 worker 處理中, 視同拒絕 (閘道重連時再試)
+                print(f"⚠️ 閘道: {e}")
+                del streams[camera_id]
+                for api_key in [key for key, cid in accepted.items() if cid == camera_id]:
+                    del accepted[api_key]
+                    rejected.append(api_key)
+                continue
+            connected.append(camera_id)
+        if not streams:
+            await websocket.close(code=1013, reason="攝影機由其他伺服器進程處理中")
+            return
+
+        await websocket.send_json({
+            "type": "ready",
+            "protocol_version": PROTOCOL_VERSION,
+            "cameras": accepted,
+            "rejected": rejected
+        })
+        for camera_id, stream in streams.items():
+            await send_stream_settings(websocket, stream["session"], stream["camera"], camera_id=camera_id)
+
+        while True:
+            data = await websocket.receive_json()
+            if data.get("type") != "frame":
+                continue
+
+            camera_id = data.get("camera_id")
+            stream = streams.get(camera_id)
+            if stream is None:
+                await websocket.send_json({
+                    "type": "error",
+                    "camera_id": camera_id,
+                    "message": "此連線未授權該攝影機"
+                })
+                continue
+
+            camera = stream["camera"] = camera_cache.get_live(camera_id) or stream["camera"]
+            if await handle_upload_frame(websocket, camera, stream["session"], data.get("data"), db,
+                                         captured_at=buffered_capture_time(data), camera_id=camera_id):
+                stream["last_seen"] = await touch_last_seen(db, camera_id, stream["last_seen"])
+
+    except WebSocketDisconnect:
+        for camera_id in connected:
+            await set_camera_status(db, camera_id, is_online=False, last_seen=datetime.now())
+        print(f"📡 閘道已斷線 ({len(connected)} 台攝影機)")
+
+    finally:
+        for camera_id in connected:
+            await camera_disconnected(streams[camera_id]["camera"])
+
+
+async def handle_upload_frame(websocket: WebSocket, camera: CameraConfig, session: StreamSession,
+                              frame_base64: str, db: AsyncSession, captured_at: Optional[datetime] = None,
+                              **tag) -> bool:
+    """
+    處理一張上傳影像並回傳偵測結果 (單一攝影機與閘道連線共用)
+
+    Args:
+        captured_at: 斷線期間暫存、重連後補送的影格的拍攝時間 (即時影格為 None)
+        tag: 附加在回應訊息上的欄位 (閘道連線為 camera_id)
+
+    Returns:
+        是否成功處理 (影像無法解碼時為 False, 並回傳 error 訊息; 閘道上其他攝影機不受影響)
+    """
+    # 解碼影像 (大尺寸影像以 DCT 縮放直接解碼成接近模型輸入的大小)
+    try:
+        img_data = base64.b64decode(frame_base64, validate=True)
+    except (TypeError, ValueError):
+        # 缺少 data 欄位或不是有效的 base64 (binascii.Error 為 ValueError 子類別)
+        img_data = None
+    frame, scale = decode_frame(img_data) if img_data else (None, 1)
+    if frame is None:
+        await websocket.send_json({
+            "type": "error",
+            **tag,
+            "message": "影像資料無法解碼"
+        })
+        return False
+
+    if captured_at is not None:
+        detection_data, is_alert = await process_buffered_frame(camera, frame, img_data, session, captured_at, db,
+                                                                scale=scale)
+    else:
+        detection_data, is_alert = await process_frame(camera, frame, img_data, db, scale=scale)
+
+    if is_alert:
+        await websocket.send_json({
+            "type": "alert",
+            **tag,
+            "data": detection_data
+        })
     
-    result = results[0]
-    boxes = result.boxes
+    # 回傳偵測結果
+    await websocket.send_json({
+        "type": "detection_result",
+        **tag,
+        "data": detection_data
+    })
+
+    await send_stream_settings(websocket, session, camera, **tag)
+    return True
+
+
+def buffered_capture_time(data: dict) -> Optional[datetime]:
+    """客戶端斷線期間暫存、重連後補送的影格 ("buffered": true) 回傳拍攝時間, 即時影格回傳 None"""
+    if not data.get("buffered"):
+        return None
+    try:
+        return datetime.fromtimestamp(float(data["captured_at"]))
+    except (KeyError, TypeError, ValueError, OverflowError, OSError):
+        return datetime.now()
+
+
+async def send_stream_settings(websocket: WebSocket, session: StreamSession, camera: CameraConfig, **tag):
+    """上傳參數有變化時送出 config 訊息"""
+    settings = session.next_settings(camera.detect_mode)
+    if settings is not None:
+        await websocket.send_json({"type": "config", **tag, "data": settings})
+
+
+# ==================== 內建 RTSP 擷取 ====================
+
+async def ingest_camera(camera_id: int, api_key: str, reader: SourceReader):
+    """處理內建擷取引擎解碼的影格 (與 WebSocket 上傳相同流程, 省去 JPEG 編解碼)"""
+    async with AsyncSessionLocal() as db:
+        try:
+            camera = await verify_camera_api_key(api_key, db)
+        except HTTPException:
+            print(f"❌ RTSP 擷取 [Camera {camera_id}]: 無效的 API Key")
+            return
+
+        # 租約仍由其他 worker 持有 (例如接手當機 worker 的攝影機, 舊租約尚未過期): 稍後再試
+        busy = None
+        while True:
+            try:
+                last_seen = await camera_connected(camera, db)
+                break
+            except CameraBusyError as e:
+                if busy is None:
+                    print(f"⚠️ RTSP 擷取 [Camera {camera_id}]: {e}, 稍後重試")
+                busy = reader.error = str(e)
+                await asyncio.sleep(WORKER_HEARTBEAT_SECONDS)
+                if reader.finished:
+                    return
+        if busy is not None and reader.error == busy:
+            reader.error = None
+        try:
+            while True:
+                frame = await reader.next_frame()
+                if frame is None:
+                    break
+                camera = camera_cache.get_live(camera_id) or camera
+                await process_frame(camera, frame, None, db)
+                last_seen = await touch_last_seen(db, camera_id, last_seen)
+        finally:
+            try:
+                await set_camera_status(db, camera_id, is_online=False, last_seen=datetime.now())
+            except Exception as e:
+                print(f"⚠️ 攝影機狀態更新失敗 [Camera {camera_id}]: {e}")
+            print(f"📷 攝影機 [{camera.camera_name}] RTSP 擷取結束")
+            await camera_disconnected(camera)
+
+
+ingest_engine.set_frame_consumer(ingest_camera)
+
+
+# ==================== 每幀處理流程 (WebSocket 上傳與內建擷取共用) ====================
+
+async def camera_connected(camera: CameraConfig, db: AsyncSession) -> datetime:
+    """
+    攝影機開始串流: 取得租約、更新在線狀態、重置計數器、登錄為連線中, 回傳 last_seen
+
+    Raises:
+        CameraBusyError: 攝影機正由其他 worker 處理
+    """
+    owner = await state_store.claim_camera(camera.id)
+    if owner is not None:
+        raise CameraBusyError(camera.id, owner)
+
+    try:
+        # 更新攝影機狀態 (以 UPDATE 直接寫入, 不載入 ORM 物件)
+        last_seen = datetime.now()
+        await set_camera_status(db, camera.id, is_online=True, last_seen=last_seen)
+
+        # 🔥 重置追蹤狀態（當攝影機重新連線時）
+        # YOLO 的追蹤器會自動管理，但可以在這裡初始化計數器
+        await state_store.reset_streak(camera.id)
+    except BaseException:
+        # 後續步驟失敗 (例如資料庫寫入錯誤): 釋放租約, 否則心跳會一直續約到 worker 重啟
+        await state_store.release_camera(camera.id)
+        raise
+
+    print(f"📷 攝影機 [{camera.camera_name}] 已連線")
+    stream_governor.streams += 1
+
+    # 登錄為連線中攝影機, 之後每幀從登錄表讀取最新設定
+    if camera_cache.register(camera):
+        publish_camera_status(camera, is_online=True)
+    return last_seen
+
+
+async def camera_disconnected(camera: CameraConfig):
+    """攝影機停止串流: 清理追蹤狀態與緩衝區, 釋放租約"""
+    stream_governor.streams -= 1
+
+    if camera_cache.unregister(camera.id):
+        publish_camera_status(camera, is_online=False)
+    clip_recorder.remove(camera.id)
+
+    # 🔥 清理追蹤狀態
+    await state_store.reset_streak(camera.id)
+    await state_store.release_camera(camera.id)
+
+
+async def touch_last_seen(db: AsyncSession, camera_id: int, last_seen: datetime) -> datetime:
+    """每 LAST_SEEN_UPDATE_INTERVAL 最多寫入一次最後上線時間"""
+    now = datetime.now()
+    if now - last_seen >= LAST_SEEN_UPDATE_INTERVAL:
+        await set_camera_status(db, camera_id, last_seen=now)
+        return now
+    return last_seen
+
+
+async def process_frame(camera: CameraConfig, frame, jpeg_bytes: Optional[bytes], db: AsyncSession,
+                        scale: int = 1):
+    """
+    處理一幀影像: 偵測、即時轉播、穩定吸菸判斷、截圖 / 影片 / 記錄
+
+    Args:
+        jpeg_bytes: 影格的 JPEG 資料 (事件影片用); 沒有時依需要才編碼
+        scale: frame 相對於 jpeg_bytes 的縮小倍數 (縮小解碼時截圖另外完整解碼)
+
+    Returns:
+        (偵測結果, 是否觸發警報)
+    """
+    cam_id = camera.id
+
+    # 原始 JPEG 放入環狀緩衝區 (事件影片用, 不重新編碼);
+    # 內建擷取的影格沒有 JPEG, 在執行緒中編碼並與偵測同時進行, 不佔用事件迴圈
+    encoding = None
+    if clip_recorder.enabled:
+        if jpeg_bytes is None:
+            encoding = asyncio.ensure_future(asyncio.to_thread(encode_jpeg, frame, CLIP_JPEG_QUALITY))
+        else:
+            clip_recorder.add_frame(cam_id, jpeg_bytes)
     
-    persons = []
-    cigarettes = []
+    # 🔥 執行偵測（自動追蹤）
+    detection_data, result = await detect_frame(camera, frame, scale)
+
+    if encoding is not None:
+        jpeg_bytes = await encoding
+        clip_recorder.add_frame(cam_id, jpeg_bytes)
+
+    # 有人觀看時才繪製偵測框, 編碼一次後分送給所有觀看者
+    annotated_frame = None
+    if live_view.has_viewers(cam_id):
+        annotated_frame = annotate_frame(result, frame, camera, detection_data["boxes"], scale)
+        await live_view.publish(cam_id, annotated_frame)
     
-    # 🔥 動態取得類別名稱（不寫死）
-    for box in boxes:
-        cls = int(box.cls[0])
-        track_id = int(box.id[0]) if box.id is not None else -1
-        x1, y1, x2, y2 = box.xyxy[0].tolist()
-        conf = float(box.conf[0])
-        
-        # 🔥 從模型取得類別名稱
-        class_name = result.names[cls]
-        
-        obj = {
-            "id": track_id,
-            "x1": x1, "y1": y1, "x2": x2, "y2": y2,
-            "confidence": conf,
-            "class": cls,
-            "label": class_name
-        }
-        
-        # 🔥 根據類別名稱判斷（不是根據數字）
-        if class_name.lower() == "person":
-            persons.append(obj)
-        elif class_name.lower() == "cigarette":
-            cigarettes.append(obj)
-    
-    # 判斷吸菸
-    is_smoking = False
-    smoking_pairs = []
-    max_confidence = 0
-    
-    for person in persons:
-        for cigarette in cigarettes:
-            cig_center_x = (cigarette["x1"] + cigarette["x2"]) / 2
-            cig_center_y = (cigarette["y1"] + cigarette["y2"]) / 2
-            
-            p_x1, p_y1, p_x2, p_y2 = person["x1"], person["y1"], person["x2"], person["y2"]
-            
-            margin = 50
-            if (p_x1 - margin <= cig_center_x <= p_x2 + margin and 
-                p_y1 - margin <= cig_center_y <= p_y2 + margin):
-                is_smoking = True
-                smoking_pairs.append({
-                    "person_id": person["id"],
-                    "cigarette_id": cigarette["id"]
-                })
-                
-                max_conf = max(person["confidence"], cigarette["confidence"])
-                if max_conf > max_confidence:
-                    max_confidence = max_conf
-    
-    detection_data = {
-        "has_person": len(persons) > 0,
-        "has_cigarette": len(cigarettes) > 0,
-        "is_smoking": is_smoking,
-        "smoking_pairs": smoking_pairs,
-        "max_confidence": max_confidence,
-        "boxes": persons + cigarettes
-    }
+    # 檢查是否偵測到吸菸
+    if not (detection_data and detection_data["is_smoking"]):
+        # 若中斷吸菸，重設計數器
+        await state_store.reset_streak(cam_id)
+        return detection_data, False
+
+    # 若連續3幀偵測到吸菸才算真正吸菸
+    if await state_store.incr_streak(cam_id) < DETECTION_STABLE_FRAMES:
+        return detection_data, False
+
+    # 冷卻時間檢查 (檢查並記錄為原子操作, 多個 worker 不會重複觸發)
+    if not await state_store.try_alert(cam_id, DETECTION_COOLDOWN.total_seconds()):
+        return detection_data, False
+
+    print(f"⚠️ [{camera.camera_name}] 偵測到穩定吸菸行為！")
     
-    # 繪製偵測框
-    annotated_frame = result.plot()
+    # 🔥 加入追蹤資訊到記錄
+    smoking_info = detection_data.get("smoking_pairs", [])
+    if smoking_info:
+        print(f"   吸菸者 ID: {[p['person_id'] for p in smoking_info]}")
+
+    if camera.enable_screenshot:
+        screenshot_path = capture_screenshot(camera, frame, jpeg_bytes, scale, result, detection_data, db,
+                                             annotated_frame)
+        if screenshot_path:
+            detection_data["screenshot_path"] = screenshot_path
+
+    # 事件前後影片 (事件後影格收集完才寫入檔案)
+    if clip_recorder.enabled:
+        clip_path, clip_file = new_clip_path(cam_id)
+        if clip_recorder.trigger(cam_id, clip_file):
+            detection_data["clip_path"] = clip_path
+
+    await save_detection(detection_data, camera, db)
     
-    return detection_data, annotated_frame
+    # 🔥 重置計數器（避免連續觸發）
+    await state_store.reset_streak(cam_id)
+    return detection_data, True
+
+
+async def process_buffered_frame(camera: CameraConfig, frame, jpeg_bytes: bytes, session: StreamSession,
+                                 captured_at: datetime, db: AsyncSession, scale: int = 1):
+    """
+    處理斷線期間暫存、重連後補送的影格
+
+    不是即時畫面: 不轉播、不放入事件影片緩衝區、不計入連續吸菸幀數, 也不即時警報;
+    偵測到吸菸時以拍攝時間記錄 (同一連線依拍攝時間套用冷卻時間)。
+
+    Returns:
+        (偵測結果, False)
+    """
+    detection_data, result = await detect_frame(camera, frame, scale)
+    if not (detection_data and detection_data["is_smoking"]):
+        return detection_data, False
+
+    last = session.last_buffered_detection
+    if last is not None and abs(captured_at - last) < DETECTION_COOLDOWN:
+        return detection_data, False
+    session.last_buffered_detection = captured_at
+
+    print(f"⚠️ [{camera.camera_name}] 補送影格偵測到吸菸 (拍攝時間 {captured_at:%Y-%m-%d %H:%M:%S})")
+    detection_data["captured_at"] = captured_at.isoformat()
+    if camera.enable_screenshot:
+        screenshot_path = capture_screenshot(camera, frame, jpeg_bytes, scale, result, detection_data, db)
+        if screenshot_path:
+            detection_data["screenshot_path"] = screenshot_path
+    await save_detection(detection_data, camera, db, timestamp=captured_at)
+    return detection_data, False
+
+
+async def detect_frame(camera: CameraConfig, frame, scale: float = 1):
+    """執行偵測並記錄推論時間供上傳幀率協商, 回傳 (偵測結果, YOLO result)"""
+    started = time.perf_counter()
+    if inference_pool.enabled:
+        # 交給攝影機所屬的推論進程 (沒有 YOLO result, 偵測框由座標繪製)
+        detection_data = await inference_pool.detect(
+            camera.id, frame, camera.confidence_threshold, camera.iou_threshold, scale
+        )
+        result = None
+    else:
+        detection_data, result = run_detection(frame, camera, scale=scale)
+    stream_governor.record_frame(time.perf_counter() - started)
+    return detection_data, result
+
+
+def capture_screenshot(camera: CameraConfig, frame, jpeg_bytes: Optional[bytes], scale: int, result,
+                       detection_data: dict, db: AsyncSession, annotated_frame=None) -> Optional[str]:
+    """儲存事件截圖 (annotated_frame 為已繪製的即時畫面, 沒有時另外繪製), 回傳相對路徑"""
+    if scale > 1:
+        # 縮小解碼的影格: 截圖改用完整解析度, 偵測框依原始座標繪製
+        full_frame = decode_full(jpeg_bytes)
+        annotated_frame = draw_detections(full_frame, detection_data["boxes"]) if camera.draw_bbox else full_frame
+    elif annotated_frame is None:
+        annotated_frame = annotate_frame(result, frame, camera, detection_data["boxes"])
+    return save_screenshot(annotated_frame, camera, db)
+
+
+def encode_jpeg(frame, quality: int) -> bytes:
+    """將影像編碼為 JPEG"""
+    _, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    return buffer.tobytes()
+
+
+def publish_camera_status(camera: CameraConfig, is_online: bool):
+    """推送攝影機上線 / 離線事件給儀表板"""
+    alert_broker.publish(camera.user_id, "camera_status", {
+        "camera_id": camera.id,
+        "camera_name": camera.camera_name,
+        "is_online": is_online,
+        "counters": {"online_cameras": 1 if is_online else -1}
+    })
+
+
+async def set_camera_status(db: AsyncSession, camera_id: int, **values):
+    """更新攝影機在線狀態 / 最後上線時間"""
+    await db.execute(update(Camera).where(Camera.id == camera_id).values(**values))
+    await db.commit()
+
+
+# ==================== 即時畫面轉播 (瀏覽器觀看) ====================
+
+async def get_viewable_camera(camera_id: int, token: str):
+    """驗證 token 並確認攝影機屬於該用戶 (使用短暫 session, 不在觀看期間佔用連線)"""
+    async with AsyncSessionLocal() as db:
+        user = await get_user_from_token(token, db)
+        camera = await db.scalar(select(Camera).filter(
+            Camera.id == camera_id,
+            Camera.user_id == user.id
+        ))
+    if not camera:
+        raise HTTPException(status_code=404, detail="攝影機不存在")
+    return camera
+
+
+@app.websocket("/ws/view/{camera_id}")
+async def websocket_view(websocket: WebSocket, camera_id: int, token: str):
+    """觀看攝影機即時畫面 (二進位 JPEG 影格), token 以 query string 傳入"""
+    await websocket.accept()
+    try:
+        await get_viewable_camera(camera_id, token)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=str(e.detail))
+        return
+
+    viewer = live_view.subscribe(camera_id)
+    announce_viewers([camera_id])
+    # 同時監聽客戶端斷線, 攝影機沒有上傳時也能即時清理
+    receiver = asyncio.create_task(websocket.receive())
+    try:
+        while True:
+            sender = asyncio.create_task(viewer.next_frame())
+            done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                sender.cancel()
+                message = receiver.result()
+                if message["type"] == "websocket.disconnect":
+                    break
+                receiver = asyncio.create_task(websocket.receive())
+                continue
+            await websocket.send_bytes(sender.result())
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        receiver.cancel()
+        live_view.unsubscribe(camera_id, viewer)
+
+
+@app.get("/api/cameras/{camera_id}/mjpeg")
+async def camera_mjpeg(camera_id: int, token: str):
+    """觀看攝影機即時畫面 (MJPEG, 可直接放在 <img src>)"""
+    await get_viewable_camera(camera_id, token)
+
+    async def stream():
+        viewer = live_view.subscribe(camera_id)
+        announce_viewers([camera_id])
+        try:
+            while True:
+                jpeg = await viewer.next_frame()
+                yield (
+                    b"--frame\r\nContent-Type: image/jpeg\r\n"
+                    + f"Content-Length: {len(jpeg)}\r\n\r\n".encode()
+                    + jpeg + b"\r\n"
+                )
+        finally:
+            live_view.unsubscribe(camera_id, viewer)
+
+    return StreamingResponse(stream(), media_type="multipart/x-mixed-replace; boundary=frame")
+
+
+@app.get("/api/system/live-view")
+async def get_live_view_stats(current_user: User = Depends(get_current_user)):
+    """取得即時畫面觀看者與跳幀統計"""
+    return live_view.get_stats()
+
 
-def save_screenshot(frame, camera: Camera, db: Session):
-    """儲存截圖"""
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"violation_{camera.id}_{timestamp}.jpg"
-    filepath = SCREENSHOT_DIR / filename
+# ==================== 偵測邏輯 ====================
+
+def annotate_frame(result, frame, camera: CameraConfig, boxes: Optional[List[dict]] = None, scale: float = 1):
+    """
+    繪製偵測框 (draw_bbox 關閉或沒有偵測結果時回傳原圖)
+
+    沒有 YOLO result (推論進程模式) 時依 boxes 座標繪製, scale 為 frame 的縮小倍數
+    """
+    if not camera.draw_bbox:
+        return frame
+    if result is not None:
+        return result.plot()
+    if not boxes:
+        return frame
+    if scale != 1:
+        boxes = [{**box, "x1": box["x1"] / scale, "y1": box["y1"] / scale,
+                  "x2": box["x2"] / scale, "y2": box["y2"] / scale} for box in boxes]
+    return draw_detections(frame, boxes)
+
+
+def draw_detections(frame, boxes: List[dict]):
+    """依偵測結果 (原始座標) 繪製偵測框"""
+    frame = frame.copy()
+    for box in boxes:
+        color = (0, 255, 0) if box["label"].lower() == "person" else (0, 0, 255)
+        p1 = (int(box["x1"]), int(box["y1"]))
+        p2 = (int(box["x2"]), int(box["y2"]))
+        cv2.rectangle(frame, p1, p2, color, 3)
+        cv2.putText(frame, f"{box['label']} {box['confidence']:.2f}", (p1[0], max(p1[1] - 8, 16)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+    return frame
+
+
+def run_detection(frame, camera: CameraConfig, scale: float = 1):
+    """
+    執行吸菸偵測（使用追蹤）, 回傳 (偵測結果, YOLO result)
+
+    scale: frame 為縮小解碼時的倍數, 偵測框座標換算回原始影像尺寸
+    """
+    if model is None:
+        return empty_detection(), None
+    return track_frame(model, frame, camera.confidence_threshold, camera.iou_threshold, scale)
+
+def save_screenshot(frame, camera: CameraConfig, db: AsyncSession):
+    """儲存截圖 (交給背景寫入器, 立即回傳相對路徑; 佇列滿而被丟棄時回傳 None)"""
+    # 依攝影機 / 日期分目錄, 檔名含唯一碼 (同一秒多次警報不會互相覆蓋)
+    relative_path, filepath = new_screenshot_path(camera.id)
     
-    cv2.imwrite(str(filepath), frame)
+    if not screenshot_writer.submit(frame, filepath):
+        return None
     
-    # return str(filepath)
-    return filename
+    return relative_path
 
 
-def save_detection(detection_data, camera: Camera, db: Session):
-    """儲存偵測記錄到資料庫"""
+async def save_detection(detection_data, camera: CameraConfig, db: AsyncSession,
+                         timestamp: Optional[datetime] = None):
+    """儲存偵測記錄到資料庫 (timestamp: 拍攝時間, 預設為現在)"""
     detection = Detection(
+        timestamp=timestamp or datetime.now(),
         user_id=camera.user_id,
         camera_id=camera.id,
         has_person=detection_data["has_person"],
@@ -861,11 +1662,32 @@ def save_detection(detection_data, camera: Camera, db: Session):
         is_smoking=detection_data["is_smoking"],
         confidence=detection_data.get("max_confidence", 0),
         screenshot_path=detection_data.get("screenshot_path"),
+        clip_path=detection_data.get("clip_path"),
         detection_details=json.dumps(detection_data["boxes"])
     )
     
     db.add(detection)
-    db.commit()
+    await db.commit()
+
+    # 推送新記錄與統計增量給儀表板 (格式同 /api/detections)
+    alert_broker.publish(camera.user_id, "detection", {
+        "detection": {
+            "id": detection.id,
+            "timestamp": detection.timestamp.isoformat(),
+            "camera_name": camera.camera_name,
+            "location": camera.location,
+            "has_person": detection.has_person,
+            "has_cigarette": detection.has_cigarette,
+            "is_smoking": detection.is_smoking,
+            "confidence": detection.confidence,
+            "screenshot_path": detection.screenshot_path,
+            "clip_path": detection.clip_path
+        },
+        "counters": {
+            "total_detections": 1,
+            "today_detections": 1 if detection.timestamp.date() == datetime.now().date() else 0
+        }
+    })
 
 
 # ==================== 其他 API ====================
@@ -875,26 +1697,93 @@ async def root():
     return {
         "message": "吸菸監控系統 API v2.0",
         "version": "2.0",
-        "features": ["多用戶支援", "多攝影機管理", "JWT 認證", "MySQL 資料庫"],
+        "features": ["多用戶支援", "多攝影機管理", "JWT 認證", "MySQL / SQLite 資料庫"],
         "endpoints": {
             "auth": "/api/auth/*",
             "cameras": "/api/cameras",
             "detections": "/api/detections",
             "statistics": "/api/statistics",
-            "websocket_upload": "/ws/upload/{api_key}"
+            "websocket_upload": "/ws/upload/{api_key}",
+            "websocket_gateway": "/ws/gateway",
+            "websocket_view": "/ws/view/{camera_id}?token=...",
+            "mjpeg_view": "/api/cameras/{camera_id}/mjpeg?token=...",
+            "rtsp": "/api/cameras/{camera_id}/rtsp/{start|stop|status|logs}, /api/rtsp/*"
         }
     }
 
 
-@app.get("/api/screenshots/{filename}")
-async def get_screenshot(filename: str):
-    """取得截圖"""
-    filepath = SCREENSHOT_DIR / filename
-    if not filepath.exists():
+@app.get("/api/system/screenshot-writer")
+async def get_screenshot_writer_stats(current_user: User = Depends(get_current_user)):
+    """取得截圖背景寫入統計 (佇列長度、丟棄數、寫入延遲)"""
+    return screenshot_writer.get_stats()
+
+
+@app.get("/api/system/clip-recorder")
+async def get_clip_recorder_stats(current_user: User = Depends(get_current_user)):
+    """取得事件影片緩衝區統計 (記憶體用量、已寫入片段數)"""
+    return clip_recorder.get_stats()
+
+
+@app.get("/api/system/streams")
+async def get_stream_stats(current_user: User = Depends(get_current_user)):
+    """取得上傳串流負載 (連線數、平均推論時間、分配幀率)"""
+    return stream_governor.get_stats()
+
+
+@app.get("/api/system/state")
+async def get_state_store_stats(current_user: User = Depends(get_current_user)):
+    """取得攝影機狀態儲存資訊 (後端、worker、持有的攝影機數)"""
+    return state_store.get_stats()
+
+
+@app.get("/api/system/inference")
+async def get_inference_stats(current_user: User = Depends(get_current_user)):
+    """取得推論進程狀態 (每個進程的攝影機數、處理量、重啟次數)"""
+    return inference_pool.get_stats()
+
+
+@app.put("/api/system/inference")
+async def scale_inference_workers(
+    workers: int = Query(..., ge=1),
+    current_user: User = Depends(get_current_active_admin)
+):
+    """調整推論進程數 (攝影機依 ID 重新分配, 只有增減的進程上的攝影機會移動)"""
+    return inference_pool.scale(workers)
+
+
+@app.get("/api/system/rtsp")
+async def get_rtsp_stats(current_user: User = Depends(get_current_user)):
+    """取得 RTSP 擷取統計 (串流數、重啟 / 重連次數)"""
+    return rtsp_manager.get_stats()
+
+
+@app.get("/api/clips/{filename:path}")
+async def get_clip(request: Request, filename: str):
+    """取得吸菸事件前後影片 (MJPEG AVI), 支援 Range"""
+    filepath = resolve_screenshot(filename)
+    if filepath is None or filepath.suffix != ".avi" or not filepath.is_file():
+        raise HTTPException(status_code=404, detail="影片不存在")
+    return await cached_file_response(request, filepath, media_type="video/x-msvideo")
+
+
+@app.get("/api/screenshots/{filename:path}")
+async def get_screenshot(request: Request, filename: str, size: str = "full"):
+    """取得截圖 (size: full 原圖 / thumb 縮圖 / webp), 支援 ETag / 304 / Range"""
+    if size not in SCREENSHOT_SIZES:
+        raise HTTPException(status_code=400, detail=f"size 需為 {', '.join(SCREENSHOT_SIZES)}")
+    # filename 為資料庫中的相對路徑 (camera_x/日期/檔名), 舊資料則只有檔名
+    filepath = resolve_screenshot(filename)
+    if filepath is None or not filepath.is_file():
         raise HTTPException(status_code=404, detail="截圖不存在")
-    return FileResponse(filepath)
+    if size != "full":
+        # 舊截圖沒有縮圖時即時補產生
+        filepath = await asyncio.to_thread(ensure_variant, filepath, size)
+    return await cached_file_response(request, filepath)
 
 
 if __name__ == "__main__":
     import uvicorn
+    if inference_pool.enabled:
+        # 推論進程以 spawn 啟動時會以 __mp_main__ 重新匯入本模組 (整個 web 應用程式)
+        print("⚠️ 推論進程模式請改用: uvicorn server.main:app --host 0.0.0.0 --port 8000")
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,44 +1,46 @@
+import asyncio
 import subprocess
 import sys
 import os
 import time
 from typing import Dict, Optional
 
+from server.backoff import backoff_delay
+from server.camera_logs import get_camera_logger, pump_output, close_camera_log, tail_log, log_path
+from server.config import (
+    RTSP_INGEST_MODE, RTSP_MAX_CONCURRENT_RESTARTS, RTSP_SUPERVISOR_INTERVAL,
+    RTSP_STARTUP_GRACE, RTSP_STABLE_SECONDS
+)
+from server.ingest import ingest_engine
+
 class RTSPClientManager:
+    """
+    管理 camera_client.py 子進程
+
+    監控工作每 RTSP_SUPERVISOR_INTERVAL 秒檢查所有進程, 異常結束的客戶端依指數退避
+    (加抖動) 自動重啟; 同時進行中的重啟最多 RTSP_MAX_CONCURRENT_RESTARTS 個,
+    避免網路恢復時所有攝影機同時重連。正常結束 (exit 0, 例如影片檔播完、API Key
+    被拒絕) 的客戶端不重啟, 狀態為 exited。
+    """
+
     def __init__(self):
         self.clients: Dict[int, dict] = {}
+        self._supervisor: Optional[asyncio.Task] = None
+        self.total_restarts = 0
     
     def start(self, camera_id: int, api_key: str, rtsp_url: str) -> dict:
-        """啟動 RTSP 攝影機客戶端"""
+        """啟動 RTSP 攝影機客戶端 (不等待進程啟動, 由監控工作處理異常結束)"""
         if camera_id in self.clients:
-            old_process = self.clients[camera_id]["process"]
-            if old_process.poll() is not None:
-                # 舊進程已結束，清理
-                try:
-                    self.clients[camera_id]["log_file"].close()
-                except:
-                    pass
-                del self.clients[camera_id]
-            else:
+            if self.clients[camera_id]["state"] != "exited":
                 return {
                     "success": False,
                     "message": "客戶端已在執行中",
-                    "status": "running"
+                    "status": self.clients[camera_id]["state"]
                 }
+            self.stop(camera_id)
 
-
-        
         try:
-            # 建立 logs 目錄
-            os.makedirs("logs", exist_ok=True)
-            log_path = f"logs/camera_{camera_id}.log"
-            
-            # 取得專案根目錄
-            project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            
-            # camera_client.py 路徑
-            client_script = os.path.join(project_root, 'client', 'camera_client.py')
-            
+            client_script = self._client_script()
             # 檢查檔案是否存在
             if not os.path.exists(client_script):
                 print(f"❌ 找不到 camera_client.py: {client_script}")
@@ -47,75 +49,30 @@ class RTSPClientManager:
                     "message": f"找不到 camera_client.py: {client_script}",
                     "status": "error"
                 }
-            
-            # 建立指令（修正參數名稱）
-            cmd = [
-                sys.executable,
-                client_script,
-                '--server', 'ws://localhost:8000',
-                '--api-key', api_key,
-                '--type', 'rtsp',      # ✅ 正確的參數
-                '--source', rtsp_url   # ✅ 正確的參數
-            ]
-            
-            print(f"啟動 RTSP 客戶端 [Camera {camera_id}]")
-            print(f"指令: {' '.join(cmd)}")
-            print(f"日誌: {log_path}")
-            
-            # 啟動子進程
-            log_file = open(log_path, 'w', encoding='utf-8', errors='replace')  # ✅ 加 errors='replace'
-            process = subprocess.Popen(
-                cmd,
-                stdout=log_file,
-                stderr=subprocess.STDOUT,
-                creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
-            )
-            
-            # 等待一下確認進程啟動
-            time.sleep(1)
-            
-            # 檢查進程是否還在執行
-            if process.poll() is not None:
-                log_file.close()
-                
-                # 🔥 修正：讀取日誌時處理編碼錯誤
-                error_log = ""
-                for encoding in ['utf-8', 'cp950', 'gbk', 'latin-1']:
-                    try:
-                        with open(log_path, 'r', encoding=encoding, errors='ignore') as f:
-                            error_log = f.read()
-                        break
-                    except:
-                        continue
-                
-                if not error_log:
-                    error_log = "無法讀取日誌檔案"
-                
-                print(f"camera_client.py 啟動失敗:")
-                print(error_log)
-                return {
-                    "success": False,
-                    "message": "camera_client.py 啟動後立即結束",
-                    "error": error_log,
-                    "status": "crashed"
-                }
-            
-            # 儲存進程資訊
-            self.clients[camera_id] = {
-                "process": process,
-                "log_file": log_file,
+
+            client_info = {
                 "api_key": api_key,
                 "rtsp_url": rtsp_url,
+                "process": None,
+                "state": "starting",
+                "restarts": 0,
+                "failures": 0,           # 連續異常結束次數 (決定退避時間)
+                "last_exit_code": None,
+                "last_error": None,
+                "next_restart": None,
                 "start_time": time.time()
             }
+            self._spawn(camera_id, client_info)
+            self.clients[camera_id] = client_info
+            self._ensure_supervisor()
             
-            print(f"RTSP 客戶端已啟動 [Camera {camera_id}] PID: {process.pid}")
+            print(f"RTSP 客戶端已啟動 [Camera {camera_id}] PID: {client_info['process'].pid}")
             
             return {
                 "success": True,
                 "message": "RTSP 客戶端已啟動",
                 "status": "started",
-                "pid": process.pid
+                "pid": client_info["process"].pid
             }
             
         except Exception as e:
@@ -138,27 +95,9 @@ class RTSPClientManager:
             }
         
         try:
-            client_info = self.clients[camera_id]
-            process = client_info["process"]
-            log_file = client_info["log_file"]
-            
-            # 終止進程
-            process.terminate()
-            
-            # 等待進程結束
-            try:
-                process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                process.kill()
-            
-            # 關閉日誌檔案
-            try:
-                log_file.close()
-            except:
-                pass
-            
-            # 移除客戶端資訊
-            del self.clients[camera_id]
+            # 先移除, 避免監控工作重啟
+            client_info = self.clients.pop(camera_id)
+            self._terminate(camera_id, client_info)
             
             print(f"RTSP 客戶端已停止 [Camera {camera_id}]")
             
@@ -186,25 +125,31 @@ class RTSPClientManager:
         
         client_info = self.clients[camera_id]
         process = client_info["process"]
-        
-        # 檢查進程是否還在執行
-        if process.poll() is not None:
-            # 進程已結束
-            try:
-                client_info["log_file"].close()
-            except:
-                pass
-            del self.clients[camera_id]
-            return {
-                "running": False,
-                "status": "crashed"
-            }
-        
+        running = process is not None and process.poll() is None
+        status = {
+            "running": running,
+            "status": client_info["state"],
+            "restarts": client_info["restarts"],
+            "last_exit_code": client_info["last_exit_code"],
+            "last_error": client_info["last_error"]
+        }
+        if running:
+            status["pid"] = process.pid
+            status["uptime"] = time.time() - client_info["start_time"]
+        if client_info["next_restart"] is not None:
+            status["next_restart_in"] = round(max(0.0, client_info["next_restart"] - time.monotonic()), 1)
+        return status
+
+    def get_stats(self) -> dict:
+        """所有客戶端狀態統計"""
+        states: Dict[str, int] = {}
+        for client_info in self.clients.values():
+            states[client_info["state"]] = states.get(client_info["state"], 0) + 1
         return {
-            "running": True,
-            "status": "running",
-            "pid": process.pid,
-            "uptime": time.time() - client_info["start_time"]
+            "clients": len(self.clients),
+            "states": states,
+            "total_restarts": self.total_restarts,
+            "max_concurrent_restarts": RTSP_MAX_CONCURRENT_RESTARTS
         }
     
     def stop_all(self):
@@ -212,7 +157,141 @@ class RTSPClientManager:
         camera_ids = list(self.clients.keys())
         for camera_id in camera_ids:
             self.stop(camera_id)
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
         print("已停止所有 RTSP 客戶端")
 
-# 建立全域實例
-rtsp_manager = RTSPClientManager()
\ No newline at end of file
+    # ==================== 子進程 ====================
+
+    @staticmethod
+    def _client_script() -> str:
+        # 取得專案根目錄
+        project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return os.path.join(project_root, 'client', 'camera_client.py')
+
+    def _spawn(self, camera_id: int, client_info: dict):
+        """啟動子進程, 輸出經管線寫入輪替日誌 (重啟時附加, 保留異常結束前的輸出)"""
+        # 建立指令 (-u: 不緩衝輸出, 日誌即時寫入)
+        cmd = [
+            sys.executable, '-u',
+            self._client_script(),
+            '--server', 'ws://localhost:8000',
+            '--api-key', client_info["api_key"],
+            '--type', 'rtsp',
+            '--source', client_info["rtsp_url"]
+        ]
+
+        print(f"啟動 RTSP 客戶端 [Camera {camera_id}]")
+        print(f"日誌: {log_path(camera_id)}")
+        if client_info["state"] == "backoff":
+            get_camera_logger(camera_id).info(f"===== 重新啟動 RTSP 客戶端 (第 {client_info['restarts'] + 1} 次重啟) =====")
+        else:
+            get_camera_logger(camera_id).info("===== 啟動 RTSP 客戶端 =====")
+
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+        )
+
+        client_info["process"] = process
+        client_info["log_thread"] = pump_output(camera_id, process.stdout)
+        client_info["spawn_time"] = time.monotonic()
+        client_info["next_restart"] = None
+
+    @staticmethod
+    def _terminate(camera_id: int, client_info: dict):
+        process = client_info["process"]
+        if process is not None and process.poll() is None:
+            # 終止進程
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        RTSPClientManager._drain_log(client_info)
+        close_camera_log(camera_id)
+
+    @staticmethod
+    def _drain_log(client_info: dict, timeout: float = 1.0):
+        """等待輸出執行緒寫完進程結束前的輸出"""
+        log_thread = client_info.pop("log_thread", None)
+        if log_thread is not None:
+            log_thread.join(timeout)
+
+    # ==================== 監控與自動重啟 ====================
+
+    def _ensure_supervisor(self):
+        """啟動監控工作 (需在事件迴圈中呼叫)"""
+        if self._supervisor is None or self._supervisor.done():
+            self._supervisor = asyncio.get_running_loop().create_task(self._supervise())
+
+    async def _supervise(self):
+        while self.clients:
+            try:
+                self._check_clients()
+            except Exception as e:
+                print(f"❌ RTSP 客戶端監控錯誤: {e}")
+            await asyncio.sleep(RTSP_SUPERVISOR_INTERVAL)
+        self._supervisor = None
+
+    def _check_clients(self):
+        now = time.monotonic()
+
+        for camera_id, client_info in list(self.clients.items()):
+            process = client_info["process"]
+            if process is None:
+                continue
+            if process.poll() is None:
+                uptime = now - client_info["spawn_time"]
+                if client_info["state"] in ("starting", "restarting") and uptime >= RTSP_STARTUP_GRACE:
+                    client_info["state"] = "running"
+                # 穩定執行一段時間後重置退避
+                if client_info["failures"] and uptime >= RTSP_STABLE_SECONDS:
+                    client_info["failures"] = 0
+                continue
+
+            self._drain_log(client_info, timeout=0.2)
+            client_info["process"] = None
+            client_info["last_exit_code"] = process.returncode
+            if process.returncode == 0:
+                # 正常結束, 不重啟
+                client_info["state"] = "exited"
+                print(f"RTSP 客戶端已結束 [Camera {camera_id}]")
+                continue
+
+            # 進程異常結束: 排定重啟
+            client_info["last_error"] = tail_log(camera_id, 2000).strip()
+            delay = backoff_delay(client_info["failures"])
+            client_info["failures"] += 1
+            client_info["state"] = "backoff"
+            client_info["next_restart"] = now + delay
+            print(f"⚠️ RTSP 客戶端異常結束 [Camera {camera_id}] (exit {process.returncode}), {delay:.1f} 秒後重啟")
+
+        # 依排定時間重啟, 限制同時進行中的重啟數量
+        in_flight = sum(1 for c in self.clients.values() if c["state"] == "restarting")
+        due = sorted(
+            (c["next_restart"], camera_id) for camera_id, c in self.clients.items()
+            if c["state"] == "backoff" and c["next_restart"] <= now
+        )
+        for _, camera_id in due:
+            if in_flight >= RTSP_MAX_CONCURRENT_RESTARTS:
+                break
+            client_info = self.clients[camera_id]
+            try:
+                self._spawn(camera_id, client_info)
+            except Exception as e:
+                client_info["last_error"] = str(e)
+                client_info["next_restart"] = now + backoff_delay(client_info["failures"])
+                client_info["failures"] += 1
+                print(f"❌ RTSP 客戶端重啟失敗 [Camera {camera_id}]: {e}")
+                continue
+            client_info["state"] = "restarting"
+            client_info["restarts"] += 1
+            self.total_restarts += 1
+            in_flight += 1
+
+# 建立全域實例 (預設使用內建擷取引擎, RTSP_INGEST_MODE=subprocess 時改用子進程)
+rtsp_manager = ingest_engine if RTSP_INGEST_MODE == "inprocess" else RTSPClientManager()
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""
+截圖儲存配置
+
+截圖依攝影機與日期分目錄存放, 檔名加上唯一碼避免同一秒的警報互相覆蓋:
+    screenshots/camera_{camera_id}/{YYYYmmdd}/violation_{camera_id}_{YYYYmmdd_HHMMSS}_{uid}.jpg
+
+資料庫 screenshot_path 存放相對於 SCREENSHOT_DIR 的路徑 (以 / 分隔),
+舊的平面配置 (只有檔名) 仍可解析。
+
+舊截圖搬移到新配置:
+    python -m server.screenshot_storage --migrate
+"""
+
+import re
+import sys
+import uuid
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+from typing import Optional, Tuple
+
+from server.config import SCREENSHOT_DIR
+from server.screenshot_variants import SCREENSHOT_SIZES, variant_path
+
+# 舊平面配置的檔名
+FLAT_NAME_PATTERN = re.compile(r"^violation_(\d+)_(\d{8})_(\d{6})\.jpg$")
+
+
+def shard_dir(camera_id: int, when: datetime) -> PurePosixPath:
+    """取得截圖所屬的分片目錄 (相對路徑)"""
+    return PurePosixPath(f"camera_{camera_id}", when.strftime('%Y%m%d'))
+
+
+def new_screenshot_path(camera_id: int, when: Optional[datetime] = None) -> Tuple[str, Path]:
+    """
+    產生新截圖路徑
+
+    Returns:
+        (存入資料庫的相對路徑, 實際檔案路徑); 目錄由寫入端建立
+    """
+    when = when or datetime.now()
+    filename = f"violation_{camera_id}_{when.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jpg"
+    relative = shard_dir(camera_id, when) / filename
+    return str(relative), SCREENSHOT_DIR / relative
+
+
+def new_clip_path(camera_id: int, when: Optional[datetime] = None) -> Tuple[str, Path]:
+    """產生事件影片路徑 (與截圖同一分片目錄)"""
+    when = when or datetime.now()
+    filename = f"clip_{camera_id}_{when.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.avi"
+    relative = shard_dir(camera_id, when) / filename
+    return str(relative), SCREENSHOT_DIR / relative
+
+
+def resolve_screenshot(relative: str) -> Optional[Path]:
+    """將資料庫中的截圖路徑轉為實際檔案路徑 (拒絕跳出 SCREENSHOT_DIR 的路徑)"""
+    root = SCREENSHOT_DIR.resolve()
+    filepath = (root / relative).resolve()
+    if filepath != root and root not in filepath.parents:
+        return None
+    return filepath
+
+
+def migrate_flat_layout(dry_run: bool = False) -> int:
+    """
+    將舊平面配置的截圖 (含縮圖 / WebP) 搬到分片目錄, 並更新 detections.screenshot_path
+
+    Returns:
+        搬移的截圖數
+    """
+    from server.database import SessionLocal, Detection
+
+    moved = 0
+    db = SessionLocal()
+    try:
+        for filepath in sorted(SCREENSHOT_DIR.glob("violation_*.jpg")):
+            match = FLAT_NAME_PATTERN.match(filepath.name)
+            if not match:
+                continue
+            camera_id, date_str = int(match.group(1)), match.group(2)
+            relative = PurePosixPath(f"camera_{camera_id}", date_str, filepath.name)
+            target = SCREENSHOT_DIR / relative
+            print(f"  {filepath.name} → {relative}")
+            if dry_run:
+                moved += 1
+                continue
+
+            target.parent.mkdir(parents=True, exist_ok=True)
+            for size in SCREENSHOT_SIZES:
+                src = variant_path(filepath, size)
+                if src.exists():
+                    src.replace(variant_path(target, size))
+
+            db.query(Detection).filter(
+                Detection.screenshot_path == filepath.name
+            ).update({Detection.screenshot_path: str(relative)}, synchronize_session=False)
+            db.commit()
+            moved += 1
+    finally:
+        db.close()
+    return moved
+
+
+if __name__ == "__main__":
+    # 用法: python -m server.screenshot_storage --migrate [--dry-run]
+    if "--migrate" not in sys.argv:
+        print("用法: python -m server.screenshot_storage --migrate [--dry-run]")
+        sys.exit(1)
+    dry_run = "--dry-run" in sys.argv
+    print(f"📁 搬移截圖到分片目錄: {SCREENSHOT_DIR}{' (試跑)' if dry_run else ''}")
+    total = migrate_flat_layout(dry_run=dry_run)
+    print(f"✅ 完成, 共 {total} 張截圖")
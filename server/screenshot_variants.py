@@ -0,0 +1,125 @@
+"""
+截圖多解析度版本
+
+每張截圖除了原圖外, 另外產生:
+- thumb: 縮圖 JPEG ({stem}_thumb.jpg), 給偵測記錄列表預覽使用
+- webp:  原尺寸 WebP ({stem}.webp), 檔案較小 (SCREENSHOT_WEBP 開啟時才產生)
+
+舊截圖可用以下指令補產生:
+    python -m server.screenshot_variants
+"""
+
+import os
+import sys
+from pathlib import Path
+from typing import Optional
+
+import cv2
+
+from server.config import (
+    SCREENSHOT_DIR, SCREENSHOT_THUMB_WIDTH, SCREENSHOT_THUMB_QUALITY,
+    SCREENSHOT_WEBP, SCREENSHOT_WEBP_QUALITY
+)
+
+SCREENSHOT_SIZES = ("full", "thumb", "webp")
+
+
+def variant_path(filepath: Path, size: str) -> Path:
+    """取得指定版本的檔案路徑 (full 即原圖)"""
+    filepath = Path(filepath)
+    if size == "thumb":
+        return filepath.with_name(f"{filepath.stem}_thumb.jpg")
+    if size == "webp":
+        return filepath.with_suffix(".webp")
+    return filepath
+
+
+def is_variant(filepath: Path) -> bool:
+    """是否為衍生版本檔案 (非原圖)"""
+    filepath = Path(filepath)
+    return filepath.suffix == ".webp" or filepath.stem.endswith("_thumb")
+
+
+def _atomic_write(filepath: Path, data: bytes):
+    tmp_path = filepath.with_name(filepath.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, filepath)
+
+
+def make_thumbnail(frame, width: int = SCREENSHOT_THUMB_WIDTH):
+    """等比例縮小影像 (寬度小於 width 則不放大)"""
+    h, w = frame.shape[:2]
+    if w <= width:
+        return frame
+    height = max(1, round(h * width / w))
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def write_variant(frame, filepath: Path, size: str) -> Optional[Path]:
+    """由影像產生單一版本並寫入, 回傳寫入的路徑"""
+    target = variant_path(filepath, size)
+    if size == "thumb":
+        ok, buffer = cv2.imencode('.jpg', make_thumbnail(frame), [int(cv2.IMWRITE_JPEG_QUALITY), SCREENSHOT_THUMB_QUALITY])
+    elif size == "webp":
+        ok, buffer = cv2.imencode('.webp', frame, [int(cv2.IMWRITE_WEBP_QUALITY), SCREENSHOT_WEBP_QUALITY])
+    else:
+        return None
+    if not ok:
+        raise RuntimeError(f"{size} 編碼失敗")
+    _atomic_write(target, buffer.tobytes())
+    return target
+
+
+def write_variants(frame, filepath: Path):
+    """產生所有啟用的衍生版本 (縮圖一定產生, WebP 依設定)"""
+    write_variant(frame, filepath, "thumb")
+    if SCREENSHOT_WEBP:
+        write_variant(frame, filepath, "webp")
+
+
+def ensure_variant(filepath: Path, size: str) -> Path:
+    """
+    取得指定版本, 不存在時從原圖補產生
+
+    產生失敗時回傳原圖路徑
+    """
+    target = variant_path(filepath, size)
+    if size == "full" or target.exists():
+        return target
+    frame = cv2.imread(str(filepath), cv2.IMREAD_COLOR)
+    if frame is None:
+        return filepath
+    try:
+        return write_variant(frame, filepath, size)
+    except Exception as e:
+        print(f"⚠️ 產生 {size} 版本失敗 [{Path(filepath).name}]: {e}")
+        return filepath
+
+
+def backfill(directory: Path = SCREENSHOT_DIR, overwrite: bool = False) -> int:
+    """為既有截圖補產生衍生版本, 回傳處理的檔案數"""
+    count = 0
+    for filepath in sorted(Path(directory).rglob("*.jpg")):
+        if is_variant(filepath):
+            continue
+        sizes = ["thumb"] + (["webp"] if SCREENSHOT_WEBP else [])
+        missing = [s for s in sizes if overwrite or not variant_path(filepath, s).exists()]
+        if not missing:
+            continue
+        frame = cv2.imread(str(filepath), cv2.IMREAD_COLOR)
+        if frame is None:
+            print(f"⚠️ 無法讀取: {filepath}")
+            continue
+        for size in missing:
+            write_variant(frame, filepath, size)
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    # 用法: python -m server.screenshot_variants [--overwrite]
+    overwrite = "--overwrite" in sys.argv
+    print(f"🖼️  補產生截圖縮圖: {SCREENSHOT_DIR}")
+    total = backfill(SCREENSHOT_DIR, overwrite=overwrite)
+    print(f"✅ 完成, 共處理 {total} 張截圖")
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import cv2
+
+from server.screenshot_variants import write_variants
+from server.config import (
+    SCREENSHOT_WRITER_THREADS, SCREENSHOT_QUEUE_SIZE,
+    SCREENSHOT_QUEUE_OVERFLOW, SCREENSHOT_JPEG_QUALITY
+)
+
+
+class ScreenshotWriter:
+    """
+    背景截圖寫入器
+
+    截圖的 JPEG 編碼與寫檔交給背景執行緒處理, WebSocket 迴圈只需把影像放入佇列,
+    警報不必等待磁碟。佇列有上限, 滿了之後依 overflow 設定處理:
+    - "sync": 改交給預設執行緒池寫入 (不遺失證據, 也不阻塞事件迴圈)
+    - "drop": 直接丟棄這張截圖
+    """
+
+    def __init__(self, threads: int = SCREENSHOT_WRITER_THREADS, max_queue: int = SCREENSHOT_QUEUE_SIZE,
+                 overflow: str = SCREENSHOT_QUEUE_OVERFLOW, jpeg_quality: int = SCREENSHOT_JPEG_QUALITY):
+        self.threads = max(1, threads)
+        self.overflow = overflow
+        self.jpeg_quality = jpeg_quality
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._workers: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._overflow_done = threading.Condition(self._lock)
+        self._overflow_pending = 0  # 交給執行緒池、尚未寫完的截圖數
+        self._stats = {
+            "submitted": 0,
+            "written": 0,
+            "failed": 0,
+            "dropped": 0,
+            "sync_writes": 0,
+            "total_write_ms": 0.0,
+            "max_write_ms": 0.0,
+            "total_wait_ms": 0.0,
+        }
+
+    def start(self):
+        """啟動背景寫入執行緒"""
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.threads):
+                worker = threading.Thread(target=self._run, name=f"screenshot-writer-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def stop(self, timeout: float = 10.0):
+        """寫完佇列中 (與佇列滿時交給執行緒池) 的截圖後停止"""
+        with self._lock:
+            workers = self._workers
+            self._workers = []
+        for _ in workers:
+            self._queue.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        with self._overflow_done:
+            self._overflow_done.wait_for(lambda: not self._overflow_pending, max(0.0, deadline - time.monotonic()))
+
+    def submit(self, frame, filepath: Path) -> bool:
+        """
+        將截圖放入寫入佇列 (立即返回)
+
+        Returns:
+            True 表示截圖會被寫入 (佇列或執行緒池), False 表示因佇列滿被丟棄
+        """
+        if not self._workers:
+            self.start()
+        self._count("submitted")
+        try:
+            self._queue.put_nowait((frame, Path(filepath), time.perf_counter()))
+            return True
+        except queue.Full:
+            if self.overflow == "drop":
+                self._count("dropped")
+                print(f"⚠️ 截圖佇列已滿, 丟棄截圖: {Path(filepath).name}")
+                return False
+            self._count("sync_writes")
+            self._write_overflow(frame, Path(filepath))
+            return True
+
+    def get_stats(self) -> Dict:
+        """取得寫入統計 (佇列長度、寫入延遲等)"""
+        with self._lock:
+            stats = dict(self._stats)
+        done = stats["written"] + stats["failed"]
+        stats["queue_size"] = self._queue.qsize()
+        stats["queue_capacity"] = self._queue.maxsize
+        stats["threads"] = len(self._workers)
+        stats["avg_write_ms"] = round(stats["total_write_ms"] / done, 2) if done else 0.0
+        stats["avg_wait_ms"] = round(stats["total_wait_ms"] / done, 2) if done else 0.0
+        stats["max_write_ms"] = round(stats["max_write_ms"], 2)
+        del stats["total_write_ms"], stats["total_wait_ms"]
+        return stats
+
+    def _write_overflow(self, frame, filepath: Path):
+        """佇列已滿: 在事件迴圈中改交給預設執行緒池, 不在迴圈上寫檔 (其他執行緒呼叫時直接寫入)"""
+        queued_at = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(frame, filepath, queued_at)
+            return
+
+        with self._lock:
+            self._overflow_pending += 1
+
+        def write():
+            try:
+                self._write(frame, filepath, queued_at)
+            finally:
+                with self._overflow_done:
+                    self._overflow_pending -= 1
+                    self._overflow_done.notify_all()
+
+        loop.run_in_executor(None, write)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, frame, filepath: Path, queued_at: float):
+        """編碼並寫入截圖與縮圖 (先寫暫存檔再改名, 避免讀到寫一半的檔案)"""
+        started = time.perf_counter()
+        ok = False
+        try:
+            success, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality])
+            if not success:
+                raise RuntimeError("JPEG 編碼失敗")
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = filepath.with_name(filepath.name + ".tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(buffer.tobytes())
+            os.replace(tmp_path, filepath)
+            ok = True
+        except Exception as e:
+            print(f"❌ 截圖寫入失敗 [{filepath.name}]: {e}")
+
+        if ok:
+            try:
+                write_variants(frame, filepath)
+            except Exception as e:
+                print(f"⚠️ 截圖縮圖產生失敗 [{filepath.name}]: {e}")
+        finished = time.perf_counter()
+
+        with self._lock:
+            self._stats["written" if ok else "failed"] += 1
+            write_ms = (finished - started) * 1000
+            self._stats["total_write_ms"] += write_ms
+            self._stats["max_write_ms"] = max(self._stats["max_write_ms"], write_ms)
+            self._stats["total_wait_ms"] += (started - queued_at) * 1000
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+
+# 建立全域實例
+screenshot_writer = ScreenshotWriter()
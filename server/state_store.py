@@ -0,0 +1,331 @@
+"""
+攝影機執行狀態儲存
+
+連續吸菸幀數、警報冷卻時間、攝影機由哪個工作進程處理 (租約) 原本是 main.py 的全域 dict,
+只能跑單一 uvicorn worker。改為經由 state_store 存取:
+
+- memory: 進程內 dict (單一 worker, 預設)
+- redis:  Redis 相容伺服器 (Redis / Valkey / KeyDB ...), 多個 worker 或多台主機共用
+
+黏著路由: 攝影機連線時取得租約 (camera:{id}:owner = WORKER_ID, CAMERA_LEASE_SECONDS 過期),
+連線期間由同一個 worker 處理 (YOLO 追蹤器、事件影片緩衝區、即時畫面都在該進程);
+其他 worker 收到同一台攝影機的連線時拒絕, 由客戶端退避重連。
+內建 RTSP 擷取: 應執行的攝影機存放在共用集合 (rtsp_cameras), 每個 worker 定期依
+pick_worker (rendezvous hashing) 與存活中的 worker 比對, 啟動分配給自己的、停止不再屬於自己的。
+
+跨 worker 事件使用 Redis pub/sub 轉送 (每個 worker 包含自己都會收到):
+- alerts:  警報推送 (SSE), 儀表板連到任一 worker 都收得到
+- control: 攝影機設定變更 / 刪除、RTSP 擷取重新分配
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Union
+
+from server.config import (
+    STATE_STORE, REDIS_URL, STATE_KEY_PREFIX, WORKER_ID, CAMERA_LEASE_SECONDS, WORKER_HEARTBEAT_SECONDS
+)
+
+
+# 頻道訊息處理函式 (可為協程, 依收到的順序逐一處理)
+MessageHandler = Callable[[dict], Union[None, Awaitable[None]]]
+
+
+class CameraBusyError(Exception):
+    """攝影機正由其他工作進程處理"""
+
+    def __init__(self, camera_id: int, owner: str):
+        super().__init__(f"攝影機 {camera_id} 由 {owner} 處理中")
+        self.camera_id = camera_id
+        self.owner = owner
+
+
+def pick_worker(camera_id: int, workers: List[str]) -> Optional[str]:
+    """
+    依 rendezvous hashing 選出攝影機所屬的 worker
+
+    worker 增減時只有屬於該 worker 的攝影機會移動; 使用 blake2b (Python 內建 hash 每個進程不同)。
+    """
+    if not workers:
+        return None
+    return max(workers, key=lambda worker: hashlib.blake2b(f"{worker}:{camera_id}".encode(), digest_size=8).digest())
+
+
+class MemoryStateStore:
+    """進程內狀態 (單一 worker)"""
+
+    shared = False
+
+    def __init__(self, worker_id: str = WORKER_ID):
+        self.worker_id = worker_id
+        self.streaks: Dict[int, int] = {}        # {camera_id: 目前連續吸菸幀數}
+        self.last_alert: Dict[int, float] = {}   # {camera_id: 上次警報時間 (monotonic)}
+        self.owned: Dict[int, int] = {}          # {camera_id: 本進程的連線數} (同 RedisStateStore.owned)
+        self.rtsp: Set[int] = set()              # 應執行的內建 RTSP 擷取
+
+    async def incr_streak(self, camera_id: int) -> int:
+        """連續吸菸幀數加一並回傳"""
+        self.streaks[camera_id] = self.streaks.get(camera_id, 0) + 1
+        return self.streaks[camera_id]
+
+    async def reset_streak(self, camera_id: int):
+        self.streaks.pop(camera_id, None)
+
+    async def try_alert(self, camera_id: int, cooldown: float) -> bool:
+        """冷卻時間已過則記錄本次警報並回傳 True"""
+        now = time.monotonic()
+        last = self.last_alert.get(camera_id)
+        if last is not None and now - last <= cooldown:
+            return False
+        self.last_alert[camera_id] = now
+        return True
+
+    async def claim_camera(self, camera_id: int) -> Optional[str]:
+        """取得 / 延長攝影機租約, 成功回傳 None, 否則回傳目前的處理者 (單一進程一定成功)"""
+        self.owned[camera_id] = self.owned.get(camera_id, 0) + 1
+        return None
+
+    async def release_camera(self, camera_id: int):
+        """連線結束 (同一台攝影機沒有其他連線時才釋放)"""
+        count = self.owned.get(camera_id, 0) - 1
+        if count > 0:
+            self.owned[camera_id] = count
+            return
+        self.owned.pop(camera_id, None)
+
+    async def live_workers(self) -> List[str]:
+        return [self.worker_id]
+
+    async def add_rtsp_cameras(self, camera_ids: Iterable[int]):
+        """加入應執行的內建 RTSP 擷取"""
+        self.rtsp.update(camera_ids)
+
+    async def remove_rtsp_cameras(self, camera_ids: Iterable[int]):
+        self.rtsp.difference_update(camera_ids)
+
+    async def rtsp_cameras(self) -> Set[int]:
+        return set(self.rtsp)
+
+    async def run_heartbeat(self):
+        """單一進程不需要心跳"""
+
+    def publish(self, channel: str, message: dict) -> bool:
+        """跨 worker 轉送事件 (單一進程由呼叫端直接在本地處理, 回傳 False)"""
+        return False
+
+    async def listen(self, handlers: Dict[str, MessageHandler]):
+        """接收其他 worker 的事件 (單一進程不需要)"""
+
+    async def close(self):
+        self.owned.clear()
+
+    def get_stats(self) -> Dict:
+        return {
+            "backend": "memory",
+            "worker_id": self.worker_id,
+            "cameras": len(self.owned),
+            "streaks": sum(1 for count in self.streaks.values() if count),
+        }
+
+
+class RedisStateStore:
+    """
+    Redis 相容伺服器上的共用狀態
+
+    鍵值 (前綴 STATE_KEY_PREFIX):
+        camera:{id}:streak   連續吸菸幀數 (INCR)
+        camera:{id}:alert    冷卻中標記 (SET NX PX, 過期即可再次警報)
+        camera:{id}:owner    處理中的 worker (租約)
+        worker:{id}          worker 心跳
+        rtsp:cameras         應執行的內建 RTSP 擷取 (攝影機 ID 集合)
+        alerts / control     pub/sub 頻道
+    """
+
+    shared = True
+
+    def __init__(self, url: str = REDIS_URL, worker_id: str = WORKER_ID, prefix: str = STATE_KEY_PREFIX,
+                 lease_seconds: float = CAMERA_LEASE_SECONDS, heartbeat_seconds: float = WORKER_HEARTBEAT_SECONDS,
+                 client=None):
+        """
+        Args:
+            client: 已建立的 redis.asyncio 相容客戶端 (例如測試用的 fakeredis, 需 decode_responses=True),
+                    未提供時依 url 建立
+        """
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError as e:
+                raise RuntimeError("STATE_STORE=redis 需要安裝 redis 套件: pip install redis") from e
+            client = redis.from_url(url, decode_responses=True)
+        self.redis = client
+        self.worker_id = worker_id
+        self.prefix = prefix
+        self.lease_ms = int(lease_seconds * 1000)
+        self.heartbeat_seconds = heartbeat_seconds
+        # 本進程持有的攝影機與已知的連續幀數 (持有租約期間只有本進程寫入,
+        # 未偵測到吸菸時不必每幀都送 DEL)
+        self.owned: Dict[int, int] = {}  # {camera_id: 本進程的連線數}
+        self._streaks: Dict[int, int] = {}
+        self.errors = 0
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ":".join(str(part) for part in parts)
+
+    async def incr_streak(self, camera_id: int) -> int:
+        key = self._key("camera", camera_id, "streak")
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.incr(key)
+            pipe.pexpire(key, self.lease_ms)
+            count, _ = await pipe.execute()
+        self._streaks[camera_id] = count
+        return count
+
+    async def reset_streak(self, camera_id: int):
+        if self._streaks.get(camera_id, -1) == 0:
+            return
+        await self.redis.delete(self._key("camera", camera_id, "streak"))
+        self._streaks[camera_id] = 0
+
+    async def try_alert(self, camera_id: int, cooldown: float) -> bool:
+        """以 SET NX 原子地檢查並記錄冷卻 (多個 worker 同時觸發只有一個成功)"""
+        key = self._key("camera", camera_id, "alert")
+        return bool(await self.redis.set(key, self.worker_id, nx=True, px=max(1, int(cooldown * 1000))))
+
+    async def claim_camera(self, camera_id: int) -> Optional[str]:
+        owner = await self._acquire(camera_id)
+        if owner is None:
+            self.owned[camera_id] = self.owned.get(camera_id, 0) + 1
+        return owner
+
+    async def _acquire(self, camera_id: int) -> Optional[str]:
+        """取得或延長租約 (SET NX PX), 被其他 worker 持有時回傳持有者"""
+        key = self._key("camera", camera_id, "owner")
+        if await self.redis.set(key, self.worker_id, nx=True, px=self.lease_ms):
+            self._streaks.pop(camera_id, None)
+            return None
+        owner = await self.redis.get(key)
+        if owner == self.worker_id:
+            await self.redis.pexpire(key, self.lease_ms)
+            return None
+        if owner is None:
+            # 租約剛好過期, 重新搶一次
+            return await self._acquire(camera_id)
+        return owner
+
+    async def release_camera(self, camera_id: int):
+        """連線結束 (同一台攝影機在本進程沒有其他連線時才釋放租約)"""
+        count = self.owned.get(camera_id, 0) - 1
+        if count > 0:
+            self.owned[camera_id] = count
+            return
+        self.owned.pop(camera_id, None)
+        self._streaks.pop(camera_id, None)
+        key = self._key("camera", camera_id, "owner")
+        # 只刪除自己的租約 (GET 與 DEL 之間租約不會過期轉手: 持有者仍在續約)
+        if await self.redis.get(key) == self.worker_id:
+            await self.redis.delete(key)
+
+    async def live_workers(self) -> List[str]:
+        prefix = self._key("worker", "")
+        return sorted([key[len(prefix):] async for key in self.redis.scan_iter(match=prefix + "*")])
+
+    async def add_rtsp_cameras(self, camera_ids: Iterable[int]):
+        camera_ids = list(camera_ids)
+        if camera_ids:
+            await self.redis.sadd(self._key("rtsp", "cameras"), *camera_ids)
+
+    async def remove_rtsp_cameras(self, camera_ids: Iterable[int]):
+        camera_ids = list(camera_ids)
+        if camera_ids:
+            await self.redis.srem(self._key("rtsp", "cameras"), *camera_ids)
+
+    async def rtsp_cameras(self) -> Set[int]:
+        return {int(camera_id) for camera_id in await self.redis.smembers(self._key("rtsp", "cameras"))}
+
+    async def run_heartbeat(self):
+        """定期登錄 worker 心跳並延長持有中的攝影機租約"""
+        key = self._key("worker", self.worker_id)
+        ttl_ms = int(self.heartbeat_seconds * 3 * 1000)
+        while True:
+            try:
+                await self.redis.set(key, int(time.time()), px=ttl_ms)
+                for camera_id in list(self.owned):
+                    owner = await self._acquire(camera_id)
+                    if owner is not None:
+                        print(f"⚠️ 攝影機 {camera_id} 的租約已轉給 {owner}")
+                        self.owned.pop(camera_id, None)
+            except Exception as e:
+                self.errors += 1
+                print(f"⚠️ 狀態儲存心跳失敗: {e}")
+            await asyncio.sleep(self.heartbeat_seconds)
+
+    def publish(self, channel: str, message: dict) -> bool:
+        """送到頻道, 由每個 worker (包含自己) 處理"""
+        asyncio.get_running_loop().create_task(self._publish(channel, message))
+        return True
+
+    async def _publish(self, channel: str, message: dict):
+        try:
+            await self.redis.publish(self._key(channel), json.dumps(message, ensure_ascii=False, default=str))
+        except Exception as e:
+            self.errors += 1
+            print(f"⚠️ 事件轉送失敗 ({channel}): {e}")
+
+    async def listen(self, handlers: Dict[str, MessageHandler]):
+        """訂閱頻道 {頻道: 處理函式} (連線中斷時重新訂閱)"""
+        channels = {self._key(channel): handler for channel, handler in handlers.items()}
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(*channels)
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        await self._dispatch(channels[message["channel"]], message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                print(f"⚠️ 事件訂閱中斷: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def _dispatch(self, handler: MessageHandler, data: str):
+        """處理一則訊息 (處理失敗不中斷訂閱)"""
+        try:
+            result = handler(json.loads(data))
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            self.errors += 1
+            print(f"⚠️ 事件處理失敗: {e}")
+
+    async def close(self):
+        """釋放持有的租約並登出 worker"""
+        for camera_id in list(self.owned):
+            self.owned[camera_id] = 1
+            await self.release_camera(camera_id)
+        await self.redis.delete(self._key("worker", self.worker_id))
+        await self.redis.aclose()
+
+    def get_stats(self) -> Dict:
+        return {
+            "backend": "redis",
+            "worker_id": self.worker_id,
+            "cameras": len(self.owned),
+            "streaks": sum(1 for count in self._streaks.values() if count),
+            "errors": self.errors,
+        }
+
+
+def create_state_store():
+    """依 STATE_STORE 設定建立狀態儲存"""
+    if STATE_STORE == "redis":
+        return RedisStateStore()
+    return MemoryStateStore()
+
+
+# 建立全域實例
+state_store = create_state_store()
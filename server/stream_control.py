@@ -0,0 +1,104 @@
+"""
+串流參數協商
+
+攝影機連線 /ws/upload 後, 伺服器先送出 config 訊息公告上傳參數:
+    {"type": "config", "data": {
+        "protocol_version": 1,
+        "model_input_size": 640,   # 模型輸入尺寸
+        "max_size": 640,           # 上傳影像長邊上限
+        "max_fps": 15,             # 最高上傳幀率
+        "encoding": "jpeg"
+    }}
+
+串流期間伺服器負載改變 (或攝影機偵測模式變更) 時, 會再送出新的 config 訊息,
+客戶端從下一幀起依新參數上傳, 讓伺服器從來源減少負載, 而不是收下影像後再丟棄。
+
+負載估算: 偵測在事件迴圈中依序執行, 所有攝影機共用推論時間;
+可承受的總幀率 ≈ STREAM_TARGET_UTILIZATION / 平均每幀處理時間, 平均分給連線中的攝影機。
+使用推論進程 (inference_pool) 時再乘上可用的進程數 (parallelism)。
+"""
+
+from datetime import datetime
+from typing import Dict, Optional
+
+from server.config import (
+    MODEL_INPUT_SIZE, STREAM_MAX_FPS, STREAM_LOW_POWER_FPS, STREAM_MIN_FPS,
+    STREAM_TARGET_UTILIZATION
+)
+
+PROTOCOL_VERSION = 1
+STREAM_ENCODING = "jpeg"
+
+
+class StreamGovernor:
+    """依推論時間與連線數計算每台攝影機的上傳幀率"""
+
+    def __init__(self, target_utilization: float = STREAM_TARGET_UTILIZATION, alpha: float = 0.1):
+        self.target_utilization = target_utilization
+        self.alpha = alpha
+        self.avg_frame_seconds: Optional[float] = None
+        self.streams = 0
+        self.parallelism = 1  # 可同時推論的進程數
+
+    def record_frame(self, seconds: float):
+        """記錄一幀的處理時間 (指數移動平均)"""
+        if self.avg_frame_seconds is None:
+            self.avg_frame_seconds = seconds
+        else:
+            self.avg_frame_seconds += self.alpha * (seconds - self.avg_frame_seconds)
+
+    def desired_fps(self, detect_mode: str) -> float:
+        """攝影機設定要求的幀率"""
+        return STREAM_LOW_POWER_FPS if detect_mode == "low_power" else STREAM_MAX_FPS
+
+    def fps_for(self, detect_mode: str) -> float:
+        """目前負載下分配給單一攝影機的幀率"""
+        fps = self.desired_fps(detect_mode)
+        if self.avg_frame_seconds and self.streams:
+            capacity = self.target_utilization * self.parallelism / self.avg_frame_seconds / self.streams
+            fps = min(fps, capacity)
+        return max(STREAM_MIN_FPS, round(fps, 1))
+
+    def get_stats(self) -> Dict:
+        return {
+            "streams": self.streams,
+            "parallelism": self.parallelism,
+            "avg_frame_ms": round(self.avg_frame_seconds * 1000, 2) if self.avg_frame_seconds else None,
+            "fps_per_stream": self.fps_for("real_time"),
+        }
+
+
+def stream_settings(detect_mode: str, max_fps: float) -> Dict:
+    """組成 config 訊息內容"""
+    return {
+        "protocol_version": PROTOCOL_VERSION,
+        "model_input_size": MODEL_INPUT_SIZE,
+        "max_size": MODEL_INPUT_SIZE,
+        "max_fps": max_fps,
+        "encoding": STREAM_ENCODING,
+        "detect_mode": detect_mode,
+    }
+
+
+class StreamSession:
+    """單一上傳連線目前公告的參數 (變化明顯時才重新公告)"""
+
+    def __init__(self, governor: StreamGovernor):
+        self.governor = governor
+        self.settings: Optional[Dict] = None
+        self.last_buffered_detection: Optional[datetime] = None  # 補送影格上次記錄吸菸的拍攝時間
+
+    def next_settings(self, detect_mode: str) -> Optional[Dict]:
+        """回傳需要送給客戶端的新參數, 不需更新時回傳 None"""
+        max_fps = self.governor.fps_for(detect_mode)
+        current = self.settings
+        if current is not None and current["detect_mode"] == detect_mode:
+            # 幀率變化小於 20% 不重新公告, 避免頻繁來回調整
+            if abs(max_fps - current["max_fps"]) < max(1.0, current["max_fps"] * 0.2):
+                return None
+        self.settings = stream_settings(detect_mode, max_fps)
+        return self.settings
+
+
+# 建立全域實例
+stream_governor = StreamGovernor()
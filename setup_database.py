@@ -14,12 +14,19 @@ sys.path.insert(0, str(Path(__file__).parent))
 
 from server.database import Base, engine, SessionLocal, User
 from server.auth import get_password_hash
-import pymysql
-from server.config import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME
+from server.config import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, IS_SQLITE, SQLITE_PATH
 
 def create_database():
     """建立資料庫"""
+    if IS_SQLITE:
+        # SQLite 檔案會在第一次連線時自動建立
+        print(f"✅ 使用 SQLite 資料庫: {SQLITE_PATH}")
+        return True
+
     try:
+        import pymysql
+
+
         # 連線到 MySQL (不指定資料庫)
         connection = pymysql.connect(
             host=DB_HOST,
@@ -100,10 +107,14 @@ def main():
     print("=" * 60)
     
     print(f"\n資料庫設定:")
-    print(f"  Host: {DB_HOST}")
-    print(f"  Port: {DB_PORT}")
-    print(f"  User: {DB_USER}")
-    print(f"  Database: {DB_NAME}")
+    if IS_SQLITE:
+        print(f"  Type: SQLite (WAL)")
+        print(f"  File: {SQLITE_PATH}")
+    else:
+        print(f"  Host: {DB_HOST}")
+        print(f"  Port: {DB_PORT}")
+        print(f"  User: {DB_USER}")
+        print(f"  Database: {DB_NAME}")
     print()
     
     # 步驟 1: 建立資料庫
@@ -0,0 +1,170 @@
+"""
+state_store 測試 (RedisStateStore 使用 fakeredis, 不需要 Redis 伺服器)
+
+執行: pip install pytest fakeredis && python -m pytest -q tests
+"""
+
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from server.state_store import MemoryStateStore, RedisStateStore, pick_worker
+
+
+def redis_store(server, worker_id: str, **kwargs) -> RedisStateStore:
+    """建立共用同一個 fakeredis 伺服器的 worker (模擬多個 worker 連到同一台 Redis)"""
+    client = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+    return RedisStateStore(worker_id=worker_id, prefix="test:", client=client, **kwargs)
+
+
+def test_lease_contention():
+    async def main():
+        server = fakeredis.FakeServer()
+        a, b = redis_store(server, "a"), redis_store(server, "b")
+
+        assert await a.claim_camera(1) is None
+        assert await b.claim_camera(1) == "a"
+        # 同一個 worker 再次連線仍可取得 (延長租約)
+        assert await a.claim_camera(1) is None
+        # 其他攝影機不受影響
+        assert await b.claim_camera(2) is None
+
+        await a.release_camera(1)
+        assert await b.claim_camera(1) == "a"   # a 還有一條連線
+        await a.release_camera(1)
+        assert await b.claim_camera(1) is None
+
+    asyncio.run(main())
+
+
+def test_lease_expires_for_dead_worker():
+    async def main():
+        server = fakeredis.FakeServer()
+        a = redis_store(server, "a", lease_seconds=0.05)
+        b = redis_store(server, "b")
+
+        assert await a.claim_camera(1) is None
+        # a 停止續約 (當機) 後, 租約過期即可由 b 接手
+        await asyncio.sleep(0.1)
+        assert await b.claim_camera(1) is None
+
+    asyncio.run(main())
+
+
+def test_try_alert_is_atomic():
+    async def main():
+        server = fakeredis.FakeServer()
+        stores = [redis_store(server, f"w{i}") for i in range(8)]
+
+        results = await asyncio.gather(*(store.try_alert(1, cooldown=10) for store in stores))
+        assert results.count(True) == 1
+        # 冷卻中
+        assert not await stores[0].try_alert(1, cooldown=10)
+        # 不同攝影機各自冷卻
+        assert await stores[0].try_alert(2, cooldown=10)
+
+    asyncio.run(main())
+
+
+def test_release_only_own_lease():
+    async def main():
+        server = fakeredis.FakeServer()
+        a, b = redis_store(server, "a", lease_seconds=0.05), redis_store(server, "b")
+
+        assert await a.claim_camera(1) is None
+        await asyncio.sleep(0.1)
+        assert await b.claim_camera(1) is None
+        # a 的連線結束時租約已轉給 b, 不可刪除 b 的租約
+        await a.release_camera(1)
+        assert await a.claim_camera(1) == "b"
+
+        # 沒有連線過的 worker 釋放也不影響持有者
+        c = redis_store(server, "c")
+        await c.release_camera(1)
+        assert await c.claim_camera(1) == "b"
+
+    asyncio.run(main())
+
+
+def test_pubsub_relay():
+    async def main():
+        server = fakeredis.FakeServer()
+        a, b = redis_store(server, "a"), redis_store(server, "b")
+        alerts, control = [], []
+        done = asyncio.Event()
+
+        async def on_control(message):
+            # 協程處理函式: 依收到的順序處理
+            control.append(message)
+            done.set()
+
+        listener = asyncio.create_task(b.listen({"alerts": alerts.append, "control": on_control}))
+        try:
+            await asyncio.sleep(0.05)  # 等待訂閱完成
+            assert a.publish("alerts", {"user_id": 1, "event": "detection", "data": {"id": 7}})
+            assert a.publish("control", {"type": "camera_deleted", "camera_id": 3})
+            await asyncio.wait_for(done.wait(), 2)
+        finally:
+            listener.cancel()
+
+        assert alerts == [{"user_id": 1, "event": "detection", "data": {"id": 7}}]
+        assert control == [{"type": "camera_deleted", "camera_id": 3}]
+
+    asyncio.run(main())
+
+
+def test_live_workers_and_rtsp_cameras():
+    async def main():
+        server = fakeredis.FakeServer()
+        a, b = redis_store(server, "a"), redis_store(server, "b")
+        heartbeats = [asyncio.create_task(store.run_heartbeat()) for store in (a, b)]
+        try:
+            await asyncio.sleep(0.05)
+            workers = await a.live_workers()
+            assert workers == ["a", "b"]
+        finally:
+            for task in heartbeats:
+                task.cancel()
+
+        await a.add_rtsp_cameras([1, 2, 3])
+        await b.remove_rtsp_cameras([2])
+        assert await b.rtsp_cameras() == {1, 3}
+        # 每個 worker 算出相同的分配
+        assert {pick_worker(camera_id, workers) for camera_id in range(100)} <= set(workers)
+
+        await b.close()
+        assert await a.live_workers() == ["a"]
+
+    asyncio.run(main())
+
+
+def test_memory_store_parity():
+    """單一進程與 Redis 的租約參照計數、連續幀數、冷卻行為一致"""
+    async def run(store):
+        trace = [await store.claim_camera(1), await store.claim_camera(1)]
+        await store.release_camera(1)
+        trace.append(store.get_stats()["cameras"])
+        await store.release_camera(1)
+        trace.append(store.get_stats()["cameras"])
+        await store.release_camera(1)  # 多釋放一次不出錯
+        trace.append(store.get_stats()["cameras"])
+
+        trace += [await store.incr_streak(1), await store.incr_streak(1)]
+        await store.reset_streak(1)
+        trace.append(await store.incr_streak(1))
+
+        trace += [await store.try_alert(1, cooldown=10), await store.try_alert(1, cooldown=10)]
+
+        await store.add_rtsp_cameras([4, 5])
+        await store.remove_rtsp_cameras([4])
+        trace.append(await store.rtsp_cameras())
+        return trace
+
+    async def main():
+        memory = await run(MemoryStateStore(worker_id="a"))
+        redis = await run(redis_store(fakeredis.FakeServer(), "a"))
+        assert memory == redis == [None, None, 1, 0, 0, 1, 2, 1, True, False, {5}]
+
+    asyncio.run(main())